@@ -3,4 +3,5 @@ __all__ = [
     'utils',
     'datasets',
     'kaldi',
+    'decoders',
 ]
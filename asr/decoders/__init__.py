@@ -0,0 +1,75 @@
+import importlib
+
+from .blank_skip import BlankSkipDecoder
+from .rescore import RescoringDecoder
+
+
+# decoder backends by name, imported on demand so that the Kaldi-free ones
+# don't require the latgen extension to be built
+DECODER_TYPES = {
+    "latgen": ("asr.kaldi.latgen", "LatGenCTCDecoder"),
+    "ctc_beam": ("asr.decoders.ctc_beam", "CTCBeamDecoder"),
+    "wfst": ("asr.decoders.wfst", "WFSTDecoder"),
+}
+
+
+# the keyword options each decoder takes, so that the ones meant for another decoder are rejected
+DECODER_OPTIONS = {
+    "latgen": ["label_file", "fst_file", "wd_file", "lexicon_file", "beam", "max_active", "min_active",
+               "acoustic_scale", "allow_partial", "lattice_beam", "decoder_config"],
+    "ctc_beam": ["label_file", "wd_file", "lexicon_file", "lm_file", "beam_size", "beam", "cutoff_top_n",
+                 "cutoff_beam", "lm_weight", "word_bonus", "acoustic_scale", "decode_workers", "decoder_config"],
+    "wfst": ["fst_file", "label_file", "wd_file", "lexicon_file", "beam", "max_active", "min_active",
+             "acoustic_scale", "allow_partial", "isymbols", "osymbols", "decoder_config"],
+}
+
+# the options of the wrappers by get_decoder, which any decoder takes
+WRAPPER_OPTIONS = ["blank_skip", "blank_skip_mode", "rescore_lm", "rescore_old_lm", "rescore_mode"]
+
+
+def decoder_options(options, decoder_type=None):
+    """ the options for get_decoder among the given ones, e.g. all the command-line options,
+        those of the decoder_type if given, or those of any decoder otherwise
+    """
+    names = set(WRAPPER_OPTIONS)
+    names.update(*(v for k, v in DECODER_OPTIONS.items() if decoder_type in (None, k)))
+    return { k: v for k, v in options.items() if k in names }
+
+
+def get_decoder(decoder_type="latgen", blank_skip=None, blank_skip_mode="merge", rescore_lm=None,
+                rescore_old_lm=None, rescore_mode="lattice", **kwargs):
+    """ build a decoder by its name, skipping the frames of blank posterior over
+        blank_skip before the search if given, and rescoring the lattices of the latgen
+        decoder by the rescore_lm if given. the options left None are of the defaults
+        of the decoder, and the others not in its DECODER_OPTIONS raise ValueError
+    """
+    assert decoder_type in DECODER_TYPES, f"decoder_type should be one of {set(DECODER_TYPES)}"
+    kwargs = { k: v for k, v in kwargs.items() if v is not None }
+    unknown = sorted(set(kwargs) - set(DECODER_OPTIONS[decoder_type]))
+    if unknown:
+        raise ValueError(f"{decoder_type} decoder doesn't take the options {unknown}")
+    module, name = DECODER_TYPES[decoder_type]
+    decoder_class = getattr(importlib.import_module(module), name)
+    decoder = decoder_class(**kwargs)
+    if rescore_lm is not None:
+        assert decoder_type == "latgen", "only the latgen decoder generates lattices for the rescoring"
+        decoder = RescoringDecoder(decoder, rescore_lm, rescore_old_lm, mode=rescore_mode)
+    if blank_skip is not None:
+        decoder = BlankSkipDecoder(decoder, threshold=blank_skip, mode=blank_skip_mode)
+    return decoder
+
+
+__all__ = [
+    'DECODER_TYPES',
+    'DECODER_OPTIONS',
+    'decoder_options',
+    'get_decoder',
+    'blank_skip',
+    'ctc_beam',
+    'ngram',
+    'posterior_cache',
+    'rescore',
+    'sweep',
+    'tune',
+    'wfst',
+]
@@ -0,0 +1,133 @@
+#!python
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from asr.utils.logger import logger, init_logger
+from asr.utils import params as p
+from asr.utils.edit_distance import edit_distance
+
+from . import DECODER_TYPES, get_decoder, decoder_options
+from .blank_skip import SKIP_MODES, BlankSkipDecoder
+from .posterior_cache import PosteriorCache
+
+
+# an output frame of the CTC models covers 3 spectrogram frames folded by FrameSplitter
+FRAME_SHIFT = p.WINDOW_SHIFT * 3
+
+
+def synthesize(labeler, num_utts=100, min_words=3, max_words=15, peak=(0.6, 0.95), seed=None):
+    """ generate CTC-like posteriors for random word sequences from the lexicon
+
+        returns the list of (TxH log-posteriors, reference word ids)
+    """
+    rng = np.random.RandomState(seed)
+    num_labels = labeler.get_num_labels()
+    blank = labeler.phone2idx('<blk>')
+    wids = np.array([w for w, lexs in labeler.wi2l.items() if w != 0 and any(lexs)])
+    utts = list()
+    for _ in range(num_utts):
+        words = rng.choice(wids, rng.randint(min_words, max_words + 1)).tolist()
+        labels = list()
+        for w in words:
+            lexs = [l for l in labeler.wi2l[w] if l]
+            labels.extend(lexs[rng.randint(len(lexs))])
+        frames = list()
+        for l in labels:
+            # repeated labels need a blank in between
+            num_blanks = rng.randint(1 if frames and frames[-1] == l else 0, 5)
+            frames.extend([blank] * num_blanks + [l] * rng.randint(1, 3))
+        frames.extend([blank] * rng.randint(1, 5))
+        # spread the remaining mass randomly over the other labels
+        posts = rng.dirichlet(np.full(num_labels, 0.1), size=len(frames))
+        tops = rng.uniform(*peak, size=len(frames))
+        posts *= (1. - tops)[:, None]
+        posts[np.arange(len(frames)), frames] += tops
+        utts.append((np.log(posts + p.EPS).astype(np.float32), words))
+    return utts
+
+
+def load_posteriors(labeler, file_path):
+    """ load log-posteriors from a posterior cache directory, or saved as a dict of 'loglikes' (list of TxH)
+        and 'texts'
+    """
+    if Path(file_path).is_dir():
+        return PosteriorCache(file_path).utterances(labeler)
+    states = torch.load(file_path, map_location="cpu")
+    utts = list()
+    for l, t in zip(states["loglikes"], states["texts"]):
+        words = [labeler.word2idx(w.strip()) for w in t.strip().split()]
+        utts.append((np.asarray(l, dtype=np.float32), words))
+    return utts
+
+
+def make_batches(utts, batch_size):
+    for i in range(0, len(utts), batch_size):
+        batch = utts[i:i+batch_size]
+        frame_lens = torch.IntTensor([len(l) for l, _ in batch])
+        loglikes = torch.zeros(len(batch), int(frame_lens.max()), batch[0][0].shape[1])
+        for j, (l, _) in enumerate(batch):
+            loglikes[j, :len(l)] = torch.from_numpy(l)
+        yield loglikes, frame_lens, [w for _, w in batch]
+
+
+def run(decoder, utts, batch_size=8, frame_shift=FRAME_SHIFT):
+    """ decode the utterances, returns (WER %, RTF) """
+    N, D, elapsed, duration = 0, 0, 0., 0.
+    for loglikes, frame_lens, refs in make_batches(utts, batch_size):
+        start = time.perf_counter()
+        words, alignments, w_sizes, a_sizes = decoder(loglikes, frame_lens)
+        elapsed += time.perf_counter() - start
+        duration += frame_lens.sum().item() * frame_shift
+        hyps = [w[:s].tolist() for w, s in zip(words, w_sizes)]
+        N += int(edit_distance(refs, hyps).sum())
+        D += sum(len(r) for r in refs)
+    return N * 100. / D, elapsed / duration
+
+
+def benchmark(argv):
+    parser = argparse.ArgumentParser(description="decoder accuracy and speed benchmark")
+    parser.add_argument('--decoders', default=["ctc_beam"], type=str, nargs='+', help=f"decoders in {set(DECODER_TYPES)}")
+    parser.add_argument('--posteriors', default=None, type=str, help="saved log-posteriors to decode, instead of synthetic ones")
+    parser.add_argument('--num-utts', default=100, type=int, help="number of synthetic utterances")
+    parser.add_argument('--batch-size', default=8, type=int, help="number of simultaneous decoding")
+    parser.add_argument('--frame-shift', default=FRAME_SHIFT, type=float, help="time shift of an output frame in secs")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--decode-workers', default=0, type=int, help="number of processes for ctc_beam decoder")
+    parser.add_argument('--blank-skip', default=[], type=float, nargs='*', help="blank skipping thresholds to compare")
+    parser.add_argument('--blank-skip-mode', default="merge", type=str, help=f"blank skipping mode in {SKIP_MODES}")
+    parser.add_argument('--seed', default=None, type=int, help="seed for the synthetic posteriors")
+    parser.add_argument('--log-dir', default='./logs_benchmark', type=str, help="filename for logging the outputs")
+    args = parser.parse_args(argv)
+
+    init_logger(log_file="benchmark.log", **vars(args))
+
+    options = { "lm_file": args.lm_file, "decode_workers": args.decode_workers }
+    decoders = {d: get_decoder(d, **decoder_options(options, d)) for d in args.decoders}
+    labeler = next(iter(decoders.values())).labeler
+
+    if args.posteriors is not None:
+        utts = load_posteriors(labeler, args.posteriors)
+    else:
+        utts = synthesize(labeler, num_utts=args.num_utts, seed=args.seed)
+    logger.info(f"{len(utts)} utterances, {sum(len(l) for l, _ in utts)} frames to decode")
+
+    for name, decoder in decoders.items():
+        wer, rtf = run(decoder, utts, batch_size=args.batch_size, frame_shift=args.frame_shift)
+        logger.info(f"{name}: WER {wer:.2f} %, RTF {rtf:.4f}")
+        # trade-off of the blank skipping
+        for threshold in args.blank_skip:
+            skipper = BlankSkipDecoder(decoder, threshold=threshold, mode=args.blank_skip_mode)
+            wer, rtf = run(skipper, utts, batch_size=args.batch_size, frame_shift=args.frame_shift)
+            logger.info(f"{name} with blank skip {threshold} ({args.blank_skip_mode}): WER {wer:.2f} %, "
+                        f"RTF {rtf:.4f}, {skipper.skip_ratio() * 100.:.1f} % frames skipped")
+        if hasattr(decoder, "close"):
+            decoder.close()
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:])
@@ -0,0 +1,97 @@
+#!python
+import math
+
+import torch
+
+
+SKIP_MODES = set([
+    "drop",
+    "merge",
+])
+
+
+def skip_blank_frames(loglikes, frame_lens, threshold=0.95, blank=0, mode="merge"):
+    """ remove the frames whose blank posterior exceeds the threshold
+
+        in the "drop" mode all of them are removed, and in the "merge" mode every run of them is
+        merged into a single frame of the averaged posteriors, so that a blank still separates
+        the repeated labels. returns the new NxT'xH loglikes, frame lens, and the NxT' index of
+        the original frame where each new frame starts
+    """
+    assert mode in SKIP_MODES
+    num_batch, num_frames, _ = loglikes.size()
+    valid = torch.arange(num_frames).unsqueeze(0) < frame_lens.long().unsqueeze(1)
+    skip = (loglikes[:, :, blank] > math.log(threshold)) & valid
+    if mode == "merge":
+        prev = torch.cat([skip.new_zeros(num_batch, 1), skip[:, :-1]], dim=1)
+        keep = valid & ~(skip & prev)
+    else:
+        keep = valid & ~skip
+
+    new_lens = keep.sum(dim=1).int()
+    max_len = max(int(new_lens.max()), 1) if num_batch > 0 else 1
+    new_loglikes = loglikes.new_full((num_batch, max_len, loglikes.size(2)), 0.)
+    frame_index = torch.zeros(num_batch, max_len, dtype=torch.long)
+    for i in range(num_batch):
+        index = keep[i].nonzero().view(-1)
+        frame_index[i, :len(index)] = index
+        if mode == "merge" and len(index) > 0:
+            # average posteriors over the frames folded into each kept frame
+            group = keep[i, :frame_lens[i]].long().cumsum(0) - 1
+            posts = torch.zeros(len(index), loglikes.size(2)).index_add_(0, group, loglikes[i, :frame_lens[i]].exp())
+            counts = torch.zeros(len(index)).index_add_(0, group, torch.ones(len(group)))
+            new_loglikes[i, :len(index)] = (posts / counts.unsqueeze(1)).log()
+        else:
+            new_loglikes[i, :len(index)] = loglikes[i, index]
+    return new_loglikes, new_lens, frame_index
+
+
+def restore_alignments(alignments, a_sizes, frame_index, frame_lens, blank_token=1):
+    """ map the per-frame alignments of the skipped frames back to the original timeline,
+        filling the removed frames with the blank token
+    """
+    num_batch = alignments.size(0)
+    max_len = int(frame_lens.max()) if num_batch > 0 else 0
+    restored = torch.zeros(num_batch, max_len, dtype=alignments.dtype)
+    for i in range(num_batch):
+        restored[i, :frame_lens[i]] = blank_token
+        size = int(a_sizes[i])
+        if size > 0:
+            restored[i, frame_index[i, :size]] = alignments[i, :size]
+    # alignments of failed utterances stay empty
+    sizes = torch.where(a_sizes > 0, frame_lens.int(), a_sizes.int())
+    return restored, sizes
+
+
+class BlankSkipDecoder:
+    """ wraps a decoder to search only the frames left after skipping the blank frames """
+
+    def __init__(self, decoder, threshold=0.95, mode="merge"):
+        self.decoder = decoder
+        self.labeler = decoder.labeler
+        self.threshold = threshold
+        self.mode = mode
+        self.blank = self.labeler.phone2idx('<blk>')
+        self.num_frames_in = 0
+        self.num_frames_out = 0
+
+    def __call__(self, loglikes, frame_lens):
+        return self.forward(loglikes, frame_lens)
+
+    def forward(self, loglikes, frame_lens):
+        new_loglikes, new_lens, frame_index = skip_blank_frames(loglikes, frame_lens, self.threshold,
+                                                                blank=self.blank, mode=self.mode)
+        self.num_frames_in += int(frame_lens.sum())
+        self.num_frames_out += int(new_lens.sum())
+        words, alignments, w_sizes, a_sizes = self.decoder(new_loglikes.contiguous(), new_lens)
+        # token ids in the alignment are shifted by one for <eps>
+        alignments, a_sizes = restore_alignments(alignments, a_sizes, frame_index, frame_lens,
+                                                 blank_token=self.blank + 1)
+        return words, alignments, w_sizes, a_sizes
+
+    def skip_ratio(self):
+        return 1. - self.num_frames_out / max(self.num_frames_in, 1)
+
+    def close(self):
+        if hasattr(self.decoder, "close"):
+            self.decoder.close()
@@ -0,0 +1,335 @@
+#!python
+import json
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+from asr.utils.logger import logger
+from asr.kaldi.labeler import Labeler, DEFAULT_CTC_LABEL, DEFAULT_WORDS, DEFAULT_LEXICON
+
+from .ngram import NGramLM
+
+
+NEG_INF = -np.inf
+EPS_WORD = 0
+
+
+class LexiconTrie:
+    """ prefix tree of the pronunciations in the lexicon, stored in flat arrays
+
+        edges are kept as sorted keys of `node * num_labels + label`, so that the children
+        of a batch of (node, label) pairs can be looked up by a single `np.searchsorted`
+    """
+
+    def __init__(self, labeler, sil_phone='sil'):
+        self.num_labels = labeler.get_num_labels()
+        children = [dict()]
+        words = [list()]
+
+        def insert(wid, lex):
+            node = 0
+            for l in lex:
+                if l not in children[node]:
+                    children[node][l] = len(children)
+                    children.append(dict())
+                    words.append(list())
+                node = children[node][l]
+            if wid not in words[node]:
+                words[node].append(wid)
+
+        for wid, lexs in labeler.wi2l.items():
+            for lex in lexs:
+                if lex:
+                    insert(wid, lex)
+        # optional silence between words, emitted as <eps>
+        if sil_phone in labeler.p2i:
+            insert(EPS_WORD, [labeler.phone2idx(sil_phone)])
+
+        self.num_nodes = len(children)
+        edges = sorted((n * self.num_labels + l, c) for n, ch in enumerate(children) for l, c in ch.items())
+        self.edge_keys = np.array([k for k, _ in edges], dtype=np.int64)
+        self.edge_nodes = np.array([c for _, c in edges], dtype=np.int64)
+        self.word_ptr = np.cumsum([0] + [len(w) for w in words]).astype(np.int64)
+        self.word_ids = np.array([w for ws in words for w in ws], dtype=np.int64)
+
+    def children(self, nodes, labels):
+        """ return child nodes of (nodes, labels) pairs, -1 if no such edge """
+        keys = nodes * self.num_labels + labels
+        pos = np.searchsorted(self.edge_keys, keys)
+        pos = np.minimum(pos, len(self.edge_keys) - 1)
+        return np.where(self.edge_keys[pos] == keys, self.edge_nodes[pos], -1)
+
+    def words(self, node):
+        return self.word_ids[self.word_ptr[node]:self.word_ptr[node+1]]
+
+
+class WordHistories:
+    """ interns the word sequences of the hypotheses to integer ids, with their LM states """
+
+    def __init__(self, lm=None, word2lm=None, lm_weight=0.8, word_bonus=0.0):
+        self.lm = lm
+        self.word2lm = word2lm
+        self.lm_weight = lm_weight
+        self.word_bonus = word_bonus
+        self.index = dict()
+        self.parent, self.word, self.score = [-1], [EPS_WORD], [0.]
+        self.state = [lm.start() if lm is not None else ()]
+
+    def extend(self, h, wid):
+        """ return the id of history h followed by wid, and the score of appending wid """
+        if wid == EPS_WORD:
+            return h, 0.
+        key = (h, wid)
+        if key not in self.index:
+            score, state = self.word_bonus, self.state[h]
+            if self.lm is not None:
+                lp, state = self.lm.score(state, int(self.word2lm[wid]))
+                score += self.lm_weight * lp
+            self.index[key] = len(self.parent)
+            self.parent.append(h)
+            self.word.append(wid)
+            self.state.append(state)
+            self.score.append(score)
+        i = self.index[key]
+        return i, self.score[i]
+
+    def final(self, h):
+        return self.lm_weight * self.lm.final(self.state[h]) if self.lm is not None else 0.
+
+    def words(self, h):
+        words = list()
+        while h > 0:
+            words.append(self.word[h])
+            h = self.parent[h]
+        return words[::-1]
+
+
+class CTCPrefixBeamSearch:
+    """ lexicon-constrained CTC prefix beam search with an optional word n-gram LM
+
+        every hypothesis is identified by (word history, trie node, last label), and all the
+        hypotheses of a frame are expanded, merged and pruned with array operations
+    """
+
+    def __init__(self, trie, lm=None, word2lm=None, blank=0, beam_size=64, beam=16.0,
+                 cutoff_top_n=20, cutoff_beam=8.0, lm_weight=0.8, word_bonus=0.0, acoustic_scale=1.0):
+        self.trie = trie
+        self.lm = lm
+        self.word2lm = word2lm
+        self.blank = blank
+        self.beam_size = beam_size
+        self.beam = beam
+        self.cutoff_top_n = cutoff_top_n
+        self.cutoff_beam = cutoff_beam
+        self.lm_weight = lm_weight
+        self.word_bonus = word_bonus
+        self.acoustic_scale = acoustic_scale
+
+    def _candidates(self, loglikes):
+        """ non-blank labels worth expanding for each frame, -1 for the pruned """
+        top_n = min(self.cutoff_top_n, loglikes.shape[1])
+        cands = np.argsort(-loglikes, axis=1)[:, :top_n]
+        scores = np.take_along_axis(loglikes, cands, axis=1)
+        keep = (scores >= loglikes.max(axis=1, keepdims=True) - self.cutoff_beam) & (cands != self.blank)
+        return np.where(keep, cands, -1)
+
+    def decode(self, loglikes):
+        """ loglikes is a TxH numpy array, returns (word ids, alignment) """
+        loglikes = loglikes.astype(np.float64) * self.acoustic_scale
+        num_frames, num_labels = loglikes.shape
+        candidates = self._candidates(loglikes)
+
+        histories = WordHistories(self.lm, self.word2lm, self.lm_weight, self.word_bonus)
+
+        # active hypotheses
+        hist = np.zeros(1, dtype=np.int64)
+        node = np.zeros(1, dtype=np.int64)
+        last = np.full(1, -1, dtype=np.int64)
+        pb = np.zeros(1)
+        pnb = np.full(1, NEG_INF)
+        lms = np.zeros(1)
+
+        back_parents, back_tokens = list(), list()
+
+        for t in range(num_frames):
+            lp = loglikes[t]
+            ptot = np.logaddexp(pb, pnb)
+            idx = np.arange(len(hist))
+
+            # staying at the same prefix: blank, or repeating the last label
+            rep = np.where(last >= 0, pnb + lp[np.maximum(last, 0)], NEG_INF)
+            stay_pb = ptot + lp[self.blank]
+
+            # extending the prefix by a new label along the trie
+            cands = candidates[t][candidates[t] >= 0]
+            e_idx = np.repeat(idx, len(cands))
+            e_lab = np.tile(cands, len(idx))
+            e_node = self.trie.children(node[e_idx], e_lab)
+            valid = e_node >= 0
+            e_idx, e_lab, e_node = e_idx[valid], e_lab[valid], e_node[valid]
+            e_p = np.where(e_lab == last[e_idx], pb[e_idx], ptot[e_idx]) + lp[e_lab]
+
+            # completing words at the trie leaves, going back to the root
+            w_idx, w_hist, w_lab, w_p, w_lms = list(), list(), list(), list(), list()
+            for i in np.flatnonzero(self.trie.word_ptr[e_node+1] > self.trie.word_ptr[e_node]):
+                src = e_idx[i]
+                for wid in self.trie.words(e_node[i]):
+                    h, score = histories.extend(int(hist[src]), int(wid))
+                    w_idx.append(src)
+                    w_hist.append(h)
+                    w_lab.append(e_lab[i])
+                    w_p.append(e_p[i])
+                    w_lms.append(lms[src] + score)
+
+            num_w = len(w_idx)
+            w_idx = np.array(w_idx, dtype=np.int64)
+            c_parent = np.concatenate([idx, e_idx, w_idx])
+            c_hist = np.concatenate([hist, hist[e_idx], np.array(w_hist, dtype=np.int64)])
+            c_node = np.concatenate([node, e_node, np.zeros(num_w, dtype=np.int64)])
+            c_last = np.concatenate([last, e_lab, np.array(w_lab, dtype=np.int64)])
+            c_pb = np.concatenate([stay_pb, np.full(len(e_idx) + num_w, NEG_INF)])
+            c_pnb = np.concatenate([rep, e_p, np.array(w_p, dtype=np.float64)])
+            c_lms = np.concatenate([lms, lms[e_idx], np.array(w_lms, dtype=np.float64)])
+            # the label consumed at this frame, for the alignment
+            c_tok = np.concatenate([np.where(stay_pb >= rep, self.blank, last), e_lab,
+                                    np.array(w_lab, dtype=np.int64)])
+
+            # merge the same hypotheses, keeping the best contributor for the back-pointer
+            keys = (c_hist * self.trie.num_nodes + c_node) * (num_labels + 1) + (c_last + 1)
+            order = np.lexsort((-np.maximum(c_pb, c_pnb), keys))
+            keys = keys[order]
+            starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            first = order[starts]
+            pb = np.logaddexp.reduceat(c_pb[order], starts)
+            pnb = np.logaddexp.reduceat(c_pnb[order], starts)
+            hist, node, last, lms = c_hist[first], c_node[first], c_last[first], c_lms[first]
+            parent, token = c_parent[first], c_tok[first]
+
+            # beam pruning
+            scores = np.logaddexp(pb, pnb) + lms
+            keep = np.flatnonzero(scores >= scores.max() - self.beam)
+            if len(keep) > self.beam_size:
+                keep = keep[np.argpartition(-scores[keep], self.beam_size)[:self.beam_size]]
+            hist, node, last, lms = hist[keep], node[keep], last[keep], lms[keep]
+            pb, pnb = pb[keep], pnb[keep]
+            back_parents.append(parent[keep])
+            back_tokens.append(token[keep])
+
+        # closing sentences: prefer the hypotheses ending at word boundaries
+        scores = np.logaddexp(pb, pnb) + lms
+        scores += np.array([histories.final(h) for h in hist])
+        complete = node == 0
+        if complete.any():
+            scores = np.where(complete, scores, NEG_INF)
+        best = int(np.argmax(scores))
+
+        words = histories.words(int(hist[best]))
+
+        alignment = np.zeros(num_frames, dtype=np.int64)
+        i = best
+        for t in range(num_frames - 1, -1, -1):
+            alignment[t] = back_tokens[t][i]
+            i = back_parents[t][i]
+        return words, alignment
+
+
+# the search object for the workers in the process pool
+_search = None
+
+
+def _init_worker(search):
+    global _search
+    _search = search
+    torch.set_num_threads(1)
+
+
+def _decode_worker(loglikes):
+    return _search.decode(loglikes)
+
+
+class CTCBeamDecoder:
+    """ Kaldi-free decoder running the CTC prefix beam search on the lexicon of the Labeler,
+        with an optional ARPA n-gram LM. the outputs are the same with the LatGenDecoder's
+    """
+
+    def __init__(self, label_file=str(DEFAULT_CTC_LABEL), wd_file=str(DEFAULT_WORDS),
+                 lexicon_file=str(DEFAULT_LEXICON), lm_file=None, beam_size=64, beam=16.0,
+                 cutoff_top_n=20, cutoff_beam=8.0, lm_weight=0.8, word_bonus=0.0, acoustic_scale=1.0,
+                 decode_workers=0, decoder_config=None):
+        # search options tuned by asr.decoders.tune override the arguments
+        if decoder_config is not None:
+            with open(decoder_config, "r") as f:
+                config = json.load(f)
+            beam_size = config.get("beam_size", beam_size)
+            beam = config.get("beam", beam)
+            cutoff_top_n = config.get("cutoff_top_n", cutoff_top_n)
+            cutoff_beam = config.get("cutoff_beam", cutoff_beam)
+            lm_weight = config.get("lm_weight", lm_weight)
+            word_bonus = config.get("word_bonus", word_bonus)
+            acoustic_scale = config.get("acoustic_scale", acoustic_scale)
+
+        # labels info
+        self.labeler = Labeler(label_file, wd_file, lexicon_file)
+
+        lm, word2lm = None, None
+        if lm_file is not None:
+            lm = NGramLM(lm_file)
+            word2lm = np.full(len(self.labeler.i2w), lm.unk_id, dtype=np.int64)
+            for w, i in self.labeler.w2i.items():
+                word2lm[i] = lm.index(w)
+
+        self.search = CTCPrefixBeamSearch(LexiconTrie(self.labeler), lm=lm, word2lm=word2lm,
+                                          blank=self.labeler.phone2idx('<blk>'),
+                                          beam_size=beam_size, beam=beam,
+                                          cutoff_top_n=cutoff_top_n, cutoff_beam=cutoff_beam,
+                                          lm_weight=lm_weight, word_bonus=word_bonus,
+                                          acoustic_scale=acoustic_scale)
+        self.decode_workers = decode_workers
+        self.pool = None
+
+    def __call__(self, loglikes, frame_lens):
+        return self.forward(loglikes, frame_lens)
+
+    def forward(self, loglikes, frame_lens):
+        # loglikes should NxTxH (N: batch size, T: frames, H: classes)
+        assert loglikes.dim() == 3 and loglikes.size(2) == self.labeler.get_num_labels()
+        assert frame_lens.dim() == 1 and loglikes.size(0) == frame_lens.size(0)
+
+        loglikes = loglikes.detach().float().numpy()
+        batch = [l[:s] for l, s in zip(loglikes, frame_lens.tolist())]
+        if self.decode_workers > 0 and len(batch) > 1:
+            if self.pool is None:
+                logger.debug(f"starting {self.decode_workers} decoding workers")
+                self.pool = mp.Pool(self.decode_workers, initializer=_init_worker, initargs=(self.search, ))
+            results = self.pool.map(_decode_worker, batch)
+        else:
+            results = [self.search.decode(l) for l in batch]
+
+        w_sizes = torch.IntTensor([len(w) for w, _ in results])
+        a_sizes = torch.IntTensor([len(a) for _, a in results])
+        words = torch.IntTensor(len(results), max(w_sizes.tolist() + [0])).zero_()
+        alignments = torch.IntTensor(len(results), max(a_sizes.tolist() + [0])).zero_()
+        for i, (w, a) in enumerate(results):
+            words[i, :len(w)] = torch.IntTensor(w)
+            # token ids in the alignment are shifted by one for <eps>, as in the TLG graph
+            alignments[i, :len(a)] = torch.from_numpy(a + 1).int()
+        return words, alignments, w_sizes, a_sizes
+
+    def close(self):
+        """ stop the decoding workers, which are started again by the next decoding """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
@@ -0,0 +1,229 @@
+#!python
+import math
+
+import numpy as np
+
+from asr.utils.kaldi_io import smart_open
+from asr.utils.logger import logger
+
+
+LOG10 = math.log(10.)
+
+
+class NGramLM:
+    """ back-off n-gram language model read from an ARPA file
+
+        words are mapped to their own integer ids by `index()`, and all the scores
+        are converted from log10 to the natural log to be summed with the acoustic scores
+    """
+
+    def __init__(self, arpa_file, unk='<unk>', bos='<s>', eos='</s>'):
+        self.arpa_file = arpa_file
+        self.vocab = dict()
+        self.probs = list()
+        self.backoffs = list()
+
+        self.__load_arpa_file()
+
+        self.order = len(self.probs)
+        self.unk_id = self.vocab.get(unk, -1)
+        self.bos_id = self.vocab.get(bos, -1)
+        self.eos_id = self.vocab.get(eos, -1)
+        # log-prob for the words not in the vocab, taken from <unk> if the model has it
+        self.unk_logprob = self.probs[0].get((self.unk_id, ), -99. * LOG10)
+        logger.debug(f"{self.order}-gram LM loaded from {arpa_file}: "
+                     f"{', '.join(str(len(x)) for x in self.probs)} entries")
+
+    def __load_arpa_file(self):
+        order = 0
+        with smart_open(self.arpa_file, "rb") as f:
+            for line in f:
+                line = line.decode('utf-8').strip()
+                if not line or line.startswith("ngram "):
+                    continue
+                if line.startswith("\\"):
+                    if line.endswith("-grams:"):
+                        order = int(line[1:line.index("-")])
+                        self.probs.append(dict())
+                        self.backoffs.append(dict())
+                    elif line == "\\end\\":
+                        break
+                    continue
+                if order == 0:
+                    continue
+                token = line.split()
+                ngram = tuple(self.__add_word(w) for w in token[1:order+1])
+                self.probs[order-1][ngram] = float(token[0]) * LOG10
+                if len(token) > order + 1:
+                    self.backoffs[order-1][ngram] = float(token[order+1]) * LOG10
+
+    def __add_word(self, word):
+        if word not in self.vocab:
+            self.vocab[word] = len(self.vocab)
+        return self.vocab[word]
+
+    def index(self, word):
+        return self.vocab.get(word, self.unk_id)
+
+    def start(self):
+        """ initial history state of a sentence """
+        return (self.bos_id, ) if self.bos_id >= 0 and self.order > 1 else ()
+
+    def score(self, state, wid):
+        """ return log p(wid | state) with back-off, and the next history state """
+        state = state[len(state)-self.order+1:] if self.order > 1 else ()
+        history, logprob = state, 0.
+        while True:
+            ngram = history + (wid, )
+            lp = self.probs[len(ngram)-1].get(ngram)
+            if lp is not None:
+                logprob += lp
+                break
+            if not history:
+                logprob += self.unk_logprob
+                break
+            logprob += self.backoffs[len(history)-1].get(history, 0.)
+            history = history[1:]
+        next_state = (state + (wid, ))[1:] if len(state) == self.order - 1 else state + (wid, )
+        return logprob, next_state
+
+    def final(self, state):
+        """ log-prob for closing the sentence """
+        if self.eos_id < 0:
+            return 0.
+        return self.score(state, self.eos_id)[0]
+
+
+class TrieNGramLM(NGramLM):
+    """ the same back-off n-gram LM as NGramLM, held in sorted numpy arrays instead of dicts
+        for the large LMs used in the rescoring
+
+        an n-gram is a row of the n-th order arrays, searched by the key of its (n-1)-gram row
+        and the last word id, as `row * vocab_size + word`. the keys of each order are sorted
+        so a child is found by the binary search, and a row costs 16 bytes in total
+    """
+
+    def __init__(self, arpa_file, unk='<unk>', bos='<s>', eos='</s>'):
+        self.arpa_file = arpa_file
+        self.vocab = dict()
+
+        ngrams, probs, backoffs = self.__load_arpa_file()
+        self.__build_trie(ngrams, probs, backoffs)
+
+        self.order = len(self.probs)
+        self.unk_id = self.vocab.get(unk, -1)
+        self.bos_id = self.vocab.get(bos, -1)
+        self.eos_id = self.vocab.get(eos, -1)
+        self.unk_logprob = float(self.probs[0][self.unk_id]) if self.unk_id >= 0 else -99. * LOG10
+        logger.debug(f"{self.order}-gram trie LM loaded from {arpa_file}: "
+                     f"{', '.join(str(len(x)) for x in self.probs)} entries")
+
+    def __load_arpa_file(self):
+        counts, ngrams, probs, backoffs = list(), list(), list(), list()
+        order, pos = 0, 0
+        with smart_open(self.arpa_file, "rb") as f:
+            for line in f:
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                if line.startswith("ngram "):
+                    counts.append(int(line.split("=")[1]))
+                    continue
+                if line.startswith("\\"):
+                    if line.endswith("-grams:"):
+                        order = int(line[1:line.index("-")])
+                        # preallocate by the counts in the header
+                        ngrams.append(np.full((counts[order-1], order), -1, dtype=np.int32))
+                        probs.append(np.zeros(counts[order-1], dtype=np.float32))
+                        backoffs.append(np.zeros(counts[order-1], dtype=np.float32))
+                        pos = 0
+                    elif line == "\\end\\":
+                        break
+                    continue
+                if order == 0:
+                    continue
+                token = line.split()
+                if order == 1:
+                    self.vocab.setdefault(token[1], len(self.vocab))
+                ngrams[order-1][pos] = [self.vocab.get(w, -1) for w in token[1:order+1]]
+                probs[order-1][pos] = float(token[0]) * LOG10
+                if len(token) > order + 1:
+                    backoffs[order-1][pos] = float(token[order+1]) * LOG10
+                pos += 1
+        return ngrams, probs, backoffs
+
+    def __build_trie(self, ngrams, probs, backoffs):
+        V = len(self.vocab)
+        # unigrams are indexed by the word ids directly
+        order = np.argsort(ngrams[0][:, 0])
+        self.keys = [np.arange(V, dtype=np.int64)]
+        self.probs = [probs[0][order]]
+        self.backoffs = [backoffs[0][order]]
+        for n in range(1, len(ngrams)):
+            rows = ngrams[n][:, 0].astype(np.int64)
+            for j in range(1, n):
+                rows = self._find_rows(j, rows, ngrams[n][:, j])
+            valid = (rows >= 0) & (ngrams[n][:, n] >= 0)
+            if not valid.all():
+                logger.warning(f"{(~valid).sum()} {n+1}-grams without their contexts are ignored")
+            keys = rows[valid] * V + ngrams[n][valid, n]
+            order = np.argsort(keys, kind='mergesort')
+            self.keys.append(keys[order])
+            self.probs.append(probs[n][valid][order])
+            self.backoffs.append(backoffs[n][valid][order])
+
+    def _find_rows(self, n, rows, words):
+        """ rows of the (n+1)-grams extending the n-gram rows by the words, -1 if not found """
+        keys = rows * len(self.vocab) + words
+        pos = np.minimum(np.searchsorted(self.keys[n], keys), len(self.keys[n]) - 1)
+        found = (rows >= 0) & (words >= 0) & (self.keys[n][pos] == keys)
+        return np.where(found, pos, -1)
+
+    def _find_row(self, ngram):
+        """ row of the n-gram, -1 if not found or if it has the words out of the vocab, the id -1
+            without <unk> in the LM, whose keys would alias the other n-grams
+        """
+        row = ngram[0]
+        if row < 0:
+            return -1
+        for n, w in enumerate(ngram[1:], 1):
+            if w < 0:
+                return -1
+            key = row * len(self.vocab) + w
+            row = int(np.searchsorted(self.keys[n], key))
+            if row >= len(self.keys[n]) or self.keys[n][row] != key:
+                return -1
+        return row
+
+    def score(self, state, wid):
+        """ return log p(wid | state) with back-off, and the next history state """
+        state = state[len(state)-self.order+1:] if self.order > 1 else ()
+        history, logprob = state, 0.
+        while True:
+            ngram = history + (wid, )
+            row = self._find_row(ngram) if wid >= 0 else -1
+            if row >= 0:
+                logprob += float(self.probs[len(ngram)-1][row])
+                break
+            if not history:
+                logprob += self.unk_logprob
+                break
+            row = self._find_row(history)
+            if row >= 0:
+                logprob += float(self.backoffs[len(history)-1][row])
+            history = history[1:]
+        next_state = (state + (wid, ))[1:] if len(state) == self.order - 1 else state + (wid, )
+        return logprob, next_state
+
+
+if __name__ == "__main__":
+    import sys
+    lm = NGramLM(sys.argv[1])
+    words = sys.argv[2:]
+    state, total = lm.start(), 0.
+    for w in words:
+        lp, state = lm.score(state, lm.index(w))
+        print(f"{w}: {lp / LOG10:.4f}")
+        total += lp
+    total += lm.final(state)
+    print(f"total log10 prob: {total / LOG10:.4f}")
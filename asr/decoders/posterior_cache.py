@@ -0,0 +1,140 @@
+#!python
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from asr.utils import params as p
+
+
+INDEX_FILE = "index.json"
+VALUE_FILE = "values.f16"
+LABEL_FILE = "labels.u16"
+
+
+class PosteriorWriter:
+    """ store per-utterance log-posteriors in float16, optionally keeping only the top-k labels of each frame
+
+        the store is a directory of a flat value file, a flat label file for top-k, and a json index of
+        the utterance names, texts, offsets and frame lengths
+    """
+
+    def __init__(self, path, num_labels, top_k=None):
+        self.path = Path(path)
+        self.path.mkdir(mode=0o755, parents=True, exist_ok=True)
+        self.num_labels = num_labels
+        self.top_k = top_k if top_k is not None and top_k < num_labels else None
+        self.utts = list()
+        self.offset = 0
+        self.values = open(self.path.joinpath(VALUE_FILE), "wb")
+        self.labels = open(self.path.joinpath(LABEL_FILE), "wb") if self.top_k is not None else None
+
+    def add(self, name, loglikes, text=None):
+        """ add TxH log-posteriors of an utterance """
+        if torch.is_tensor(loglikes):
+            loglikes = loglikes.detach().cpu().numpy()
+        assert loglikes.ndim == 2 and loglikes.shape[1] == self.num_labels
+        if self.top_k is not None:
+            labels = np.argpartition(-loglikes, self.top_k - 1, axis=1)[:, :self.top_k]
+            loglikes = np.take_along_axis(loglikes, labels, axis=1)
+            self.labels.write(labels.astype(np.uint16).tobytes())
+        self.values.write(loglikes.astype(np.float16).tobytes())
+        self.utts.append({ "name": str(name), "text": text, "offset": self.offset, "frames": len(loglikes) })
+        self.offset += len(loglikes)
+
+    def close(self):
+        self.values.close()
+        if self.labels is not None:
+            self.labels.close()
+        index = { "num_labels": self.num_labels, "top_k": self.top_k, "utts": self.utts }
+        with open(self.path.joinpath(INDEX_FILE), "w") as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PosteriorCache:
+    """ read-only memory-mapped access to the log-posteriors stored by PosteriorWriter
+
+        the path can also be of the rank_XX shards dumped by the ranks of a distributed run, read
+        in the order of the ranks, where the utterances repeated to even up the shards are skipped
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.shards = None
+        if not self.path.joinpath(INDEX_FILE).exists():
+            self.__load_shards()
+            return
+        with open(self.path.joinpath(INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.num_labels = index["num_labels"]
+        self.top_k = index["top_k"]
+        self.utts = index["utts"]
+        self.names = { u["name"]: i for i, u in enumerate(self.utts) }
+        width = self.num_labels if self.top_k is None else self.top_k
+        num_frames = sum(u["frames"] for u in self.utts)
+        self.values = np.memmap(self.path.joinpath(VALUE_FILE), dtype=np.float16, mode="r",
+                                shape=(num_frames, width)) if num_frames > 0 else None
+        if self.top_k is not None and num_frames > 0:
+            self.labels = np.memmap(self.path.joinpath(LABEL_FILE), dtype=np.uint16, mode="r",
+                                    shape=(num_frames, width))
+
+    def __load_shards(self):
+        paths = sorted(d for d in self.path.glob("rank_*") if d.joinpath(INDEX_FILE).exists())
+        if not paths:
+            raise FileNotFoundError(f"no posterior cache found in {self.path}")
+        self.shards = [PosteriorCache(d) for d in paths]
+        self.num_labels = self.shards[0].num_labels
+        self.top_k = self.shards[0].top_k
+        assert all(c.num_labels == self.num_labels and c.top_k == self.top_k for c in self.shards)
+        self.utts, self.names, self.locations = list(), dict(), list()
+        for shard in self.shards:
+            for i, utt in enumerate(shard.utts):
+                if utt["name"] in self.names:
+                    continue
+                self.names[utt["name"]] = len(self.utts)
+                self.utts.append(utt)
+                self.locations.append((shard, i))
+
+    def __len__(self):
+        return len(self.utts)
+
+    def __getitem__(self, idx):
+        """ returns (TxH float32 log-posteriors, text) of the utterance by its position or name """
+        if isinstance(idx, str):
+            idx = self.names[idx]
+        if self.shards is not None:
+            shard, i = self.locations[idx]
+            return shard[i]
+        utt = self.utts[idx]
+        s, l = utt["offset"], utt["frames"]
+        values = np.asarray(self.values[s:s+l], dtype=np.float32)
+        if self.top_k is None:
+            return values, utt["text"]
+        # spread the mass of the pruned labels evenly over them
+        rest = np.clip(1. - np.exp(values).sum(axis=1), p.EPS, None) / (self.num_labels - self.top_k)
+        loglikes = np.repeat(np.log(rest)[:, None], self.num_labels, axis=1).astype(np.float32)
+        np.put_along_axis(loglikes, self.labels[s:s+l].astype(np.int64), values, axis=1)
+        return loglikes, utt["text"]
+
+    def utterances(self, labeler):
+        """ returns the list of (TxH log-posteriors, reference word ids) as in the decoder benchmark """
+        utts = list()
+        for i in range(len(self)):
+            loglikes, text = self[i]
+            words = [labeler.word2idx(w.strip()) for w in text.strip().split()] if text else []
+            utts.append((loglikes, words))
+        return utts
+
+
+if __name__ == "__main__":
+    import sys
+    cache = PosteriorCache(sys.argv[1])
+    frames = sum(u["frames"] for u in cache.utts)
+    print(f"{len(cache)} utterances, {frames} frames, {cache.num_labels} labels, top_k={cache.top_k}")
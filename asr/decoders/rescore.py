@@ -0,0 +1,160 @@
+#!python
+import numpy as np
+import torch
+
+from asr.utils.logger import logger
+
+from .ngram import TrieNGramLM
+
+
+RESCORE_MODES = set([
+    "lattice",
+    "nbest",
+])
+
+
+class LMRescorer:
+    """ second pass replacing the LM scores of the first pass graph with a larger n-gram LM
+
+        the cost of a path is `acoustic_scale * acoustic + graph + lm_weight * new LM - old LM`,
+        where the old LM is the one compiled into the graph, if given, to take its scores out
+    """
+
+    def __init__(self, labeler, lm_file, old_lm_file=None, lm_weight=1.0, acoustic_scale=1.0,
+                 max_histories=20, beam=10.0):
+        self.labeler = labeler
+        self.lm = TrieNGramLM(lm_file)
+        self.old_lm = TrieNGramLM(old_lm_file) if old_lm_file is not None else None
+        self.word2lm = self.__word_map(self.lm)
+        self.word2old = self.__word_map(self.old_lm) if self.old_lm is not None else None
+        self.lm_weight = lm_weight
+        self.acoustic_scale = acoustic_scale
+        self.max_histories = max_histories
+        self.beam = beam
+
+    def __word_map(self, lm):
+        word2lm = np.full(len(self.labeler.i2w), lm.unk_id, dtype=np.int64)
+        for w, i in self.labeler.w2i.items():
+            word2lm[i] = lm.index(w)
+        return word2lm
+
+    def start(self):
+        return (self.lm.start(), self.old_lm.start() if self.old_lm is not None else ())
+
+    def score(self, state, wid, cache=None):
+        """ LM cost of the word and the next state, memoized in the cache if given """
+        if cache is not None and (state, wid) in cache:
+            return cache[(state, wid)]
+        lp, new_state = self.lm.score(state[0], int(self.word2lm[wid]))
+        cost, old_state = -self.lm_weight * lp, state[1]
+        if self.old_lm is not None:
+            old_lp, old_state = self.old_lm.score(state[1], int(self.word2old[wid]))
+            cost += old_lp
+        result = (cost, (new_state, old_state))
+        if cache is not None:
+            cache[(state, wid)] = result
+        return result
+
+    def final(self, state):
+        cost = -self.lm_weight * self.lm.final(state[0])
+        if self.old_lm is not None:
+            cost += self.old_lm.final(state[1])
+        return cost
+
+    def rescore_nbest(self, words, scores):
+        """ returns the index of the best path among the K paths of words and (graph, acoustic) costs """
+        best, best_cost = -1, float("inf")
+        cache = dict()
+        for k, (ws, (graph, acoustic)) in enumerate(zip(words, scores)):
+            if not np.isfinite(graph):
+                continue
+            cost, state = self.acoustic_scale * acoustic + graph, self.start()
+            for w in ws:
+                c, state = self.score(state, w, cache)
+                cost += c
+            cost += self.final(state)
+            if cost < best_cost:
+                best, best_cost = k, cost
+        return best
+
+    def rescore_lattice(self, arcs, weights):
+        """ best word sequence of a topologically sorted word lattice of (src, dst, word) arcs
+            and their (graph, acoustic) costs, expanding the lattice states by the LM histories
+        """
+        arcs, weights = np.asarray(arcs), np.asarray(weights)
+        num_states = int(arcs[:, :2].max()) + 1 if len(arcs) else 0
+        costs = self.acoustic_scale * weights[:, 1] + weights[:, 0]
+        order = np.argsort(arcs[:, 0], kind='mergesort')
+        arc_ptr = np.searchsorted(arcs[order, 0], np.arange(num_states + 1))
+        # tokens of each lattice state, LM state -> (cost, prev lattice state, prev LM state, word)
+        tokens = [dict() for _ in range(num_states)]
+        if num_states > 0:
+            tokens[0][self.start()] = (0., -1, None, 0)
+        best, cache = (float("inf"), -1, None), dict()
+        for s in range(num_states):
+            toks = tokens[s]
+            if not toks:
+                continue
+            # keep the histories within the beam and the max number
+            cutoff = min(t[0] for t in toks.values()) + self.beam
+            kept = sorted((t[0], h) for h, t in toks.items() if t[0] <= cutoff)[:self.max_histories]
+            for a in order[arc_ptr[s]:arc_ptr[s+1]]:
+                dst, wid = int(arcs[a, 1]), int(arcs[a, 2])
+                for cost, h in kept:
+                    if dst < 0:
+                        total = cost + costs[a] + self.final(h)
+                        if total < best[0]:
+                            best = (total, s, h)
+                        continue
+                    lm_cost, next_h = self.score(h, wid, cache) if wid > 0 else (0., h)
+                    total = cost + costs[a] + lm_cost
+                    if next_h not in tokens[dst] or total < tokens[dst][next_h][0]:
+                        tokens[dst][next_h] = (total, s, h, wid)
+        # trace back the best path
+        words, s, h = list(), best[1], best[2]
+        while s >= 0:
+            _, prev_s, prev_h, wid = tokens[s][h]
+            if wid > 0:
+                words.append(wid)
+            s, h = prev_s, prev_h
+        return words[::-1]
+
+
+class RescoringDecoder:
+    """ wraps the latgen decoder to rescore its lattices or n-best paths by a larger n-gram LM """
+
+    def __init__(self, decoder, lm_file, old_lm_file=None, mode="lattice", nbest=100, lm_weight=1.0,
+                 acoustic_scale=1.0, max_histories=20, beam=10.0):
+        assert mode in RESCORE_MODES
+        self.decoder = decoder
+        self.labeler = decoder.labeler
+        self.mode = mode
+        self.nbest = nbest
+        self.rescorer = LMRescorer(self.labeler, lm_file, old_lm_file, lm_weight=lm_weight,
+                                   acoustic_scale=acoustic_scale, max_histories=max_histories, beam=beam)
+        logger.debug(f"rescoring {mode} by the LM {lm_file}")
+
+    def __call__(self, loglikes, frame_lens):
+        return self.forward(loglikes, frame_lens)
+
+    def forward(self, loglikes, frame_lens):
+        if self.mode == "nbest":
+            words, alignments, scores, w_sizes, a_sizes = self.decoder.nbest(loglikes, frame_lens, self.nbest)
+            best = [self.rescorer.rescore_nbest([w[:s].tolist() for w, s in zip(ws, ss)], sc.tolist())
+                    for ws, ss, sc in zip(words, w_sizes, scores)]
+            results = [(ws[k, :s[k]].tolist(), als[k, :t[k]]) if k >= 0 else ([], als[0, :0])
+                       for k, ws, s, als, t in zip(best, words, w_sizes, alignments, a_sizes)]
+        else:
+            arcs, weights, l_sizes, alignments, a_sizes = self.decoder.lattice(loglikes, frame_lens)
+            # the alignments are of the first pass best paths
+            results = [(self.rescorer.rescore_lattice(a[:l].numpy(), w[:l].numpy()) if l > 0 else [], al[:s])
+                       for a, w, l, al, s in zip(arcs, weights, l_sizes, alignments, a_sizes)]
+
+        w_sizes = torch.IntTensor([len(w) for w, _ in results])
+        a_sizes = torch.IntTensor([len(a) for _, a in results])
+        words = torch.IntTensor(len(results), max(w_sizes.tolist() + [0])).zero_()
+        alignments = torch.IntTensor(len(results), max(a_sizes.tolist() + [0])).zero_()
+        for i, (w, a) in enumerate(results):
+            words[i, :len(w)] = torch.IntTensor(w)
+            alignments[i, :len(a)] = a
+        return words, alignments, w_sizes, a_sizes
@@ -0,0 +1,113 @@
+#!python
+import sys
+import argparse
+import resource
+import itertools
+import multiprocessing as mp
+
+import torch
+
+from asr.utils.logger import logger, init_logger
+
+from . import DECODER_TYPES, get_decoder, decoder_options
+from .benchmark import FRAME_SHIFT, run
+from .posterior_cache import PosteriorCache
+
+
+SWEEP_PARAMS = [
+    "beam",
+    "max_active",
+    "acoustic_scale",
+    "lm_weight",
+    "blank_skip",
+]
+
+
+def _decode_setting(source, decoder_type, setting, batch_size, frame_shift, decoder_kwargs, count_active):
+    """ decode the utterances, or the posterior cache if the source is its path, with a setting
+        and return the setting with its WER, RTF, peak active tokens and peak memory in MB. the
+        latgen decoder counts the active tokens only if count_active, which slows it down
+    """
+    # every setting takes a single core so that the settings decode in parallel
+    torch.set_num_threads(1)
+    decoder = get_decoder(decoder_type, **decoder_kwargs, **setting)
+    utts = PosteriorCache(source).utterances(decoder.labeler) if isinstance(source, str) else source
+    # the search of the wrapped decoder
+    base = decoder
+    while hasattr(base, "decoder"):
+        base = base.decoder
+    if count_active and hasattr(base, "count_active_tokens"):
+        base.count_active_tokens(True)
+    wer, rtf = run(decoder, utts, batch_size=batch_size, frame_shift=frame_shift)
+    peak_active = base.peak_active_tokens() if hasattr(base, "peak_active_tokens") else None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return setting, { "wer": wer, "rtf": rtf, "peak_active": peak_active, "max_rss": max_rss }
+
+
+def decode_settings(source, decoder_type, settings, batch_size=8, frame_shift=FRAME_SHIFT,
+                    decoder_kwargs=dict(), workers=1, count_active=False):
+    """ decode the settings in parallel, returns the list of (setting, stats) """
+    jobs = [(source, decoder_type, s, batch_size, frame_shift, decoder_kwargs, count_active) for s in settings]
+    # a fresh process for each setting, since the latgen decoder keeps a global instance,
+    # and for the peak memory of each setting
+    with mp.Pool(processes=max(min(workers, len(jobs)), 1), maxtasksperchild=1) as pool:
+        return pool.starmap(_decode_setting, jobs)
+
+
+def grid_settings(args, params, decoder_type):
+    """ the settings of all the combinations of the values in args of the params that the decoder
+        takes, the others are left out not to repeat the same setting
+    """
+    taken = [k for k in params if k in decoder_options(dict.fromkeys(params), decoder_type)]
+    ignored = [k for k in params if k not in taken]
+    if ignored:
+        logger.info(f"{decoder_type} decoder doesn't take {ignored}, left out of the grid")
+    grid = [getattr(args, k) for k in taken]
+    return [dict(zip(taken, v)) for v in itertools.product(*grid)]
+
+
+def describe(setting, stats):
+    desc = ", ".join(f"{k}={v}" for k, v in setting.items())
+    desc += f": WER {stats['wer']:.2f} %, RTF {stats['rtf']:.4f}"
+    if stats["peak_active"] is not None:
+        desc += f", peak active {stats['peak_active']}"
+    return desc + f", memory {stats['max_rss']:.1f} MB"
+
+
+def sweep(argv):
+    parser = argparse.ArgumentParser(description="decode-only sweep of the decoder settings over cached posteriors")
+    parser.add_argument('cache', type=str, help="posterior cache directory dumped by the test with --dump-posteriors")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--beam', default=[16.0], type=float, nargs='+', help="decoding beams to try")
+    parser.add_argument('--max-active', default=[8000], type=int, nargs='+', help="max active tokens to try")
+    parser.add_argument('--acoustic-scale', default=[1.0], type=float, nargs='+', help="acoustic scales to try")
+    parser.add_argument('--lm-weight', default=[0.8], type=float, nargs='+', help="LM weights to try for ctc_beam decoder")
+    parser.add_argument('--blank-skip', default=[None], type=float, nargs='+', help="blank skipping thresholds to try")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--count-active', default=False, action='store_true', help="report the peak active tokens of latgen decoder, slowing it down")
+    parser.add_argument('--workers', default=mp.cpu_count(), type=int, help="number of settings decoded in parallel")
+    parser.add_argument('--batch-size', default=8, type=int, help="number of simultaneous decoding")
+    parser.add_argument('--frame-shift', default=FRAME_SHIFT, type=float, help="time shift of an output frame in secs")
+    parser.add_argument('--log-dir', default='./logs_sweep', type=str, help="filename for logging the outputs")
+    args = parser.parse_args(argv)
+
+    init_logger(log_file="sweep.log", **vars(args))
+
+    settings = grid_settings(args, SWEEP_PARAMS, args.decoder_type)
+    decoder_kwargs = { "lm_file": args.lm_file }
+    cache = PosteriorCache(args.cache)
+    logger.info(f"{len(settings)} settings over {len(cache)} cached utterances")
+
+    results = decode_settings(args.cache, args.decoder_type, settings, batch_size=args.batch_size,
+                              frame_shift=args.frame_shift, decoder_kwargs=decoder_kwargs,
+                              workers=args.workers, count_active=args.count_active)
+    for setting, stats in results:
+        logger.info(describe(setting, stats))
+
+    setting, stats = min(results, key=lambda r: (r[1]["wer"], r[1]["rtf"]))
+    logger.info(f"best setting {describe(setting, stats)}")
+    return results
+
+
+if __name__ == "__main__":
+    sweep(sys.argv[1:])
@@ -0,0 +1,102 @@
+#!python
+import sys
+import json
+import argparse
+import multiprocessing as mp
+from pathlib import Path
+
+from asr.utils.logger import logger, init_logger
+
+from . import DECODER_TYPES, get_decoder
+from .benchmark import FRAME_SHIFT, synthesize, load_posteriors
+from .sweep import decode_settings, describe, grid_settings
+
+
+TUNE_PARAMS = [
+    "beam",
+    "max_active",
+    "min_active",
+    "acoustic_scale",
+]
+
+
+def pareto_front(results):
+    """ the (setting, stats) not dominated in both of WER and RTF, in the order of RTF """
+    front, best_wer = list(), float("inf")
+    for setting, stats in sorted(results, key=lambda r: (r[1]["rtf"], r[1]["wer"])):
+        if stats["wer"] < best_wer:
+            front.append((setting, stats))
+            best_wer = stats["wer"]
+    return front
+
+
+def save_config(file_path, setting, stats=None):
+    """ save the search options to be loaded by the decoders with decoder_config """
+    config = dict(setting)
+    if stats is not None:
+        config["stats"] = stats
+    Path(file_path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(file_path, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def tune(argv):
+    parser = argparse.ArgumentParser(description="decoder search options tuning under an RTF budget")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--posteriors', default=None, type=str, help="posterior cache or saved log-posteriors, instead of synthetic ones")
+    parser.add_argument('--num-utts', default=100, type=int, help="number of synthetic utterances")
+    parser.add_argument('--seed', default=None, type=int, help="seed for the synthetic posteriors")
+    parser.add_argument('--beam', default=[10.0, 13.0, 16.0], type=float, nargs='+', help="decoding beams to try")
+    parser.add_argument('--max-active', default=[2000, 4000, 8000], type=int, nargs='+', help="max active tokens to try")
+    parser.add_argument('--min-active', default=[200], type=int, nargs='+', help="min active tokens to try")
+    parser.add_argument('--acoustic-scale', default=[0.8, 1.0, 1.2], type=float, nargs='+', help="acoustic scales to try")
+    parser.add_argument('--count-active', default=False, action='store_true', help="report the peak active tokens of latgen decoder, the RTF being measured with the counting slowing it down")
+    parser.add_argument('--rtf-budget', default=None, type=float, help="max RTF allowed for the chosen setting")
+    parser.add_argument('--output', default="decoder.json", type=str, help="config file to save the chosen setting")
+    parser.add_argument('--workers', default=mp.cpu_count(), type=int, help="number of settings decoded in parallel")
+    parser.add_argument('--batch-size', default=8, type=int, help="number of simultaneous decoding")
+    parser.add_argument('--frame-shift', default=FRAME_SHIFT, type=float, help="time shift of an output frame in secs")
+    parser.add_argument('--log-dir', default='./logs_tune', type=str, help="filename for logging the outputs")
+    args = parser.parse_args(argv)
+
+    init_logger(log_file="tune.log", **vars(args))
+
+    if args.posteriors is not None and Path(args.posteriors).is_dir():
+        # the workers read the posterior cache by themselves
+        source = args.posteriors
+    else:
+        labeler = get_decoder(args.decoder_type).labeler
+        if args.posteriors is not None:
+            source = load_posteriors(labeler, args.posteriors)
+        else:
+            source = synthesize(labeler, num_utts=args.num_utts, seed=args.seed)
+
+    settings = grid_settings(args, TUNE_PARAMS, args.decoder_type)
+    logger.info(f"{len(settings)} settings to try")
+
+    results = decode_settings(source, args.decoder_type, settings, batch_size=args.batch_size,
+                              frame_shift=args.frame_shift, workers=args.workers, count_active=args.count_active)
+    for setting, stats in results:
+        logger.info(describe(setting, stats))
+
+    front = pareto_front(results)
+    logger.info("pareto front:")
+    for setting, stats in front:
+        logger.info(f"  {describe(setting, stats)}")
+
+    # the most accurate setting within the budget
+    candidates = front
+    if args.rtf_budget is not None:
+        candidates = [r for r in front if r[1]["rtf"] <= args.rtf_budget]
+        if not candidates:
+            logger.warning(f"no setting meets the RTF budget {args.rtf_budget}, choosing the fastest one")
+            candidates = front[:1]
+    setting, stats = min(candidates, key=lambda r: (r[1]["wer"], r[1]["rtf"]))
+    logger.info(f"chosen setting {describe(setting, stats)}")
+    save_config(args.output, setting, stats)
+    logger.info(f"saved to {args.output}, load it by --decoder-config {args.output}")
+    return setting
+
+
+if __name__ == "__main__":
+    tune(sys.argv[1:])
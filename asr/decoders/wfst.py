@@ -0,0 +1,327 @@
+#!python
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from asr.utils.kaldi_io import smart_open
+from asr.utils.logger import logger
+from asr.kaldi.labeler import Labeler, GRAPH_PATH, DEFAULT_CTC_LABEL, DEFAULT_WORDS, DEFAULT_LEXICON
+
+
+INF = np.inf
+DEFAULT_CTC_NPZ_GRAPH = GRAPH_PATH.joinpath("TLG.npz")
+
+
+def _expand(starts, ends):
+    """ flatten the arc ranges [starts, ends) into arc indices and their range positions """
+    counts = ends - starts
+    src = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.repeat(np.cumsum(counts) - counts - starts, counts)
+    return np.arange(counts.sum()) - offsets, src
+
+
+def _best_per_state(states, costs):
+    """ positions of the minimum cost entry for each distinct state """
+    order = np.lexsort((costs, states))
+    states = states[order]
+    first = np.ones(len(states), dtype=bool)
+    first[1:] = states[1:] != states[:-1]
+    return order[first]
+
+
+class WFSTGraph:
+    """ decoding graph in the tropical semiring, with the arcs in CSR arrays
+
+        the arcs leaving state s are arc_ptr[s]:arc_ptr[s+1], sorted by the input label,
+        so that the first num_eps[s] arcs of them are epsilon arcs
+    """
+
+    def __init__(self, start, final, src, ilabel, olabel, weight, nextstate):
+        self.start = int(start)
+        self.final = np.asarray(final, dtype=np.float32)
+        self.num_states = len(self.final)
+        order = np.lexsort((ilabel, src))
+        self.ilabel = np.asarray(ilabel, dtype=np.int32)[order]
+        self.olabel = np.asarray(olabel, dtype=np.int32)[order]
+        self.weight = np.asarray(weight, dtype=np.float32)[order]
+        self.nextstate = np.asarray(nextstate, dtype=np.int64)[order]
+        src = np.asarray(src, dtype=np.int64)[order]
+        self.arc_ptr = np.searchsorted(src, np.arange(self.num_states + 1)).astype(np.int64)
+        self.num_eps = np.bincount(src[self.ilabel == 0], minlength=self.num_states).astype(np.int64)
+
+    @classmethod
+    def read_text(cls, fst_file, isymbols=None, osymbols=None, acceptor=None):
+        """ read the output of `fstprint`, or the text of `fstcompile` with the symbol tables. the
+            arcs of an acceptor have a label and an optional weight, so its 4-field arcs can't be
+            told from the weightless ones of a transducer: the graph is taken as an acceptor if
+            acceptor is True, or if it is None and any arc has 3 fields. the output labels are
+            of the input symbol table if osymbols isn't given
+        """
+        def read_symbols(sym_file):
+            if sym_file is None:
+                return None
+            with open(sym_file, "r") as f:
+                return {s: int(i) for s, i in (line.strip().split() for line in f if line.strip())}
+
+        def label(syms, token):
+            return syms[token] if syms is not None else int(token)
+
+        isyms = read_symbols(isymbols)
+        osyms = read_symbols(osymbols) if osymbols is not None else isyms
+        start, finals, arcs = None, dict(), list()
+        with smart_open(fst_file, "rb") as f:
+            for line in f:
+                token = line.decode('utf-8').split()
+                if not token:
+                    continue
+                s = int(token[0])
+                if start is None:
+                    start = s
+                if len(token) <= 2:
+                    finals[s] = float(token[1]) if len(token) == 2 else 0.
+                else:
+                    arcs.append(token)
+        if acceptor is None:
+            acceptor = any(len(token) == 3 for token in arcs)
+
+        src, ilabel, olabel, weight, nextstate = list(), list(), list(), list(), list()
+        for token in arcs:
+            src.append(int(token[0]))
+            nextstate.append(int(token[1]))
+            ilabel.append(label(isyms, token[2]))
+            if acceptor:
+                olabel.append(label(osyms, token[2]))
+                weight.append(float(token[3]) if len(token) > 3 else 0.)
+            else:
+                olabel.append(label(osyms, token[3]))
+                weight.append(float(token[4]) if len(token) > 4 else 0.)
+
+        num_states = max([start] + src + nextstate + list(finals)) + 1
+        final = np.full(num_states, INF, dtype=np.float32)
+        for s, w in finals.items():
+            final[s] = w
+        return cls(start, final, src, ilabel, olabel, weight, nextstate)
+
+    @classmethod
+    def load(cls, fst_file, *args, **kwargs):
+        """ load the compact binary export if the file is .npz, otherwise read it as a text """
+        if Path(fst_file).suffix != ".npz":
+            return cls.read_text(fst_file, *args, **kwargs)
+        graph = cls.__new__(cls)
+        with np.load(fst_file) as data:
+            for k in data.files:
+                setattr(graph, k, data[k])
+        graph.start = int(graph.start)
+        graph.num_states = len(graph.final)
+        return graph
+
+    def save(self, fst_file):
+        np.savez(fst_file, start=self.start, final=self.final, ilabel=self.ilabel, olabel=self.olabel,
+                 weight=self.weight, nextstate=self.nextstate, arc_ptr=self.arc_ptr, num_eps=self.num_eps)
+
+    def num_arcs(self):
+        return len(self.ilabel)
+
+
+class TokenPassing:
+    """ beam-pruned Viterbi token passing over a WFSTGraph, following Kaldi's FasterDecoder
+
+        active tokens of a frame are kept in arrays of (state, cost, token id), and the
+        traceback is recorded as a table of (previous token id, arc) for all the tokens
+    """
+
+    def __init__(self, graph, beam=16.0, max_active=8000, min_active=200, acoustic_scale=1.0,
+                 allow_partial=True, beam_delta=0.5):
+        self.graph = graph
+        self.beam = beam
+        self.max_active = max_active
+        self.min_active = min_active
+        self.acoustic_scale = acoustic_scale
+        self.allow_partial = allow_partial
+        self.beam_delta = beam_delta
+        self.peak_active = 0
+        # per-state scratch buffers for the epsilon closure, kept at the clean state
+        self._cost = np.full(graph.num_states, INF)
+        self._tok = np.full(graph.num_states, -1, dtype=np.int64)
+
+    def _new_tokens(self, prevs, arcs):
+        ids = np.arange(self._num_toks, self._num_toks + len(prevs))
+        self._tok_prev.append(prevs)
+        self._tok_arc.append(arcs)
+        self._num_toks += len(prevs)
+        return ids
+
+    def _get_cutoff(self, costs):
+        """ return (cutoff, adaptive beam) with the max_active and min_active constraints """
+        best = costs.min()
+        beam_cutoff = best + self.beam
+        max_active_cutoff = INF
+        if len(costs) > self.max_active:
+            max_active_cutoff = np.partition(costs, self.max_active)[self.max_active]
+        if max_active_cutoff < beam_cutoff:
+            return max_active_cutoff, max_active_cutoff - best + self.beam_delta
+        min_active_cutoff = INF
+        if len(costs) > self.min_active:
+            min_active_cutoff = np.partition(costs, self.min_active)[self.min_active]
+        if min_active_cutoff > beam_cutoff:
+            return min_active_cutoff, min_active_cutoff - best + self.beam_delta
+        return beam_cutoff, self.beam
+
+    def _process_emitting(self, states, costs, toks, loglikes):
+        g = self.graph
+        cutoff, adaptive_beam = self._get_cutoff(costs)
+        keep = costs < cutoff
+        states, costs, toks = states[keep], costs[keep], toks[keep]
+
+        starts = g.arc_ptr[states] + g.num_eps[states]
+        arcs, src = _expand(starts, g.arc_ptr[states + 1])
+        if len(arcs) == 0:
+            return states[:0], costs[:0], toks[:0], INF
+        new_costs = costs[src] + g.weight[arcs] - self.acoustic_scale * loglikes[g.ilabel[arcs] - 1]
+        next_cutoff = new_costs.min() + adaptive_beam
+        keep = new_costs < next_cutoff
+        arcs, src, new_costs = arcs[keep], src[keep], new_costs[keep]
+
+        best = _best_per_state(g.nextstate[arcs], new_costs)
+        arcs, src = arcs[best], src[best]
+        new_toks = self._new_tokens(toks[src], arcs)
+        return g.nextstate[arcs], new_costs[best], new_toks, next_cutoff
+
+    def _process_nonemitting(self, states, costs, toks, cutoff):
+        g = self.graph
+        self._cost[states] = costs
+        self._tok[states] = toks
+        active = [states]
+        frontier = states
+        while len(frontier):
+            arcs, src = _expand(g.arc_ptr[frontier], g.arc_ptr[frontier] + g.num_eps[frontier])
+            if len(arcs) == 0:
+                break
+            prev = frontier[src]
+            new_costs = self._cost[prev] + g.weight[arcs]
+            nexts = g.nextstate[arcs]
+            keep = new_costs < np.minimum(cutoff, self._cost[nexts])
+            arcs, prev, new_costs, nexts = arcs[keep], prev[keep], new_costs[keep], nexts[keep]
+            best = _best_per_state(nexts, new_costs)
+            frontier = nexts[best]
+            self._cost[frontier] = new_costs[best]
+            self._tok[frontier] = self._new_tokens(self._tok[prev[best]], arcs[best])
+            active.append(frontier)
+
+        states = np.unique(np.concatenate(active))
+        costs, toks = self._cost[states], self._tok[states]
+        self._cost[states] = INF
+        self._tok[states] = -1
+        return states, costs, toks
+
+    def decode(self, loglikes):
+        """ loglikes is a TxH numpy array, returns (word ids, alignment) or None if failed """
+        g = self.graph
+        self._tok_prev, self._tok_arc, self._num_toks = list(), list(), 0
+
+        toks = self._new_tokens(np.array([-1]), np.array([-1]))
+        states, costs, toks = self._process_nonemitting(np.array([g.start]), np.zeros(1), toks, INF)
+        for t in range(loglikes.shape[0]):
+            states, costs, toks, cutoff = self._process_emitting(states, costs, toks, loglikes[t])
+            if len(states) == 0:
+                return None
+            states, costs, toks = self._process_nonemitting(states, costs, toks, cutoff)
+            self.peak_active = max(self.peak_active, len(states))
+
+        final_costs = costs + g.final[states]
+        if np.isfinite(final_costs).any():
+            best = int(np.argmin(final_costs))
+        elif self.allow_partial:
+            best = int(np.argmin(costs))
+        else:
+            return None
+        return self._traceback(int(toks[best]))
+
+    def _traceback(self, tok):
+        g = self.graph
+        tok_prev = np.concatenate(self._tok_prev)
+        tok_arc = np.concatenate(self._tok_arc)
+        words, alignment = list(), list()
+        while tok >= 0:
+            arc = tok_arc[tok]
+            if arc >= 0:
+                if g.olabel[arc] != 0:
+                    words.append(int(g.olabel[arc]))
+                if g.ilabel[arc] != 0:
+                    alignment.append(int(g.ilabel[arc]))
+            tok = tok_prev[tok]
+        return words[::-1], alignment[::-1]
+
+
+class WFSTDecoder:
+    """ decoder searching a TLG graph exported from OpenFst, without the Kaldi binding.
+        the outputs are the same with the LatGenDecoder's
+    """
+
+    def __init__(self, fst_file=str(DEFAULT_CTC_NPZ_GRAPH), label_file=str(DEFAULT_CTC_LABEL),
+                 wd_file=str(DEFAULT_WORDS), lexicon_file=str(DEFAULT_LEXICON), beam=16.0,
+                 max_active=8000, min_active=200, acoustic_scale=1.0, allow_partial=True,
+                 isymbols=None, osymbols=None, decoder_config=None):
+        # search options tuned by asr.decoders.tune override the arguments
+        if decoder_config is not None:
+            with open(decoder_config, "r") as f:
+                config = json.load(f)
+            beam = config.get("beam", beam)
+            max_active = config.get("max_active", max_active)
+            min_active = config.get("min_active", min_active)
+            acoustic_scale = config.get("acoustic_scale", acoustic_scale)
+
+        # labels info
+        self.labeler = Labeler(label_file, wd_file, lexicon_file)
+
+        logger.debug(f"loading decoding graph from {fst_file}")
+        graph = WFSTGraph.load(fst_file, isymbols=isymbols, osymbols=osymbols)
+        self.search = TokenPassing(graph, beam=beam, max_active=max_active, min_active=min_active,
+                                   acoustic_scale=acoustic_scale, allow_partial=allow_partial)
+
+    def __call__(self, loglikes, frame_lens):
+        return self.forward(loglikes, frame_lens)
+
+    def peak_active_tokens(self, reset=False):
+        """ peak number of active tokens in the search since the last reset """
+        peak = self.search.peak_active
+        if reset:
+            self.search.peak_active = 0
+        return peak
+
+    def forward(self, loglikes, frame_lens):
+        # loglikes should NxTxH (N: batch size, T: frames, H: classes)
+        assert loglikes.dim() == 3 and loglikes.size(2) == self.labeler.get_num_labels()
+        assert frame_lens.dim() == 1 and loglikes.size(0) == frame_lens.size(0)
+
+        loglikes = loglikes.detach().float().numpy()
+        results = [self.search.decode(l[:s]) for l, s in zip(loglikes, frame_lens.tolist())]
+        # failed utterances are left empty as in latgen
+        results = [r if r is not None else ([], []) for r in results]
+
+        w_sizes = torch.IntTensor([len(w) for w, _ in results])
+        a_sizes = torch.IntTensor([len(a) for _, a in results])
+        words = torch.IntTensor(len(results), max(w_sizes.tolist() + [0])).zero_()
+        alignments = torch.IntTensor(len(results), max(a_sizes.tolist() + [0])).zero_()
+        for i, (w, a) in enumerate(results):
+            words[i, :len(w)] = torch.IntTensor(w)
+            alignments[i, :len(a)] = torch.IntTensor(a)
+        return words, alignments, w_sizes, a_sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export an OpenFst text graph to the compact binary format")
+    parser.add_argument('--isymbols', default=None, type=str, help="input symbol table if the labels are symbols")
+    parser.add_argument('--osymbols', default=None, type=str, help="output symbol table if the labels are symbols")
+    parser.add_argument('--acceptor', default=None, action='store_true', help="the graph is an acceptor, which is guessed from its arcs if not given")
+    parser.add_argument('fst_file', type=str, help="text graph printed by fstprint")
+    parser.add_argument('npz_file', type=str, help="output .npz file")
+    args = parser.parse_args()
+
+    graph = WFSTGraph.read_text(args.fst_file, isymbols=args.isymbols, osymbols=args.osymbols,
+                                acceptor=args.acceptor)
+    graph.save(args.npz_file)
+    print(f"{graph.num_states} states, {graph.num_arcs()} arcs are saved to {args.npz_file}")
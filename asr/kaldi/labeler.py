@@ -0,0 +1,178 @@
+#!python
+import os
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from asr.utils.logger import logger
+
+
+GRAPH_PATH = Path(__file__).parent.joinpath("graph")
+
+DEFAULT_GRAPH = GRAPH_PATH.joinpath("CLG.fst")
+DEFAULT_LABEL = GRAPH_PATH.joinpath("phones.txt")
+DEFAULT_WORDS = GRAPH_PATH.joinpath("words.txt")
+DEFAULT_LEXICON = GRAPH_PATH.joinpath("align_lexicon.int")
+
+DEFAULT_CTC_GRAPH = GRAPH_PATH.joinpath("TLG.fst")
+DEFAULT_CTC_LABEL = GRAPH_PATH.joinpath("labels.txt")
+
+CACHE_DIR = ".labeler_cache"
+
+
+def _read_symbols(file_path):
+    """ read a Kaldi symbol table into a numpy string array indexed by the ids """
+    syms, ids = list(), list()
+    with open(file_path, "r") as f:
+        for line in f:
+            token = line.strip().split()
+            if not token:
+                continue
+            syms.append(token[0].strip())
+            ids.append(int(token[1].strip()))
+    ids = np.array(ids, dtype=np.int64)
+    table = np.full(ids.max() + 1 if len(ids) else 0, '', dtype=np.array(syms).dtype if syms else 'U1')
+    table[ids] = syms
+    return table
+
+
+class Labeler:
+    """ provides phone to pid, pid to phone, word to wid, wid to word
+
+        the tables are compiled once into an .npz cache next to the word file, keyed on the
+        modification times of the source files. i2w is a numpy string array indexed by the wids,
+        and w2i and wi2l are built on their first use
+    """
+
+    def __init__(self, label_file=str(DEFAULT_LABEL), word_file=str(DEFAULT_WORDS),
+                 lex_file=str(DEFAULT_LEXICON), use_cache=True):
+        self.label_file = label_file
+        self.word_file = word_file
+        self.lex_file = lex_file
+
+        self._w2i, self._wi2l = None, None
+        if not use_cache or not self.__load_cache():
+            self.__load_label_file()
+            self.__load_word_file()
+            self.__load_lex_file()
+            self.__make_maps()
+            if use_cache:
+                self.__save_cache()
+
+    def __sources(self):
+        return [str(Path(f).resolve()) for f in (self.label_file, self.word_file, self.lex_file)]
+
+    def __mtimes(self):
+        return np.array([os.stat(f).st_mtime_ns for f in self.__sources()], dtype=np.int64)
+
+    def __cache_path(self):
+        key = hashlib.sha1('|'.join(self.__sources()).encode('utf-8')).hexdigest()[:16]
+        return Path(self.word_file).resolve().parent.joinpath(CACHE_DIR, f"labeler_{key}.npz")
+
+    def __load_cache(self):
+        cache_path = self.__cache_path()
+        if not cache_path.exists():
+            return False
+        try:
+            with np.load(cache_path) as cache:
+                if not np.array_equal(cache["mtimes"], self.__mtimes()):
+                    return False
+                self.i2p = cache["i2p"]
+                self.i2w = cache["i2w"]
+                self.lex_wids = cache["lex_wids"]
+                self.lex_ptr = cache["lex_ptr"]
+                self.lex_pids = cache["lex_pids"]
+        except (OSError, KeyError, ValueError):
+            return False
+        self.__make_maps()
+        return True
+
+    def __save_cache(self):
+        cache_path = self.__cache_path()
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            cache_path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.savez(f, mtimes=self.__mtimes(), i2p=self.i2p, i2w=self.i2w,
+                         lex_wids=self.lex_wids, lex_ptr=self.lex_ptr, lex_pids=self.lex_pids)
+            tmp_path.replace(cache_path)
+        except OSError as e:
+            logger.debug(f"could not write the labeler cache {cache_path}: {e}")
+
+    def __make_maps(self):
+        self.p2i = {p: i for i, p in enumerate(self.i2p.tolist()) if p}
+        self.num_words = int((self.i2w != '').sum())
+
+    def __load_label_file(self):
+        self.i2p = _read_symbols(self.label_file)
+
+    def __load_word_file(self):
+        self.i2w = _read_symbols(self.word_file)
+
+    def __load_lex_file(self):
+        # lexicons in CSR of (wid, pronunciation), multiple pronunciations of a word are kept in order
+        wids, lens, pids = list(), list(), list()
+        with open(self.lex_file, "r") as f:
+            for line in f:
+                token = line.strip().split()
+                if not token:
+                    continue
+                wids.append(int(token[0].strip()))
+                lens.append(len(token) - 2)
+                pids.extend(int(i.strip()) for i in token[2:])
+        self.lex_wids = np.array(wids, dtype=np.int64)
+        self.lex_ptr = np.concatenate([[0], np.cumsum(lens, dtype=np.int64)])
+        self.lex_pids = np.array(pids, dtype=np.int64)
+
+    @property
+    def w2i(self):
+        if self._w2i is None:
+            self._w2i = {w: i for i, w in enumerate(self.i2w.tolist()) if w}
+        return self._w2i
+
+    @property
+    def wi2l(self):
+        if self._wi2l is None:
+            self._wi2l = dict()
+            pids = self.lex_pids.tolist()
+            for wi, s, e in zip(self.lex_wids.tolist(), self.lex_ptr[:-1].tolist(), self.lex_ptr[1:].tolist()):
+                self._wi2l.setdefault(wi, list()).append(pids[s:e])
+        return self._wi2l
+
+    def get_num_labels(self):
+        return len(self.p2i)
+
+    def get_num_words(self):
+        return self.num_words
+
+    def phone2idx(self, phone):
+        return self.p2i[phone]
+
+    def idx2phone(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.item()
+        return str(self.i2p[idx])
+
+    def idx2word(self, idx, unk='<unk>'):
+        if torch.is_tensor(idx):
+            idx = idx.item()
+        return str(self.i2w[idx]) if 0 <= idx < len(self.i2w) and self.i2w[idx] else unk
+
+    def idx2words(self, idx, unk='<unk>'):
+        """ vectorized idx2word for a tensor or an array of wids, returns a numpy string array """
+        if torch.is_tensor(idx):
+            idx = idx.cpu().numpy()
+        idx = np.asarray(idx, dtype=np.int64)
+        valid = (idx >= 0) & (idx < len(self.i2w))
+        words = self.i2w[np.where(valid, idx, 0)]
+        return np.where(valid & (words != ''), words, unk)
+
+    def word2idx(self, word, unk='<unk>'):
+        w2i = self.w2i
+        return w2i[word] if word in w2i else w2i[unk]
+
+    def word2lex(self, word):
+        """ return list of lexicons for a single word to support multiple definitions """
+        return self.wi2l[self.word2idx(word)]
@@ -1,4 +1,5 @@
 import sys
+import json
 from pathlib import Path
 
 import torch
@@ -8,94 +9,30 @@ from asr.utils.misc import get_num_lines
 
 from .._path import KALDI_ROOT
 from .._ext import latgen_lib
+from ..labeler import Labeler, GRAPH_PATH, DEFAULT_GRAPH, DEFAULT_LABEL, DEFAULT_WORDS, DEFAULT_LEXICON
+from ..labeler import DEFAULT_CTC_GRAPH, DEFAULT_CTC_LABEL
 
 
-GRAPH_PATH = Path(__file__).parents[1].joinpath("graph")
 if not GRAPH_PATH.exists():
     print("ERROR: no graph path found. please run build.py first")
     sys.exit(1)
 
-DEFAULT_GRAPH = GRAPH_PATH.joinpath("CLG.fst")
-DEFAULT_LABEL = GRAPH_PATH.joinpath("phones.txt")
-DEFAULT_WORDS = GRAPH_PATH.joinpath("words.txt")
-DEFAULT_LEXICON = GRAPH_PATH.joinpath("align_lexicon.int")
-
-
-class Labeler:
-    """ provides phone to pid, pid to phone, word to wid, wid to word """
-
-    def __init__(self, label_file=str(DEFAULT_LABEL), word_file=str(DEFAULT_WORDS),
-                 lex_file=str(DEFAULT_LEXICON)):
-        self.label_file = label_file
-        self.word_file = word_file
-        self.lex_file = lex_file
-
-        self.__load_label_file()
-        self.__load_word_file()
-        self.__load_lex_file()
-
-    def __load_label_file(self):
-        self.p2i, self.i2p = dict(), dict()
-        with open(self.label_file, "r") as f:
-            for line in f:
-                p, i = line.strip().split()
-                p, i = p.strip(), int(i.strip())
-                self.p2i[p] = i
-                self.i2p[i] = p
-
-    def __load_word_file(self):
-        self.w2i, self.i2w = dict(), dict()
-        with open(self.word_file, "r") as f:
-            for line in f:
-                w, i = line.strip().split()
-                w, i = w.strip(), int(i.strip())
-                self.w2i[w] = i
-                self.i2w[i] = w
-
-    def __load_lex_file(self):
-        self.wi2l = dict()
-        with open(self.lex_file, "r") as f:
-            for line in f:
-                token = line.strip().split()
-                wi, l = int(token[0].strip()), [int(i.strip()) for i in token[2:]]
-                if wi in self.wi2l:
-                    self.wi2l[wi].append(l)
-                else:
-                    self.wi2l[wi] = [l]
-
-    def get_num_labels(self):
-        return len(self.p2i)
-
-    def get_num_words(self):
-        return len(self.w2i)
-
-    def phone2idx(self, phone):
-        return self.p2i[phone]
-
-    def idx2phone(self, idx):
-        if torch.is_tensor(idx):
-            idx = idx.item()
-        return self.i2p[idx]
-
-    def idx2word(self, idx, unk='<unk>'):
-        if torch.is_tensor(idx):
-            idx = idx.item()
-        return self.i2w[idx] if idx in self.i2w else unk
-
-    def word2idx(self, word, unk='<unk>'):
-        return self.w2i[word] if word in self.w2i else self.w2i[unk]
-
-    def word2lex(self, word):
-        """ return list of lexicons for a single word to support multiple definitions """
-        return self.wi2l[self.word2idx(word)]
-
 
 class LatGenDecoder(Function):
     """ decoder using position-dependent phones as the acoustic model labels """
 
     def __init__(self, beam=16.0, max_active=8000, min_active=200, acoustic_scale=1.0, allow_partial=True,
-                 fst_file=str(DEFAULT_GRAPH), label_file=str(DEFAULT_LABEL),
-                 lexicon_file=str(DEFAULT_LEXICON), wd_file=str(DEFAULT_WORDS)):
+                 lattice_beam=8.0, fst_file=str(DEFAULT_GRAPH), label_file=str(DEFAULT_LABEL),
+                 lexicon_file=str(DEFAULT_LEXICON), wd_file=str(DEFAULT_WORDS), decoder_config=None):
+        # search options tuned by asr.decoders.tune override the arguments
+        if decoder_config is not None:
+            with open(decoder_config, "r") as f:
+                config = json.load(f)
+            beam = config.get("beam", beam)
+            max_active = config.get("max_active", max_active)
+            min_active = config.get("min_active", min_active)
+            acoustic_scale = config.get("acoustic_scale", acoustic_scale)
+
         # labels info
         self.labeler = Labeler(label_file, wd_file, lexicon_file)
 
@@ -104,6 +41,8 @@ class LatGenDecoder(Function):
         wd_in_filename = wd_file.encode('ascii')
         latgen_lib.initialize(beam, max_active, min_active, acoustic_scale,
                               allow_partial, fst_in_filename, wd_in_filename)
+        latgen_lib.set_lattice_options(lattice_beam, 25)
+        self.count_active_tokens(False)
 
     def forward(self, loglikes, frame_lens):
         # loglikes should NxTxH (N: batch size, T: frames, H: classes)
@@ -120,17 +59,59 @@ class LatGenDecoder(Function):
 
         return words, alignments, w_sizes, a_sizes
 
+    def count_active_tokens(self, count=True):
+        """ count the active tokens of the search for peak_active_tokens, which slows it down """
+        self.counting = count
+        latgen_lib.set_count_active(int(count))
+
+    def peak_active_tokens(self, reset=False):
+        """ peak number of active tokens in the search since the last reset, None if not counted """
+        if not self.counting:
+            return None
+        return latgen_lib.get_peak_active(int(reset))
+
+    def nbest(self, loglikes, frame_lens, n=10):
+        """ n-best paths from the lattices, as NxKxW words, NxKxA alignments, NxKx2 (graph, acoustic)
+            costs, and NxK sizes of words and alignments. missing paths have zero sizes and inf costs
+        """
+        assert loglikes.dim() == 3 and loglikes.size(2) == self.labeler.get_num_labels()
+        assert frame_lens.dim() == 1 and loglikes.size(0) == frame_lens.size(0)
+
+        with torch.no_grad():
+            words = torch.IntTensor().zero_()
+            alignments = torch.IntTensor().zero_()
+            scores = torch.FloatTensor().zero_()
+            w_sizes = torch.IntTensor().zero_()
+            a_sizes = torch.IntTensor().zero_()
+            latgen_lib.decode_nbest(loglikes, frame_lens, n, words, alignments, scores, w_sizes, a_sizes)
+
+        return words, alignments, scores, w_sizes, a_sizes
+
+    def lattice(self, loglikes, frame_lens):
+        """ word lattices as NxMx3 arcs of (src, dst, word) with NxMx2 (graph, acoustic) costs and N sizes,
+            the states are topologically sorted from the start state 0, and the final weights are given
+            as the arcs to the state -1. the alignments of the best paths are returned as well
+        """
+        assert loglikes.dim() == 3 and loglikes.size(2) == self.labeler.get_num_labels()
+        assert frame_lens.dim() == 1 and loglikes.size(0) == frame_lens.size(0)
+
+        with torch.no_grad():
+            arcs = torch.IntTensor().zero_()
+            weights = torch.FloatTensor().zero_()
+            l_sizes = torch.IntTensor().zero_()
+            alignments = torch.IntTensor().zero_()
+            a_sizes = torch.IntTensor().zero_()
+            latgen_lib.decode_lattice(loglikes, frame_lens, arcs, weights, l_sizes, alignments, a_sizes)
+
+        return arcs, weights, l_sizes, alignments, a_sizes
+
     def backward(self, grad_output):
         pass
 
 
-DEFAULT_CTC_GRAPH = GRAPH_PATH.joinpath("TLG.fst")
-DEFAULT_CTC_LABEL = GRAPH_PATH.joinpath("labels.txt")
-
 class LatGenCTCDecoder(LatGenDecoder):
     """ decoder using CTC labels with blank label in the acoustic model """
 
-    def __init__(self, label_file=str(DEFAULT_CTC_LABEL), fst_file=str(DEFAULT_CTC_GRAPH),
-                 *args, **kwargs):
-        super().__init__(label_file=label_file, fst_file=fst_file, *args, **kwargs)
+    def __init__(self, label_file=str(DEFAULT_CTC_LABEL), fst_file=str(DEFAULT_CTC_GRAPH), **kwargs):
+        super().__init__(label_file=label_file, fst_file=fst_file, **kwargs)
 
@@ -21,6 +21,7 @@
 // modified by Jinserk Baik <jinserk.baik@gmail.com>
 
 #include <sstream>
+#include <limits>
 
 #include <TH/TH.h>
 #include <ATen/ATen.h>
@@ -29,9 +30,11 @@
 #include "util/common-utils.h"
 #include "fstext/fstext-lib.h"
 #include "decoder/faster-decoder.h"
+#include "decoder/lattice-faster-decoder.h"
 #include "decoder/decodable-matrix.h"
 #include "base/timer.h"
 #include "lat/kaldi-lattice.h" // for {Compact}LatticeArc
+#include "lat/lattice-functions.h"
 
 using namespace kaldi;
 using namespace at;
@@ -44,6 +47,7 @@ using fst::StdArc;
 struct LatticeDecoderOptions
 {
 	FasterDecoderOptions decoder_opts_;
+	LatticeFasterDecoderConfig lattice_opts_;
 
 	BaseFloat acoustic_scale_;
 	bool allow_partial_;
@@ -72,6 +76,22 @@ struct LatticeDecoderOptions
 		decoder_opts_.hash_ratio = hash_ratio;
 	}
 
+	void update_lattice_options(BaseFloat lattice_beam, int32 prune_interval = 25)
+	{
+		lattice_opts_.lattice_beam = lattice_beam;
+		lattice_opts_.prune_interval = prune_interval;
+		lattice_opts_.determinize_lattice = true;
+	}
+
+	LatticeFasterDecoderConfig &get_lattice_options()
+	{
+		// share the search options with the 1-best decoder
+		lattice_opts_.beam = decoder_opts_.beam;
+		lattice_opts_.max_active = decoder_opts_.max_active;
+		lattice_opts_.min_active = decoder_opts_.min_active;
+		return lattice_opts_;
+	}
+
 	void load_files(std::string fst_in_filename, std::string words_in_filename)
 	{
 		if (decode_fst_) delete decode_fst_;
@@ -90,6 +110,37 @@ struct LatticeDecoderOptions
 // global instance
 LatticeDecoderOptions latgen_opts;
 
+// peak number of active tokens over the frames decoded, counted only if enabled
+// since the counting steps the decoding frame by frame and walks the tokens
+bool latgen_count_active = false;
+int32 latgen_peak_active = 0;
+
+class CountingFasterDecoder : public FasterDecoder
+{
+	public:
+		CountingFasterDecoder(const fst::Fst<fst::StdArc> &fst, const FasterDecoderOptions &opts)
+		: FasterDecoder(fst, opts)
+		{}
+
+		int32 NumActive() const
+		{
+			int32 n = 0;
+			for (const Elem *e = toks_.GetList(); e != NULL; e = e->tail)
+				n++;
+			return n;
+		}
+
+		void DecodeCounting(DecodableInterface *decodable, int32 num_frames)
+		{
+			InitDecoding();
+			while (NumFramesDecoded() < num_frames) {
+				AdvanceDecoding(decodable, 1);
+				latgen_peak_active = std::max(latgen_peak_active, NumActive());
+			}
+		}
+
+}; // class CountingFasterDecoder
+
 struct LatticeDecoderResult
 {
 	std::vector<int32> alignments_;
@@ -103,7 +154,7 @@ class LatticeDecoder
 {
 	private:
 		LatticeDecoderOptions &opts_;
-		FasterDecoder decoder_;
+		CountingFasterDecoder decoder_;
 
 	public:
 		LatticeDecoder(LatticeDecoderOptions &opts)
@@ -127,7 +178,10 @@ class LatticeDecoder
 				}
 
 				DecodableMatrixScaled decodable(loglikes, opts_.acoustic_scale_);
-				decoder_.Decode(&decodable);
+				if (latgen_count_active)
+					decoder_.DecodeCounting(&decodable, loglikes.NumRows());
+				else
+					decoder_.Decode(&decodable);
 
 				VectorFst<LatticeArc> decoded;  // linear FST.
 
@@ -153,6 +207,89 @@ class LatticeDecoder
 }; // class LatticeDecoder
 
 
+struct LatticeGeneratorResult
+{
+	CompactLattice lattice_;
+	std::vector<int32> alignments_;  // of the best path
+	bool failed_ = false;
+	bool partial_ = false;
+};
+
+class LatticeGenerator
+{
+	private:
+		LatticeDecoderOptions &opts_;
+		LatticeFasterDecoder decoder_;
+
+	public:
+		LatticeGenerator(LatticeDecoderOptions &opts)
+		: opts_(opts),
+		  decoder_(*opts_.decode_fst_, opts_.get_lattice_options())
+		{}
+
+		int decode(std::vector<Matrix<BaseFloat> > &loglikes_list,
+				   std::vector<LatticeGeneratorResult> &result)
+		{
+			int num_fail = 0;
+
+			for (auto &loglikes : loglikes_list) {
+				result.emplace_back(LatticeGeneratorResult());
+				LatticeGeneratorResult &res = result.back();
+
+				if (loglikes.NumRows() == 0) {
+					num_fail++;
+					res.failed_ = true;
+					continue;
+				}
+
+				DecodableMatrixScaled decodable(loglikes, opts_.acoustic_scale_);
+				decoder_.Decode(&decodable);
+
+				if ((opts_.allow_partial_ || decoder_.ReachedFinal())
+					&& decoder_.GetLattice(&res.lattice_) && res.lattice_.NumStates() > 0) {
+					res.partial_ = !decoder_.ReachedFinal();
+					// report the acoustic costs without the acoustic scale
+					if (opts_.acoustic_scale_ != 0.0)
+						fst::ScaleLattice(fst::AcousticLatticeScale(1.0 / opts_.acoustic_scale_), &res.lattice_);
+					TopSortCompactLatticeIfNeeded(&res.lattice_);
+
+					CompactLattice best_path;
+					std::vector<int32> words;
+					LatticeWeight weight;
+					CompactLatticeShortestPath(res.lattice_, &best_path);
+					Lattice best_lat;
+					ConvertLattice(best_path, &best_lat);
+					GetLinearSymbolSequence(best_lat, &res.alignments_, &words, &weight);
+				} else {
+					num_fail++;
+					res.failed_ = true;
+				}
+			}
+
+			return num_fail;
+		}
+
+}; // class LatticeGenerator
+
+
+static void to_loglikes_list(THFloatTensor *loglikes, THIntTensor *frame_lens,
+							 std::vector<Matrix<BaseFloat> > &loglikes_list)
+{
+	// convert at::Tensor to list of kaldi::SubMatrix
+	int num_batch = THFloatTensor_size(loglikes, 0);
+	int num_frame = THFloatTensor_size(loglikes, 1);
+	int num_class = THFloatTensor_size(loglikes, 2);
+
+	float *l_data = THFloatTensor_data(loglikes);
+	int *l_lens = THIntTensor_data(frame_lens);
+
+	for (int i = 0; i < num_batch; i++) {
+		int s = i * num_frame * num_class;
+		loglikes_list.emplace_back(SubMatrix<BaseFloat>(l_data + s, l_lens[i], num_class, num_class));
+	}
+}
+
+
 #ifdef __cplusplus
 extern "C"
 {
@@ -180,18 +317,7 @@ int decode(THFloatTensor *loglikes, THIntTensor *frame_lens,
 	std::vector<Matrix<BaseFloat> > loglikes_list;
 	std::vector<LatticeDecoderResult> results;
 
-	// convert at::Tensor to list of kaldi::SubMatrix
-	int num_batch = THFloatTensor_size(loglikes, 0);
-	int num_frame = THFloatTensor_size(loglikes, 1);
-	int num_class = THFloatTensor_size(loglikes, 2);
-
-	float *l_data = THFloatTensor_data(loglikes);
-	int *l_lens = THIntTensor_data(frame_lens);
-
-	for (int i = 0; i < num_batch; i++) {
-		int s = i * num_frame * num_class;
-		loglikes_list.emplace_back(SubMatrix<BaseFloat>(l_data + s, l_lens[i], num_class, num_class));
-	}
+	to_loglikes_list(loglikes, frame_lens, loglikes_list);
 
 	// decode
 	decoder.decode(loglikes_list, results);
@@ -228,6 +354,173 @@ int decode(THFloatTensor *loglikes, THIntTensor *frame_lens,
 	return 1;
 }
 
+int set_count_active(int count)
+{
+	latgen_count_active = (count != 0);
+	latgen_peak_active = 0;
+	return 1;
+}
+
+int get_peak_active(int reset)
+{
+	int peak = latgen_peak_active;
+	if (reset)
+		latgen_peak_active = 0;
+	return peak;
+}
+
+int set_lattice_options(float lattice_beam, int prune_interval)
+{
+	latgen_opts.update_lattice_options(lattice_beam, prune_interval);
+	return 1;
+}
+
+int decode_nbest(THFloatTensor *loglikes, THIntTensor *frame_lens, int nbest,
+                 THIntTensor *words, THIntTensor *alignments, THFloatTensor *scores,
+                 THIntTensor *w_sizes, THIntTensor *a_sizes)
+{
+	LatticeGenerator generator(latgen_opts);
+
+	std::vector<Matrix<BaseFloat> > loglikes_list;
+	std::vector<LatticeGeneratorResult> results;
+
+	to_loglikes_list(loglikes, frame_lens, loglikes_list);
+	generator.decode(loglikes_list, results);
+
+	// n-best paths of each lattice as linear lattices
+	std::vector<std::vector<Lattice> > nbest_list(results.size());
+	int max_words = 0, max_alignments = 0;
+	for (int i = 0; i < results.size(); i++) {
+		if (results[i].failed_) continue;
+		Lattice lat, nbest_lat;
+		ConvertLattice(results[i].lattice_, &lat);
+		fst::ShortestPath(lat, &nbest_lat, nbest);
+		fst::ConvertNbestToVector(nbest_lat, &nbest_list[i]);
+	}
+
+	std::vector<std::vector<std::vector<int32> > > ws(results.size()), as(results.size());
+	std::vector<std::vector<LatticeWeight> > ss(results.size());
+	for (int i = 0; i < results.size(); i++) {
+		for (auto &path : nbest_list[i]) {
+			std::vector<int32> w, a;
+			LatticeWeight weight;
+			GetLinearSymbolSequence(path, &a, &w, &weight);
+			if (max_words < w.size())
+				max_words = w.size();
+			if (max_alignments < a.size())
+				max_alignments = a.size();
+			ws[i].push_back(w);
+			as[i].push_back(a);
+			ss[i].push_back(weight);
+		}
+	}
+
+	THIntTensor_resize3d(words, results.size(), nbest, max_words);
+	THIntTensor_resize3d(alignments, results.size(), nbest, max_alignments);
+	THFloatTensor_resize3d(scores, results.size(), nbest, 2);
+	THIntTensor_resize2d(w_sizes, results.size(), nbest);
+	THIntTensor_resize2d(a_sizes, results.size(), nbest);
+
+	THIntTensor_zero(words);
+	THIntTensor_zero(alignments);
+	THFloatTensor_fill(scores, std::numeric_limits<float>::infinity());
+	THIntTensor_zero(w_sizes);
+	THIntTensor_zero(a_sizes);
+
+	for (int i = 0; i < results.size(); i++) {
+		for (int k = 0; k < ws[i].size(); k++) {
+			int j = 0;
+			THIntTensor_set2d(w_sizes, i, k, ws[i][k].size());
+			for (auto w : ws[i][k])
+				THIntTensor_set3d(words, i, k, j++, w);
+			j = 0;
+			THIntTensor_set2d(a_sizes, i, k, as[i][k].size());
+			for (auto a : as[i][k])
+				THIntTensor_set3d(alignments, i, k, j++, a);
+			THFloatTensor_set3d(scores, i, k, 0, ss[i][k].Value1());  // graph cost
+			THFloatTensor_set3d(scores, i, k, 1, ss[i][k].Value2());  // acoustic cost
+		}
+	}
+
+	return 1;
+}
+
+int decode_lattice(THFloatTensor *loglikes, THIntTensor *frame_lens,
+                   THIntTensor *arcs, THFloatTensor *weights, THIntTensor *l_sizes,
+                   THIntTensor *alignments, THIntTensor *a_sizes)
+{
+	LatticeGenerator generator(latgen_opts);
+
+	std::vector<Matrix<BaseFloat> > loglikes_list;
+	std::vector<LatticeGeneratorResult> results;
+
+	to_loglikes_list(loglikes, frame_lens, loglikes_list);
+	generator.decode(loglikes_list, results);
+
+	// word lattice as the list of arcs (src, dst, word) and their (graph, acoustic) costs,
+	// with the final weights as the arcs to the state -1
+	int max_arcs = 0, max_alignments = 0;
+	std::vector<int> num_arcs(results.size(), 0);
+	for (int i = 0; i < results.size(); i++) {
+		if (results[i].failed_) continue;
+		CompactLattice &lat = results[i].lattice_;
+		for (int s = 0; s < lat.NumStates(); s++) {
+			num_arcs[i] += lat.NumArcs(s);
+			if (lat.Final(s) != CompactLatticeWeight::Zero())
+				num_arcs[i]++;
+		}
+		if (max_arcs < num_arcs[i])
+			max_arcs = num_arcs[i];
+		if (max_alignments < results[i].alignments_.size())
+			max_alignments = results[i].alignments_.size();
+	}
+
+	THIntTensor_resize3d(arcs, results.size(), max_arcs, 3);
+	THFloatTensor_resize3d(weights, results.size(), max_arcs, 2);
+	THIntTensor_resize1d(l_sizes, results.size());
+	THIntTensor_resize2d(alignments, results.size(), max_alignments);
+	THIntTensor_resize1d(a_sizes, results.size());
+
+	THIntTensor_zero(arcs);
+	THFloatTensor_zero(weights);
+	THIntTensor_zero(l_sizes);
+	THIntTensor_zero(alignments);
+	THIntTensor_zero(a_sizes);
+
+	for (int i = 0; i < results.size(); i++) {
+		if (results[i].failed_) continue;
+		CompactLattice &lat = results[i].lattice_;
+		int j = 0;
+		for (int s = 0; s < lat.NumStates(); s++) {
+			for (fst::ArcIterator<CompactLattice> aiter(lat, s); !aiter.Done(); aiter.Next()) {
+				const CompactLatticeArc &arc = aiter.Value();
+				THIntTensor_set3d(arcs, i, j, 0, s);
+				THIntTensor_set3d(arcs, i, j, 1, arc.nextstate);
+				THIntTensor_set3d(arcs, i, j, 2, arc.olabel);
+				THFloatTensor_set3d(weights, i, j, 0, arc.weight.Weight().Value1());
+				THFloatTensor_set3d(weights, i, j, 1, arc.weight.Weight().Value2());
+				j++;
+			}
+			CompactLatticeWeight final_weight = lat.Final(s);
+			if (final_weight != CompactLatticeWeight::Zero()) {
+				THIntTensor_set3d(arcs, i, j, 0, s);
+				THIntTensor_set3d(arcs, i, j, 1, -1);
+				THIntTensor_set3d(arcs, i, j, 2, 0);
+				THFloatTensor_set3d(weights, i, j, 0, final_weight.Weight().Value1());
+				THFloatTensor_set3d(weights, i, j, 1, final_weight.Weight().Value2());
+				j++;
+			}
+		}
+		THIntTensor_set1d(l_sizes, i, j);
+		j = 0;
+		THIntTensor_set1d(a_sizes, i, results[i].alignments_.size());
+		for (auto a : results[i].alignments_)
+			THIntTensor_set2d(alignments, i, j++, a);
+	}
+
+	return 1;
+}
+
 #ifdef __cplusplus
 }
 #endif
@@ -4,3 +4,12 @@ int initialize(float beam, int max_active, int min_active,
 int decode(THFloatTensor *loglikes, THIntTensor *frame_lens,
            THIntTensor *words, THIntTensor *alignments,
            THIntTensor *w_sizes, THIntTensor *a_sizes);
+int set_count_active(int count);
+int get_peak_active(int reset);
+int set_lattice_options(float lattice_beam, int prune_interval);
+int decode_nbest(THFloatTensor *loglikes, THIntTensor *frame_lens, int nbest,
+                 THIntTensor *words, THIntTensor *alignments, THFloatTensor *scores,
+                 THIntTensor *w_sizes, THIntTensor *a_sizes);
+int decode_lattice(THFloatTensor *loglikes, THIntTensor *frame_lens,
+                   THIntTensor *arcs, THFloatTensor *weights, THIntTensor *l_sizes,
+                   THIntTensor *alignments, THIntTensor *a_sizes);
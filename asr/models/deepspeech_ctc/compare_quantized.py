@@ -0,0 +1,95 @@
+#!python
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from asr.utils.dataset import NonSplitTrainDataset, AudioSubset
+from asr.utils.dataloader import NonSplitTrainDataLoader
+from asr.utils.logger import logger, init_logger
+from asr.utils.edit_distance import edit_distance
+from asr.utils.quantize import QUANTIZE_MODES, quantize_model
+from asr.utils import params as p
+from asr.decoders import DECODER_TYPES
+
+from ..predictor import NonSplitPredictor
+from .network import DeepSpeech, LSTM
+
+
+# an output frame covers 3 spectrogram frames folded by FrameSplitter
+FRAME_SHIFT = p.WINDOW_SHIFT * 3
+
+
+def compare_quantized(argv):
+    parser = argparse.ArgumentParser(description="WER and RTF of the DeepSpeech quantized to int8 against float32 on cpu")
+    parser.add_argument('--dev-manifest', type=str, help="manifest of the utterances to compare on")
+    parser.add_argument('--num-utts', default=0, type=int, help="number of utterances randomly picked from the manifest, all if 0")
+    parser.add_argument('--max-len', default=20., type=float, help="max length of utterance to use in secs")
+    parser.add_argument('--batch-size', default=1, type=int, help="number of utterances in a batch")
+    parser.add_argument('--log-dir', default='./logs_deepspeech_ctc', type=str, help="filename for logging the outputs")
+    parser.add_argument('--continue-from', type=str, help="float32 model file path to quantize")
+    parser.add_argument('--unidirectional', default=False, action='store_true', help="the model is unidirectional with the lookahead")
+    parser.add_argument('--layer-norm-lstm', default=False, action='store_true', help="the model uses the layer-norm LSTM")
+    parser.add_argument('--quantize', default=QUANTIZE_MODES, type=str, nargs='+', help=f"quantize modes to compare in {QUANTIZE_MODES}")
+    parser.add_argument('--calibration-manifest', default=None, type=str, help="manifest to calibrate the static quantization on, the dev manifest if not given")
+    parser.add_argument('--calibration-size', default=100, type=int, help="number of utterances of the calibration manifest to use")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--decode-workers', default=None, type=int, help="number of processes for ctc_beam decoder, none by default")
+    parser.add_argument('--decoder-config', default=None, type=str, help="decoder search options file saved by asr.decoders.tune")
+    args = parser.parse_args(argv)
+
+    init_logger(log_file="compare_quantized.log", **vars(args))
+
+    if args.continue_from is None or args.dev_manifest is None:
+        logger.error("add '--continue-from <model-name>' and '--dev-manifest <manifest>' in options")
+        sys.exit(1)
+
+    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS, bidirectional=(not args.unidirectional),
+                       rnn_type=(LSTM if args.layer_norm_lstm else nn.LSTM))
+    predictor = NonSplitPredictor(model, continue_from=args.continue_from, decoder_type=args.decoder_type,
+                                  lm_file=args.lm_file, decode_workers=args.decode_workers,
+                                  decoder_config=args.decoder_config)
+    decoder = predictor.decoder
+    models = { "float32": predictor.model }
+    for mode in args.quantize:
+        calibration = None
+        if mode == "static":
+            calibration = predictor.calibration_batches(args.calibration_manifest or args.dev_manifest,
+                                                        args.calibration_size)
+        models[f"int8 {mode}"] = quantize_model(predictor.model, mode, calibration)
+
+    dataset = NonSplitTrainDataset(labeler=decoder.labeler, manifest_file=args.dev_manifest,
+                                   tempo=False, pitch=False, noise_range=(-20, -20), offset=False, padding=False)
+    dataset = AudioSubset(dataset, data_size=args.num_utts, max_len=args.max_len)
+    data_loader = NonSplitTrainDataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+
+    # every model on the same features, since the dither of the dataset is random
+    w2i = decoder.labeler.word2idx
+    stats = { name: { "N": 0, "am": 0., "decode": 0. } for name in models }
+    D, duration = 0, 0.
+    with torch.no_grad():
+        for xs, ys, frame_lens, ys_lens, filenames, texts in data_loader:
+            refs = [[w2i(w.strip()) for w in t.strip().split()] for t in texts]
+            D += sum(len(r) for r in refs)
+            duration += frame_lens.sum().item() * FRAME_SHIFT
+            for name, m in models.items():
+                start = time.perf_counter()
+                loglikes = torch.log(m(xs))
+                mid = time.perf_counter()
+                words, alignment, w_sizes, a_sizes = decoder(loglikes, frame_lens)
+                stats[name]["am"] += mid - start
+                stats[name]["decode"] += time.perf_counter() - mid
+                hyps = [w[:s].tolist() for w, s in zip(words, w_sizes)]
+                stats[name]["N"] += int(edit_distance(refs, hyps).sum())
+
+    logger.info(f"{len(dataset)} utterances, {duration:.1f} secs on cpu, {torch.get_num_threads()} threads")
+    for name, s in stats.items():
+        logger.info(f"{name:>12s}: WER {s['N'] * 100. / D:.2f} %, RTF of the model {s['am'] / duration:.4f}, "
+                    f"RTF with the decoding {(s['am'] + s['decode']) / duration:.4f}")
+
+
+if __name__ == "__main__":
+    compare_quantized(sys.argv[1:])
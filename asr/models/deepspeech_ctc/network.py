@@ -1,16 +1,20 @@
 #!python
+import sys
 import math
 from collections import OrderedDict
+from typing import List, Optional
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 #from torch.nn._functions.thnn import rnnFusedPointwise as fusedBackend
 from torch.autograd import Variable
 
 from asr.utils import params as p
 from asr.utils.misc import Swish, InferenceBatchSoftmax
+from asr.utils.recompute import recompute as recompute_forward
 
 
 class SequenceWise(nn.Module):
@@ -19,12 +23,15 @@ class SequenceWise(nn.Module):
         """
         Collapses input of dim T*N*H to (T*N)*H, and applies to a module.
         Allows handling of variable sequence lengths and minibatch sizes.
+        A PackedSequence is applied on its valid frames only.
         :param module: Module to apply input to.
         """
         super().__init__()
         self.module = module
 
     def forward(self, x):
+        if isinstance(x, PackedSequence):
+            return x._replace(data=self.module(x.data))
         t, n = x.size(0), x.size(1)
         x = x.view(t * n, -1)
         x = self.module(x)
@@ -130,7 +137,58 @@ class LSTMCell(nn.Module):
         return s.format(name=self.__class__.__name__, **self.__dict__)
 '''
 
+@torch.jit.script
+def _layer_norm_lstm_loop(igates, hx, cx, mask: Optional[torch.Tensor], weight_hh, bias_hh: Optional[torch.Tensor],
+                          ln_hh_weight, ln_hh_bias, ln_ho_weight, ln_ho_bias, eps: float):
+    """ the time loop of a layer-norm LSTM over the TxNx4H input gates already normalized.
+        the states hold over the frames out of the TxNx1 bool mask, whose outputs are zero.
+        without grad the outputs are written to a preallocated buffer, otherwise they are
+        stacked at once, since the backward of the writes to a buffer copies its whole grad
+        at every step
+    """
+    hidden_size = hx.size(1)
+    preallocated = not torch.is_grad_enabled()
+    ys = torch.empty(igates.size(0), hx.size(0), hidden_size, dtype=igates.dtype, device=igates.device) \
+        if preallocated else torch.empty(0)
+    outputs: List[torch.Tensor] = []
+    # unbound at once, since the backward of indexing a step allocates the grad of the whole igates
+    igates_t = igates.unbind(0)
+    for t in range(len(igates_t)):
+        hgates = F.layer_norm(F.linear(hx, weight_hh, bias_hh), [4 * hidden_size], ln_hh_weight, ln_hh_bias, eps)
+        gates = igates_t[t] + hgates
+        ifo = gates[:, :(3 * hidden_size)].sigmoid()
+        g = gates[:, (3 * hidden_size):].tanh()
+        i, f, o = ifo[:, :hidden_size], ifo[:, hidden_size:(2 * hidden_size)], ifo[:, (2 * hidden_size):]
+        cy = f * cx + i * g
+        hy = o * F.layer_norm(cy, [hidden_size], ln_ho_weight, ln_ho_bias, eps).tanh()
+        if mask is not None:
+            m = mask[t]
+            cx = torch.where(m, cy, cx)
+            hx = torch.where(m, hy, hx)
+            hy = torch.where(m, hy, torch.zeros_like(hy))
+        else:
+            cx, hx = cy, hy
+        if preallocated:
+            ys[t] = hy
+        else:
+            outputs.append(hy)
+    if not preallocated:
+        ys = torch.stack(outputs)
+    return ys, hx, cx
+
+
+def _reverse_padded(x, lens=None):
+    """ reverse the TxNxH padded sequences along T within their lengths, keeping the padding in place """
+    if lens is None:
+        return x.flip(0)
+    t = torch.arange(x.size(0), device=x.device).unsqueeze(1)
+    lens = lens.to(x.device).unsqueeze(0)
+    idx = torch.where(t < lens, lens - 1 - t, t)
+    return x.gather(0, idx.unsqueeze(2).expand_as(x))
+
+
 class LSTMCell(nn.LSTMCell):
+    """ LSTM cell with the layer norms of the input and the hidden projections and of the cell state """
 
     def __init__(self, input_size, hidden_size, bias=True):
         super().__init__(input_size, hidden_size, bias)
@@ -139,29 +197,32 @@ class LSTMCell(nn.LSTMCell):
         self.ln_hh = nn.LayerNorm(4 * hidden_size)
         self.ln_ho = nn.LayerNorm(hidden_size)
 
+    def input_gates(self, input):
+        """ the normalized input projections, of all the time steps at once """
+        return self.ln_ih(F.linear(input, self.weight_ih, self.bias_ih))
+
+    def run(self, igates, hx, cx, mask=None):
+        return _layer_norm_lstm_loop(igates, hx, cx, mask, self.weight_hh, self.bias_hh,
+                                     self.ln_hh.weight, self.ln_hh.bias, self.ln_ho.weight, self.ln_ho.bias,
+                                     self.ln_ho.eps)
+
     def forward(self, input, hidden=None):
-        self.check_forward_input(input)
         if hidden is None:
             hx = input.new_zeros(input.size(0), self.hidden_size, requires_grad=False)
             cx = input.new_zeros(input.size(0), self.hidden_size, requires_grad=False)
         else:
             hx, cx = hidden
-        self.check_forward_hidden(input, hx, '[0]')
-        self.check_forward_hidden(input, cx, '[1]')
-
-        gates = self.ln_ih(F.linear(input, self.weight_ih, self.bias_ih)) \
-                 + self.ln_hh(F.linear(hx, self.weight_hh, self.bias_hh))
-        i, f, o = gates[:, :(3 * self.hidden_size)].sigmoid().chunk(3, 1)
-        g = gates[:, (3 * self.hidden_size):].tanh()
-
-        cy = (f * cx) + (i * g)
-        hy = o * self.ln_ho(cy).tanh()
+        _, hy, cy = self.run(self.input_gates(input).unsqueeze(0), hx, cx)
         return hy, cy
 
 
 class LSTM(nn.Module):
+    """ multi-layered layer-norm LSTM taking TxNxH or a PackedSequence like nn.LSTM, whose time loop
+        is compiled by TorchScript. the input projections of all the time steps are computed at once,
+        and the backward direction runs on the sequences reversed within their lengths
+    """
 
-    def __init__(self, input_size, hidden_size, num_layers=1, bias=True, use_layernorm=False, bidirectional=False):
+    def __init__(self, input_size, hidden_size, num_layers=1, bias=True, bidirectional=False):
         super().__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
@@ -171,56 +232,57 @@ class LSTM(nn.Module):
         num_directions = 2 if bidirectional else 1
         self.hidden0 = nn.ModuleList([
             LSTMCell(input_size=(input_size if layer == 0 else hidden_size * num_directions),
-                     hidden_size=hidden_size, bias=bias, use_layernorm=use_layernorm)
+                     hidden_size=hidden_size, bias=bias)
             for layer in range(num_layers)
         ])
 
         if self.bidirectional:
             self.hidden1 = nn.ModuleList([
                 LSTMCell(input_size=(input_size if layer == 0 else hidden_size * num_directions),
-                         hidden_size=hidden_size, bias=bias, use_layernorm=use_layernorm)
+                         hidden_size=hidden_size, bias=bias)
                 for layer in range(num_layers)
             ])
 
+    def flatten_parameters(self):
+        pass
+
     def forward(self, input, hidden=None):
-        seq_len, batch_size, hidden_size = input.size()  # supports TxNxH only
+        packed = isinstance(input, PackedSequence)
+        if packed:
+            xs, lens = pad_packed_sequence(input)
+            mask = (torch.arange(xs.size(0)).unsqueeze(1) < lens.unsqueeze(0)).unsqueeze(2).to(xs.device)
+        else:
+            xs, lens, mask = input, None, None
+        seq_len, batch_size, _ = xs.size()  # supports TxNxH only
         num_directions = 2 if self.bidirectional else 1
         if hidden is None:
-            hx = input.new_zeros(self.num_layers * num_directions, batch_size, self.hidden_size, requires_grad=False)
-            cx = input.new_zeros(self.num_layers * num_directions, batch_size, self.hidden_size, requires_grad=False)
+            hx = xs.new_zeros(self.num_layers * num_directions, batch_size, self.hidden_size)
+            cx = xs.new_zeros(self.num_layers * num_directions, batch_size, self.hidden_size)
         else:
             hx, cx = hidden
 
-        ht = [[None, ] * (self.num_layers * num_directions)] * seq_len
-        ct = [[None, ] * (self.num_layers * num_directions)] * seq_len
-
-        if self.bidirectional:
-            xs = input
-            for l, (layer0, layer1) in enumerate(zip(self.hidden0, self.hidden1)):
-                l0, l1 = 2 * l, 2 * l + 1
-                h0, c0, h1, c1 = hx[l0], cx[l0], hx[l1], cx[l1]
-                for t, (x0, x1) in enumerate(zip(xs, reversed(xs))):
-                    ht[t][l0], ct[t][l0] = layer0(x0, (h0, c0))
-                    h0, c0 = ht[t][l0], ct[t][l0]
-                    t = seq_len - 1 - t
-                    ht[t][l1], ct[t][l1] = layer1(x1, (h1, c1))
-                    h1, c1 = ht[t][l1], ct[t][l1]
-                xs = [torch.cat((h[l0], h[l1]), dim=1) for h in ht]
-            y  = torch.stack(xs)
-            hy = torch.stack(ht[-1])
-            cy = torch.stack(ct[-1])
-        else:
-            h, c = hx, cx
-            for t, x in enumerate(input):
-                for l, layer in enumerate(self.hidden0):
-                    ht[t][l], ct[t][l] = layer(x, (h[l], c[l]))
-                    x = ht[t][l]
-                h, c = ht[t], ct[t]
-            y  = torch.stack([h[-1] for h in ht])
-            hy = torch.stack(ht[-1])
-            cy = torch.stack(ct[-1])
-
-        return y, (hy, cy)
+        hy, cy = list(), list()
+        for l in range(self.num_layers):
+            k = l * num_directions
+            ys, h, c = self.hidden0[l].run(self.hidden0[l].input_gates(xs), hx[k], cx[k], mask)
+            hy.append(h)
+            cy.append(c)
+            if self.bidirectional:
+                igates = _reverse_padded(self.hidden1[l].input_gates(xs), lens)
+                ys_r, h, c = self.hidden1[l].run(igates, hx[k + 1], cx[k + 1], mask)
+                ys = torch.cat((ys, _reverse_padded(ys_r, lens)), dim=2)
+                hy.append(h)
+                cy.append(c)
+            xs = ys
+        hy, cy = torch.stack(hy), torch.stack(cy)
+
+        if packed:
+            # in the layout of the input
+            sorted_indices = getattr(input, "sorted_indices", None)
+            if sorted_indices is not None:
+                xs, lens = xs.index_select(1, sorted_indices), lens[sorted_indices.cpu()]
+            xs = input._replace(data=pack_padded_sequence(xs, lens).data)
+        return xs, (hy, cy)
 
 
 class BatchRNN(nn.Module):
@@ -238,11 +300,15 @@ class BatchRNN(nn.Module):
         self.rnn.flatten_parameters()
 
     def forward(self, x):
+        """ x is TxNxH, or a PackedSequence to run on the valid frames only """
         if self.batch_norm is not None:
             x = self.batch_norm(x)
         x, _ = self.rnn(x)
         if self.bidirectional:
-            x = x.view(x.size(0), x.size(1), 2, -1).sum(2).view(x.size(0), x.size(1), -1)  # (TxNxH*2) -> (TxNxH) by sum
+            if isinstance(x, PackedSequence):
+                x = x._replace(data=x.data.view(x.data.size(0), 2, -1).sum(1))
+            else:
+                x = x.view(x.size(0), x.size(1), 2, -1).sum(2).view(x.size(0), x.size(1), -1)  # (TxNxH*2) -> (TxNxH) by sum
         return x
 
 
@@ -266,20 +332,27 @@ class Lookahead(nn.Module):
         self.weight.data.uniform_(-stdv, stdv)
 
     def forward(self, input):
-        seq_len = input.size(0)
-        # pad the 0th dimension (T/sequence) with zeroes whose number = context
-        # Once pytorch's padding functions have settled, should move to those.
-        padding = torch.zeros(self.context, *(input.size()[1:])).type_as(input.data)
-        x = torch.cat((input, Variable(padding)), 0)
-
-        # add lookahead windows (with context+1 width) as a fourth dimension
-        # for each seq-batch-feature combination
-        x = [x[i:i + self.context + 1] for i in range(seq_len)]  # TxLxNxH - sequence, context, batch, feature
-        x = torch.stack(x)
-        x = x.permute(0, 2, 3, 1)  # TxNxHxL - sequence, batch, feature, context
-
-        x = torch.mul(x, self.weight).sum(dim=3)
-        return x
+        # pad the 0th dimension (T/sequence) with zeroes whose number = context,
+        # and apply the weights as a depthwise conv of (context+1) width over the features
+        x = input.permute(1, 2, 0)  # NxHxT
+        x = F.conv1d(F.pad(x, (0, self.context)), self.weight.unsqueeze(1), groups=self.n_features)
+        return x.permute(2, 0, 1).contiguous()  # TxNxH
+
+    def stream(self, input, buffer=None, final=False):
+        """ run on a TxNxH chunk of a stream, following the buffer of the last context frames
+            of the previous chunks returned. the outputs are of the frames whose context is
+            complete so far, or of all the frames left padded with zeros if final
+
+            returns the outputs and the buffer for the next chunk, None if final
+        """
+        x = input if buffer is None else torch.cat((buffer, input), 0)
+        if final:
+            return self.forward(x), None
+        buffer = x[-self.context:]
+        if x.size(0) <= self.context:
+            return x.new_zeros(0, *x.size()[1:]), buffer
+        y = F.conv1d(x.permute(1, 2, 0), self.weight.unsqueeze(1), groups=self.n_features)
+        return y.permute(2, 0, 1).contiguous(), buffer
 
     def __repr__(self):
         return self.__class__.__name__ + '(' \
@@ -288,10 +361,21 @@ class Lookahead(nn.Module):
 
 
 class DeepSpeech(nn.Module):
+    """ recompute takes the segments to run again in the backward instead of keeping their
+        activations: "conv" for the conv front-end and "rnn" for each of the BatchRNNs
+    """
+
+    RECOMPUTE_SEGMENTS = set([
+        "conv",
+        "rnn",
+    ])
 
     def __init__(self, num_classes=p.NUM_CTC_LABELS, input_folding=3, rnn_type=nn.LSTM,
-                 rnn_hidden_size=512, rnn_num_layers=4, bidirectional=True, context=20):
+                 rnn_hidden_size=512, rnn_num_layers=4, bidirectional=True, context=20, recompute=()):
         super().__init__()
+        recompute = set(recompute or ())
+        assert recompute <= self.RECOMPUTE_SEGMENTS, f"recompute segments in {self.RECOMPUTE_SEGMENTS}"
+        self.recompute = recompute
 
         # model metadata needed for serialization/deserialization
         self._rnn_type = rnn_type
@@ -366,22 +450,88 @@ class DeepSpeech(nn.Module):
         )
         self.inference_softmax = InferenceBatchSoftmax()
 
-    def forward(self, x):
-        x = self.conv(x)
+    def segment(self, name, module, *inputs):
+        if name in self.recompute:
+            return recompute_forward(module, *inputs)
+        return module(*inputs)
+
+    def forward(self, x, frame_lens=None):
+        """ x is NxCxHxT, padded along T for the frame_lens if given, in which case the layers
+            after the conv run on the valid frames only and the padded frames of the output are zero
+        """
+        x = self.segment("conv", self.conv, x)
         sizes = x.size()
         x = x.view(sizes[0], sizes[1] * sizes[2], sizes[3])  # Collapse feature dimension
         x = x.transpose(1, 2).transpose(0, 1).contiguous()  # TxNxH
-        x = self.rnns(x)
+        if frame_lens is not None:
+            # packed in the descending order of the lengths, which the torch before 1.1 requires
+            seq_len = x.size(0)
+            mask = torch.arange(seq_len).unsqueeze(0) < frame_lens.cpu().long().unsqueeze(1)  # NxT
+            frame_lens, order = frame_lens.cpu().long().sort(descending=True)
+            x = pack_padded_sequence(x.index_select(1, order.to(x.device)), frame_lens.tolist())
+        for rnn in self.rnns:
+            x = self.segment("rnn", rnn, x)
         #x, _ = self.rnns(x)
         if not self._bidirectional:  # no need for lookahead layer in bidirectional
-            x = self.lookahead(x)
+            if frame_lens is not None:
+                x, _ = pad_packed_sequence(x, total_length=seq_len)
+                x = pack_padded_sequence(self.lookahead(x), frame_lens.tolist())
+            else:
+                x = self.lookahead(x)
         x = self.fc(x)
+        if frame_lens is not None:
+            x, _ = pad_packed_sequence(x, total_length=seq_len)
+            _, unorder = order.sort()
+            x = x.index_select(1, unorder.to(x.device))
         x = x.transpose(0, 1)
         # identity in training mode, softmax in eval mode
         x = self.inference_softmax(x)
+        if frame_lens is not None and not self.training:
+            # zero the posteriors of the padded frames, the softmax of their zero outputs
+            x = x * mask.unsqueeze(2).to(x.device).type_as(x)
         return x
 
 
+def benchmark_lstm(seq_len=200, batch_size=8, input_size=816, hidden_size=512, repeats=3):
+    """ forward and backward time of a bidirectional layer of the layer-norm LSTM against nn.LSTM
+        and against the loop of the LSTMCells in python, on cpu
+    """
+    import time
+
+    def loop_lstm(m, xs):
+        ys = list()
+        for cell, xs_dir in [(m.hidden0[0], xs), (m.hidden1[0], xs.flip(0))]:
+            hx = xs.new_zeros(xs.size(1), hidden_size)
+            cx = xs.new_zeros(xs.size(1), hidden_size)
+            hs = list()
+            for x in xs_dir:
+                hx, cx = cell(x, (hx, cx))
+                hs.append(hx)
+            ys.append(torch.stack(hs))
+        return torch.cat((ys[0], ys[1].flip(0)), dim=2)
+
+    xs = torch.randn(seq_len, batch_size, input_size)
+    lstm = LSTM(input_size, hidden_size, bidirectional=True)
+    models = [
+        ("nn.LSTM", nn.LSTM(input_size, hidden_size, bidirectional=True), lambda m, xs: m(xs)[0]),
+        ("layer-norm LSTM, scripted", lstm, lambda m, xs: m(xs)[0]),
+        ("layer-norm LSTMCell loop in python", lstm, loop_lstm),
+    ]
+    print(f"T={seq_len}, N={batch_size}, input {input_size}, hidden {hidden_size}, {torch.get_num_threads()} threads")
+    for desc, m, run in models:
+        run(m, xs).sum().backward()  # warm up, and the profiling runs of the scripted loop
+        run(m, xs).sum().backward()
+        fwd, bwd = list(), list()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            ys = run(m, xs)
+            mid = time.perf_counter()
+            ys.sum().backward()
+            fwd.append(mid - start)
+            bwd.append(time.perf_counter() - mid)
+        print(f"{desc:>40s}: forward {min(fwd) * 1000.:7.1f} ms, backward {min(bwd) * 1000.:7.1f} ms")
+
+
 if __name__ == '__main__':
     import os.path
     import argparse
@@ -389,7 +539,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='DeepSpeech model information')
     parser.add_argument('--model_path', default='models/deepspeech_final.pth.tar',
                         help='Path to model file created by training')
+    parser.add_argument('--benchmark-lstm', default=False, action='store_true',
+                        help='compare the layer-norm LSTM with nn.LSTM on cpu instead')
+    parser.add_argument('--frames', default=200, type=int, help='number of frames of the benchmark')
+    parser.add_argument('--batch-size', default=8, type=int, help='batch size of the benchmark')
     args = parser.parse_args()
+
+    if args.benchmark_lstm:
+        benchmark_lstm(seq_len=args.frames, batch_size=args.batch_size)
+        sys.exit(0)
     package = torch.load(args.model_path, map_location=lambda storage, loc: storage)
     model = DeepSpeech.load_model(args.model_path)
 
@@ -2,13 +2,17 @@
 import sys
 import argparse
 
+import torch.nn as nn
+
 from asr.utils.dataset import NonSplitPredictDataset
 from asr.utils.dataloader import NonSplitPredictDataLoader
 from asr.utils.logger import logger, init_logger
 from asr.utils import params as p
+from asr.utils.quantize import QUANTIZE_MODES
+from asr.decoders import DECODER_TYPES
 
 from ..predictor import NonSplitPredictor
-from .network import DeepSpeech
+from .network import DeepSpeech, LSTM
 
 
 def predict(argv):
@@ -18,6 +22,20 @@ def predict(argv):
     parser.add_argument('--batch-size', default=8, type=int, help="number of simultaneous decoding")
     parser.add_argument('--log-dir', default='./logs_deepspeech_ctc', type=str, help="filename for logging the outputs")
     parser.add_argument('--continue-from', type=str, help="model file path to make continued from")
+    parser.add_argument('--layer-norm-lstm', default=False, action='store_true', help="the model uses the layer-norm LSTM instead of nn.LSTM")
+    parser.add_argument('--no-optimize', default=False, action='store_true', help="run the model as trained, without folding the batch norms for inference")
+    parser.add_argument('--quantize', default=None, type=str, choices=QUANTIZE_MODES, help="run the model in int8 on cpu, quantized dynamically or statically")
+    parser.add_argument('--calibration-manifest', default=None, type=str, help="manifest of the utterances to calibrate the static quantization on")
+    parser.add_argument('--calibration-size', default=100, type=int, help="number of utterances of the calibration manifest to use")
+    parser.add_argument('--save-quantized', default=None, type=str, help="file path to save the quantized model, to load by --continue-from")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--decode-workers', default=None, type=int, help="number of processes for ctc_beam decoder, none by default")
+    parser.add_argument('--decoder-config', default=None, type=str, help="decoder search options file saved by asr.decoders.tune")
+    parser.add_argument('--blank-skip', default=None, type=float, help="skip frames of blank posterior over this before decoding")
+    parser.add_argument('--rescore-lm', default=None, type=str, help="ARPA n-gram LM file to rescore the latgen lattices")
+    parser.add_argument('--rescore-old-lm', default=None, type=str, help="ARPA n-gram LM file in the graph to take out in the rescoring")
+    parser.add_argument('--rescore-mode', default="lattice", type=str, help="rescoring the lattices or the n-best paths")
     parser.add_argument('wav_files', type=str, nargs='+', help="list of wav_files for prediction")
     args = parser.parse_args(argv)
 
@@ -27,7 +45,7 @@ def predict(argv):
         logger.error("model name is missing: add '--continue-from <model-name>' in options")
         sys.exit(1)
 
-    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS)
+    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS, rnn_type=(LSTM if args.layer_norm_lstm else nn.LSTM))
     predictor = NonSplitPredictor(model, **vars(args))
 
     dataset = NonSplitPredictDataset(wav_files=args.wav_files)
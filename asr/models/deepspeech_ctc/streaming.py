@@ -0,0 +1,176 @@
+#!python
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from asr.utils.dataset import StreamingSpectrogram
+from asr.utils import params as p
+
+from .network import DeepSpeech, Lookahead
+
+
+class StreamingConv(object):
+    """ a Conv2d and the layers following it run over the chunks of NxCxHxT frames, keeping the
+        last frames of its receptive field in time for the next chunk. the zero padding in time
+        is put at the beginning of the stream and at its end instead of around every chunk
+    """
+
+    def __init__(self, conv, layers):
+        assert conv.stride[1] == 1 and conv.dilation[1] == 1, "streaming conv needs stride 1 in time"
+        assert conv.kernel_size[1] == 2 * conv.padding[1] + 1, "streaming conv needs the same padding on both sides"
+        self.conv = conv
+        self.layers = layers
+        self.width = conv.kernel_size[1]
+        self.pad = conv.padding[1]
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+
+    def __call__(self, x, final=False):
+        if x is None:
+            if not final or self.buffer is None:
+                return None
+            x = self.buffer
+        elif self.buffer is None:
+            x = F.pad(x, (self.pad, 0))
+        else:
+            x = torch.cat((self.buffer, x), dim=3)
+        if final:
+            x = F.pad(x, (0, self.pad))
+        if x.size(3) < self.width:
+            self.buffer = None if final else x
+            return None
+        self.buffer = None if final else x[:, :, :, -(self.width - 1):]
+        c = self.conv
+        y = F.conv2d(x, c.weight, c.bias, c.stride, (c.padding[0], 0), c.dilation, c.groups)
+        return self.layers(y)
+
+
+class StreamingDeepSpeech(object):
+    """ the inference of a unidirectional DeepSpeech over the chunks of a stream of audio samples,
+        carrying the frames of the STFT, the context of the convs, the hidden states of the RNNs and
+        the buffer of the lookahead from a chunk to the next, so that the posteriors emitted over
+        the chunks are those of the whole utterance
+
+        the power normalization and the noise of the Augment in the datasets are over the whole
+        utterance, so the samples are taken as they are given to the Spectrogram
+    """
+
+    def __init__(self, model, use_cuda=False, **kwargs):
+        assert not model._bidirectional, "streaming needs a unidirectional model with the lookahead"
+        self.device = torch.device("cuda" if use_cuda else "cpu")
+        self.model = model.to(self.device).eval()
+        self.spectrogram = StreamingSpectrogram(**kwargs)
+
+        convs = [i for i, m in enumerate(model.conv) if isinstance(m, nn.Conv2d)]
+        self.convs = [StreamingConv(model.conv[i], nn.Sequential(*list(model.conv)[(i + 1):j]))
+                      for i, j in zip(convs, convs[1:] + [len(model.conv)])]
+        self.lookahead = model.lookahead[0]
+        assert isinstance(self.lookahead, Lookahead)
+        self.lookahead_layers = nn.Sequential(*list(model.lookahead)[1:])
+        self.reset()
+
+    @property
+    def delay(self):
+        """ the frames of the spectrogram folded that a posterior waits for after its own """
+        return sum(c.pad for c in self.convs) + self.lookahead.context
+
+    def reset(self):
+        """ start a new stream """
+        self.spectrogram.reset()
+        for c in self.convs:
+            c.reset()
+        self.hiddens = [None] * len(self.model.rnns)
+        self.lookahead_buffer = None
+
+    def __call__(self, samples, final=False):
+        """ returns the 1xTxC posteriors completed by the chunk of samples, or None if none is yet """
+        xs = self.spectrogram(samples, final=final)
+        return self.forward(xs, final=final)
+
+    def forward(self, xs, final=False):
+        """ the same with __call__ for the chunks of 1xCxHxT features split along T """
+        with torch.no_grad():
+            x = None if xs is None or xs.size(3) == 0 else xs.to(self.device)
+            for c in self.convs:
+                x = c(x, final=final)
+            if x is not None:
+                sizes = x.size()
+                x = x.view(sizes[0], sizes[1] * sizes[2], sizes[3])  # Collapse feature dimension
+                x = x.transpose(1, 2).transpose(0, 1).contiguous()  # TxNxH
+                for i, rnn in enumerate(self.model.rnns):
+                    if rnn.batch_norm is not None:
+                        x = rnn.batch_norm(x)
+                    x, self.hiddens[i] = rnn.rnn(x, self.hiddens[i])
+            if x is None:
+                if not final or self.lookahead_buffer is None:
+                    return None
+                x = self.lookahead_buffer[:0]
+            x, self.lookahead_buffer = self.lookahead.stream(x, self.lookahead_buffer, final=final)
+            if x.size(0) == 0:
+                return None
+            x = self.lookahead_layers(x)
+            x = self.model.fc(x)
+            x = x.transpose(0, 1)
+            return self.model.inference_softmax(x)
+
+
+def benchmark(streamer, chunk_sizes, seconds=10., sample_rate=p.SAMPLE_RATE, repeats=2):
+    """ per chunk size, the compute time of a chunk against its duration, and the delay of the
+        posteriors: the audio received after the end of a frame when its posteriors are emitted,
+        averaged over the frames
+    """
+    import time
+    import numpy as np
+
+    wav = np.random.RandomState(0).normal(0., 0.1, int(seconds * sample_rate)).astype(np.float32)
+    frame_shift = streamer.spectrogram.hop * streamer.spectrogram.stride / sample_rate
+    print(f"{seconds:.1f} sec of audio on {streamer.device}, {torch.get_num_threads()} threads, "
+          f"algorithmic delay {streamer.delay} frames ({streamer.delay * frame_shift * 1000.:.0f} ms)")
+    for chunk_ms in chunk_sizes:
+        chunk = int(sample_rate * chunk_ms / 1000.)
+        for _ in range(repeats):
+            streamer.reset()
+            elapsed, delays, emitted = list(), list(), 0
+            for start in range(0, wav.shape[0], chunk):
+                final = start + chunk >= wav.shape[0]
+                t0 = time.perf_counter()
+                ys = streamer(wav[start:(start + chunk)], final=final)
+                elapsed.append(time.perf_counter() - t0)
+                if ys is not None and not final:
+                    received = min(start + chunk, wav.shape[0]) / sample_rate
+                    ends = (np.arange(ys.size(1)) + emitted + 1) * frame_shift
+                    delays.extend(received - ends)
+                    emitted += ys.size(1)
+        elapsed = np.array(elapsed) * 1000.
+        delay = np.mean(delays) * 1000. if delays else float("nan")
+        print(f"chunk {chunk_ms:5d} ms: compute p50/p90/max {np.percentile(elapsed, 50):7.1f}/"
+              f"{np.percentile(elapsed, 90):7.1f}/{elapsed.max():7.1f} ms per chunk, "
+              f"real-time factor {elapsed.sum() / (seconds * 1000.):.3f}, "
+              f"mean delay of the posteriors {delay:6.0f} ms + compute")
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    from asr.utils.logger import logger
+    from .network import LSTM
+
+    parser = argparse.ArgumentParser(description="latency of the streaming inference of a unidirectional DeepSpeech by chunk size")
+    parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
+    parser.add_argument('--continue-from', default=None, type=str, help="model file path to load, a random model if not given")
+    parser.add_argument('--layer-norm-lstm', default=False, action='store_true', help="use the layer-norm LSTM instead of nn.LSTM")
+    parser.add_argument('--chunk-ms', default=[40, 80, 160, 320, 640], type=int, nargs='*', help="chunk sizes in ms to benchmark")
+    parser.add_argument('--seconds', default=10., type=float, help="seconds of audio to stream")
+    args = parser.parse_args(sys.argv[1:])
+
+    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS, bidirectional=False,
+                       rnn_type=(LSTM if args.layer_norm_lstm else nn.LSTM))
+    if args.continue_from is not None:
+        logger.info(f"loading the model from {args.continue_from}")
+        states = torch.load(args.continue_from, map_location=lambda storage, loc: storage)
+        model.load_state_dict(states["model"])
+    streamer = StreamingDeepSpeech(model, use_cuda=args.use_cuda)
+    benchmark(streamer, args.chunk_ms, seconds=args.seconds)
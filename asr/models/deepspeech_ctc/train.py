@@ -5,17 +5,16 @@ from pathlib import Path, PurePath
 
 import torch
 from torch.utils.data.dataset import ConcatDataset
-from torch.utils.data.distributed import DistributedSampler
 from warpctc_pytorch import CTCLoss
 
 from asr.utils.dataset import NonSplitTrainDataset, AudioSubset
-from asr.utils.dataloader import NonSplitTrainDataLoader
+from asr.utils.dataloader import NonSplitTrainDataLoader, ResumableSampler, DistributedEvalSampler
 from asr.utils.logger import logger, init_logger
 from asr.utils import params as p
-from asr.kaldi.latgen import LatGenCTCDecoder
 
 from ..trainer import *
-from .network import DeepSpeech
+from ..distributed import COMPRESSIONS
+from .network import DeepSpeech, LSTM
 
 
 def batch_train(argv):
@@ -27,6 +26,7 @@ def batch_train(argv):
     parser.add_argument('--max-norm', default=400, type=int, help="norm cutoff to prevent explosion of gradients")
     # optional
     parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
+    parser.add_argument('--nproc', default=1, type=int, help="number of local processes to launch, each on a disjoint set of the cpu cores")
     parser.add_argument('--fp16', default=False, action='store_true', help="use FP16 model")
     parser.add_argument('--visdom', default=False, action='store_true', help="use visdom logging")
     parser.add_argument('--visdom-host', default="127.0.0.1", type=str, help="visdom server ip address")
@@ -37,16 +37,39 @@ def batch_train(argv):
     parser.add_argument('--log-dir', default='./logs_deepspeech_ctc', type=str, help="filename for logging the outputs")
     parser.add_argument('--model-prefix', default='deepspeech_ctc', type=str, help="model file prefix to store")
     parser.add_argument('--checkpoint', default=True, action='store_true', help="save checkpoint")
+    parser.add_argument('--keep-last', default=None, type=int, help="number of the latest epoch checkpoints to retain, all of them if not given")
+    parser.add_argument('--keep-best', default=3, type=int, help="number of the best epoch checkpoints by LER to retain with --keep-last")
+    parser.add_argument('--keep-ckpts', default=10, type=int, help="number of the latest mid-epoch checkpoints to retain")
+    parser.add_argument('--profile-sync', default=False, action='store_true', help="synchronize cuda at every step phase for the exact timings")
+    parser.add_argument('--log-interval', default=20, type=int, help="number of steps to keep the losses on the device before logging them")
+    parser.add_argument('--accum-steps', default=1, type=int, help="number of batches to accumulate the gradients over before a step")
+    parser.add_argument('--layer-norm-lstm', default=False, action='store_true', help="use the layer-norm LSTM instead of nn.LSTM")
+    parser.add_argument('--padded-rnn', default=False, action='store_true', help="run the RNNs on the padded frames too, faster for the training on cpu where the backward of the packed LSTM is slow")
+    parser.add_argument('--recompute', default=[], type=str, nargs='*', help=f"segments to recompute in the backward to save the memory in {DeepSpeech.RECOMPUTE_SEGMENTS}")
+    parser.add_argument('--grad-compression', default=None, type=str, help=f"gradient compression of the all-reduce in {set(c for c in COMPRESSIONS if c)}")
     parser.add_argument('--continue-from', default=None, type=str, help="model file path to make continued from")
     parser.add_argument('--opt-type', default="sgdr", type=str, help=f"optimizer type in {OPTIMIZER_TYPES}")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--decode-workers', default=None, type=int, help="number of processes for ctc_beam decoder, none by default")
+    parser.add_argument('--decoder-config', default=None, type=str, help="decoder search options file saved by asr.decoders.tune")
+    parser.add_argument('--blank-skip', default=None, type=float, help="skip frames of blank posterior over this before decoding")
+    parser.add_argument('--rescore-lm', default=None, type=str, help="ARPA n-gram LM file to rescore the latgen lattices")
+    parser.add_argument('--rescore-old-lm', default=None, type=str, help="ARPA n-gram LM file in the graph to take out in the rescoring")
+    parser.add_argument('--rescore-mode', default="lattice", type=str, help="rescoring the lattices or the n-best paths")
     args = parser.parse_args(argv)
 
+    if args.nproc > 1 and not is_launched():
+        launch(batch_train, argv, args.nproc)
+        return
+
     init_distributed(args.use_cuda)
     init_logger(log_file="train.log", rank=get_rank(), **vars(args))
     set_seed(args.seed)
 
     # prepare trainer object
-    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS)
+    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS, rnn_type=(LSTM if args.layer_norm_lstm else nn.LSTM),
+                       recompute=args.recompute)
     trainer = NonSplitTrainer(model, **vars(args))
     labeler = trainer.decoder.labeler
 
@@ -68,33 +91,29 @@ def batch_train(argv):
 
     dataloaders = {
         "train3" : NonSplitTrainDataLoader(datasets["train3"],
-                                           sampler=(DistributedSampler(datasets["train3"])
-                                                    if is_distributed() else None),
+                                           sampler=ResumableSampler(datasets["train3"], seed=args.seed),
                                            batch_size=64, num_workers=32,
-                                           shuffle=(not is_distributed()),
                                            pin_memory=args.use_cuda),
         "train5" : NonSplitTrainDataLoader(datasets["train5"],
-                                           sampler=(DistributedSampler(datasets["train5"])
-                                                    if is_distributed() else None),
+                                           sampler=ResumableSampler(datasets["train5"], seed=args.seed),
                                            batch_size=64, num_workers=32,
-                                           shuffle=(not is_distributed()),
                                            pin_memory=args.use_cuda),
         "train10": NonSplitTrainDataLoader(datasets["train10"],
-                                           sampler=(DistributedSampler(datasets["train10"])
-                                                    if is_distributed() else None),
+                                           sampler=ResumableSampler(datasets["train10"], seed=args.seed),
                                            batch_size=64, num_workers=32,
-                                           shuffle=(not is_distributed()),
                                            pin_memory=args.use_cuda),
         "train15": NonSplitTrainDataLoader(datasets["train15"],
-                                           sampler=(DistributedSampler(datasets["train15"])
-                                                    if is_distributed() else None),
+                                           sampler=ResumableSampler(datasets["train15"], seed=args.seed),
                                            batch_size=32, num_workers=32,
-                                           shuffle=(not is_distributed()),
                                            pin_memory=args.use_cuda),
         "dev"    : NonSplitTrainDataLoader(datasets["dev"],
+                                           sampler=(DistributedEvalSampler(datasets["dev"])
+                                                    if is_distributed() else None),
                                            batch_size=64, num_workers=32,
                                            shuffle=False, pin_memory=args.use_cuda),
         "test"   : NonSplitTrainDataLoader(datasets["test"],
+                                           sampler=(DistributedEvalSampler(datasets["test"])
+                                                    if is_distributed() else None),
                                            batch_size=64, num_workers=32,
                                            shuffle=False, pin_memory=args.use_cuda),
     }
@@ -111,7 +130,10 @@ def batch_train(argv):
             trainer.train_epoch(dataloaders["train10"])
             trainer.validate(dataloaders["dev"])
         else:
-            trainer.train_epoch(dataloaders["train15"])
+            # the utterances up to 15 secs fit in the memory by the smaller batches, accumulated
+            # over as many more of them to keep the effective batch of the other stages
+            ratio = dataloaders["train10"].batch_size // dataloaders["train15"].batch_size
+            trainer.train_epoch(dataloaders["train15"], accum_steps=ratio * args.accum_steps)
             trainer.validate(dataloaders["dev"])
 
     # final test to know WER
@@ -131,6 +153,7 @@ def train(argv):
     parser.add_argument('--max-norm', default=400, type=int, help="norm cutoff to prevent explosion of gradients")
     # optional
     parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
+    parser.add_argument('--nproc', default=1, type=int, help="number of local processes to launch, each on a disjoint set of the cpu cores")
     parser.add_argument('--fp16', default=False, action='store_true', help="use FP16 model")
     parser.add_argument('--visdom', default=False, action='store_true', help="use visdom logging")
     parser.add_argument('--visdom-host', default="127.0.0.1", type=str, help="visdom server ip address")
@@ -141,16 +164,39 @@ def train(argv):
     parser.add_argument('--log-dir', default='./logs_deepspeech_ctc', type=str, help="filename for logging the outputs")
     parser.add_argument('--model-prefix', default='deepspeech_ctc', type=str, help="model file prefix to store")
     parser.add_argument('--checkpoint', default=True, action='store_true', help="save checkpoint")
+    parser.add_argument('--keep-last', default=None, type=int, help="number of the latest epoch checkpoints to retain, all of them if not given")
+    parser.add_argument('--keep-best', default=3, type=int, help="number of the best epoch checkpoints by LER to retain with --keep-last")
+    parser.add_argument('--keep-ckpts', default=10, type=int, help="number of the latest mid-epoch checkpoints to retain")
+    parser.add_argument('--profile-sync', default=False, action='store_true', help="synchronize cuda at every step phase for the exact timings")
+    parser.add_argument('--log-interval', default=20, type=int, help="number of steps to keep the losses on the device before logging them")
+    parser.add_argument('--accum-steps', default=1, type=int, help="number of batches to accumulate the gradients over before a step")
+    parser.add_argument('--layer-norm-lstm', default=False, action='store_true', help="use the layer-norm LSTM instead of nn.LSTM")
+    parser.add_argument('--padded-rnn', default=False, action='store_true', help="run the RNNs on the padded frames too, faster for the training on cpu where the backward of the packed LSTM is slow")
+    parser.add_argument('--recompute', default=[], type=str, nargs='*', help=f"segments to recompute in the backward to save the memory in {DeepSpeech.RECOMPUTE_SEGMENTS}")
+    parser.add_argument('--grad-compression', default=None, type=str, help=f"gradient compression of the all-reduce in {set(c for c in COMPRESSIONS if c)}")
     parser.add_argument('--continue-from', default=None, type=str, help="model file path to make continued from")
     parser.add_argument('--opt-type', default="sgdr", type=str, help=f"optimizer type in {OPTIMIZER_TYPES}")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--decode-workers', default=None, type=int, help="number of processes for ctc_beam decoder, none by default")
+    parser.add_argument('--decoder-config', default=None, type=str, help="decoder search options file saved by asr.decoders.tune")
+    parser.add_argument('--blank-skip', default=None, type=float, help="skip frames of blank posterior over this before decoding")
+    parser.add_argument('--rescore-lm', default=None, type=str, help="ARPA n-gram LM file to rescore the latgen lattices")
+    parser.add_argument('--rescore-old-lm', default=None, type=str, help="ARPA n-gram LM file in the graph to take out in the rescoring")
+    parser.add_argument('--rescore-mode', default="lattice", type=str, help="rescoring the lattices or the n-best paths")
     args = parser.parse_args(argv)
 
+    if args.nproc > 1 and not is_launched():
+        launch(train, argv, args.nproc)
+        return
+
     init_distributed(args.use_cuda)
     init_logger(log_file="train.log", rank=get_rank(), **vars(args))
     set_seed(args.seed)
 
     # prepare trainer object
-    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS)
+    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS, rnn_type=(LSTM if args.layer_norm_lstm else nn.LSTM),
+                       recompute=args.recompute)
     trainer = NonSplitTrainer(model=model, **vars(args))
     labeler = trainer.decoder.labeler
 
@@ -170,16 +216,18 @@ def train(argv):
 
     dataloaders = {
         "train": NonSplitTrainDataLoader(datasets["train"],
-                                         sampler=(DistributedSampler(datasets["train"])
-                                                  if is_distributed() else None),
+                                         sampler=ResumableSampler(datasets["train"], seed=args.seed),
                                          batch_size=args.batch_size,
                                          num_workers=args.num_workers,
-                                         shuffle=(not is_distributed()),
                                          pin_memory=args.use_cuda),
         "dev"  : NonSplitTrainDataLoader(datasets["dev"],
+                                         sampler=(DistributedEvalSampler(datasets["dev"])
+                                                  if is_distributed() else None),
                                          batch_size=16, num_workers=8,
                                          shuffle=False, pin_memory=args.use_cuda),
         "test" : NonSplitTrainDataLoader(datasets["test"],
+                                         sampler=(DistributedEvalSampler(datasets["test"])
+                                                  if is_distributed() else None),
                                          batch_size=16, num_workers=8,
                                          shuffle=False, pin_memory=args.use_cuda),
     }
@@ -203,26 +251,48 @@ def test(argv):
     parser.add_argument('--batch-size', default=4, type=int, help="number of images (and labels) to be considered in a batch")
     # optional
     parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
+    parser.add_argument('--nproc', default=1, type=int, help="number of local processes to launch, each on a disjoint set of the cpu cores")
     parser.add_argument('--fp16', default=False, action='store_true', help="use FP16 model")
     parser.add_argument('--log-dir', default='./logs_deepspeech_ctc', type=str, help="filename for logging the outputs")
     parser.add_argument('--continue-from', default=None, type=str, help="model file path to make continued from")
+    parser.add_argument('--layer-norm-lstm', default=False, action='store_true', help="the model uses the layer-norm LSTM instead of nn.LSTM")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
+    parser.add_argument('--lm-file', default=None, type=str, help="ARPA n-gram LM file for ctc_beam decoder")
+    parser.add_argument('--decode-workers', default=None, type=int, help="number of processes for ctc_beam decoder, none by default")
+    parser.add_argument('--decoder-config', default=None, type=str, help="decoder search options file saved by asr.decoders.tune")
+    parser.add_argument('--blank-skip', default=None, type=float, help="skip frames of blank posterior over this before decoding")
+    parser.add_argument('--rescore-lm', default=None, type=str, help="ARPA n-gram LM file to rescore the latgen lattices")
+    parser.add_argument('--rescore-old-lm', default=None, type=str, help="ARPA n-gram LM file in the graph to take out in the rescoring")
+    parser.add_argument('--rescore-mode', default="lattice", type=str, help="rescoring the lattices or the n-best paths")
+    parser.add_argument('--dump-posteriors', default=None, type=str, help="posterior cache path to store instead of decoding")
+    parser.add_argument('--top-k', default=None, type=int, help="number of labels per frame to keep in the posterior cache")
+    parser.add_argument('--hyp-file', default=None, type=str, help="file to write the hypotheses of the utterances")
     args = parser.parse_args(argv)
 
-    init_logger(log_file="test.log", **vars(args))
+    if args.nproc > 1 and not is_launched():
+        launch(test, argv, args.nproc)
+        return
+
+    init_distributed(args.use_cuda)
+    init_logger(log_file="test.log", rank=get_rank(), **vars(args))
 
     assert args.continue_from is not None
 
-    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS)
+    model = DeepSpeech(num_classes=p.NUM_CTC_LABELS, rnn_type=(LSTM if args.layer_norm_lstm else nn.LSTM))
     trainer = NonSplitTrainer(model, **vars(args))
     labeler = trainer.decoder.labeler
 
     manifest = f"{args.data_path}/eval2000.csv"
     dataset = AudioSubset(NonSplitTrainDataset(labeler=labeler, manifest_file=manifest),
                           max_len=args.max_len, min_len=args.min_len)
-    dataloader = NonSplitTrainDataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
-                                         shuffle=True, pin_memory=args.use_cuda)
+    dataloader = NonSplitTrainDataLoader(dataset, sampler=(DistributedEvalSampler(dataset) if is_distributed() else None),
+                                         batch_size=args.batch_size, num_workers=args.num_workers,
+                                         shuffle=(not is_distributed()), pin_memory=args.use_cuda)
 
-    trainer.test(dataloader)
+    if args.dump_posteriors is not None:
+        trainer.dump_posteriors(dataloader, args.dump_posteriors, top_k=args.top_k)
+    else:
+        trainer.test(dataloader, hyp_file=args.hyp_file)
 
 
 if __name__ == "__main__":
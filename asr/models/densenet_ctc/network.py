@@ -3,7 +3,8 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
-from ..utils.misc import Swish, InferenceBatchSoftmax
+from asr.utils.misc import Swish, InferenceBatchSoftmax
+from asr.utils.recompute import recompute as recompute_forward
 
 
 class _DenseLayer(nn.Sequential):
@@ -28,12 +29,18 @@ class _DenseLayer(nn.Sequential):
 
 class _DenseBlock(nn.Sequential):
 
-    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate):
+    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, recompute_layers=False):
         super().__init__()
+        self.recompute_layers = recompute_layers
         for i in range(num_layers):
             layer = _DenseLayer(num_input_features + i * growth_rate, growth_rate, bn_size, drop_rate)
             self.add_module(f"denselayer{i+1}", layer)
 
+    def forward(self, x):
+        for layer in self:
+            x = recompute_forward(layer, x) if self.recompute_layers else layer(x)
+        return x
+
 
 class _Transition(nn.Sequential):
 
@@ -57,10 +64,23 @@ class DenseNet(nn.Module):
             bn_size (int) - multiplicative factor for number of bottle neck layers
               (i.e. bn_size * k features in the bottleneck layer)
             drop_rate (float) - dropout rate after each dense layer
+            recompute (set of str) - segments to run again in the backward instead of keeping
+              their activations: "front" for the conv front-end, "block" for each dense block,
+              and "layer" for each dense layer, which keeps only the concatenated features
     """
+
+    RECOMPUTE_SEGMENTS = set([
+        "front",
+        "block",
+        "layer",
+    ])
+
     def __init__(self, growth_rate=32, block_config=(6, 12, 24, 16),
-                 num_init_features=64, bn_size=4, drop_rate=0.5, num_classes=1000):
+                 num_init_features=64, bn_size=4, drop_rate=0.5, num_classes=1000, recompute=()):
         super().__init__()
+        recompute = set(recompute or ())
+        assert recompute <= self.RECOMPUTE_SEGMENTS, f"recompute segments in {self.RECOMPUTE_SEGMENTS}"
+        self.recompute = recompute
 
         # First convolution
         #self.hidden = nn.Sequential([
@@ -70,7 +90,7 @@ class DenseNet(nn.Module):
         #    Swish(inplace=True),
         #    nn.MaxPool2d(kernel_size=3, stride=(2, 1), padding=1),
         #])
-        self.hidden = nn.Sequential(
+        self.front = nn.Sequential(
             nn.Conv2d(2, num_init_features, kernel_size=(41, 11), stride=(2, 2), padding=(0, 5)),
             nn.BatchNorm2d(num_init_features),
             #nn.ReLU(inplace=True),
@@ -84,10 +104,12 @@ class DenseNet(nn.Module):
         )
 
         # Each denseblock
+        self.hidden = nn.Sequential()
         num_features = num_init_features
         for i, num_layers in enumerate(block_config):
             block = _DenseBlock(num_layers=num_layers, num_input_features=num_features,
-                                bn_size=bn_size, growth_rate=growth_rate, drop_rate=drop_rate)
+                                bn_size=bn_size, growth_rate=growth_rate, drop_rate=drop_rate,
+                                recompute_layers=("layer" in recompute and "block" not in recompute))
             self.hidden.add_module(f"denseblock{i+1}", block)
             num_features = num_features + num_layers * growth_rate
             if i != len(block_config) - 1:
@@ -117,8 +139,22 @@ class DenseNet(nn.Module):
             elif isinstance(m, nn.Linear):
                 nn.init.constant_(m.bias, 0)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the front-end was the first modules of the hidden in the earlier checkpoints
+        for key in list(state_dict):
+            name, _, rest = key[len(prefix):].partition(".")
+            index, _, rest = rest.partition(".")
+            if key.startswith(prefix) and name == "hidden" and index.isdigit():
+                state_dict[f"{prefix}front.{index}.{rest}"] = state_dict.pop(key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
-        x = self.hidden(x)
+        x = recompute_forward(self.front, x) if "front" in self.recompute else self.front(x)
+        for m in self.hidden:
+            if isinstance(m, _DenseBlock) and "block" in self.recompute:
+                x = recompute_forward(m, x)
+            else:
+                x = m(x)
         # BxCxWxH -> BxHxCxW -> BxTxH
         x = x.transpose(2, 3).transpose(1, 2)
         x = self.fc(x.view(x.size(0), x.size(1), -1))
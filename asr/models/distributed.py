@@ -1,9 +1,16 @@
+import sys
+import time
+import argparse
+from contextlib import contextmanager
+
 import torch
 from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 import torch.distributed as dist
 from torch.autograd import Variable
 from torch.nn.modules import Module
 
+from asr.utils.misc import is_finite
+
 '''
 This version of DistributedDataParallel is designed to be used in conjunction with the DistributedSampler
 You will be able to enable the distributed MPI-backend PyTorch Training with only 2 lines:
@@ -12,44 +19,275 @@ You will be able to enable the distributed MPI-backend PyTorch Training with onl
 This usage is exactly the same as the torch.nn.parallel.DistributedDataParallel()
 See imagenet example here: https://github.com/pytorch/examples/blob/master/imagenet/main.py#L88
 
-Parameters are broadcasted to the other processes on initialization of DistributedDataParallel,
-and will be allreduced at the finish of the backward pass.
+Parameters are broadcasted to the other processes on initialization of DistributedDataParallel.
+The parameters are grouped into buckets of bucket_cap_mb in the reverse order of their registration,
+which is roughly the order their gradients become ready in backward, and the all-reduce of a bucket
+is launched asynchronously as soon as all of its gradients are accumulated, so that the communication
+overlaps with the rest of backward. The averaged gradients are copied back by synchronize(), which
+the end of backward calls unless sync_in_backward is False, to wait only right before the optimizer step.
+
+The buckets can be compressed for the slow links by one of COMPRESSIONS: casting to fp16, PowerSGD
+low-rank approximation, or top-k sparsification, the latter two with the error feedback. The error
+feedback isn't updated by a step of non-finite gradients, which are passed through for the trainer to
+skip the step, not to carry the inf or nan over to all the later steps.
 '''
 
 
+class NoCompressor:
+    """ plain all-reduce of the flattened bucket """
+
+    def __init__(self, *args, **kwargs):
+        self.bytes = 0
+
+    def launch(self, k, grads):
+        coalesced = _flatten_dense_tensors(grads)
+        self.bytes += coalesced.numel() * coalesced.element_size()
+        return dist.all_reduce(coalesced, async_op=True), coalesced
+
+    def finish(self, k, state, grads):
+        handle, coalesced = state
+        handle.wait()
+        coalesced /= dist.get_world_size()
+        for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
+            buf.copy_(synced)
+
+
+class FP16Compressor(NoCompressor):
+    """ all-reduce of the bucket casted to fp16 """
+
+    def launch(self, k, grads):
+        coalesced = _flatten_dense_tensors(grads).half()
+        self.bytes += coalesced.numel() * coalesced.element_size()
+        return dist.all_reduce(coalesced, async_op=True), coalesced
+
+    def finish(self, k, state, grads):
+        handle, coalesced = state
+        handle.wait()
+        coalesced = coalesced.float() / dist.get_world_size()
+        for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
+            buf.copy_(synced)
+
+
+class TopKCompressor(NoCompressor):
+    """ all-gather of the ratio of the largest gradients of the bucket, the rest are kept
+        in the error feedback and added to the next gradients
+    """
+
+    def __init__(self, ratio=0.01, *args, **kwargs):
+        super().__init__()
+        self.ratio = ratio
+        self.errors = dict()
+
+    def launch(self, k, grads):
+        coalesced = _flatten_dense_tensors(grads)
+        prev = self.errors.get(k)
+        if prev is not None:
+            coalesced += prev
+        num = max(int(coalesced.numel() * self.ratio), 1)
+        _, indices = coalesced.abs().topk(num, sorted=False)
+        values = coalesced[indices]
+        # a non-finite bucket sends nan, for all the ranks to see it whichever entries are picked
+        values = torch.where(is_finite(coalesced).all(), values, torch.full_like(values, float("nan")))
+        coalesced[indices] = 0.
+        self.errors[k] = coalesced
+        self.bytes += values.numel() * (values.element_size() + indices.element_size())
+        world_size = dist.get_world_size()
+        all_values = [torch.zeros_like(values) for _ in range(world_size)]
+        all_indices = [torch.zeros_like(indices) for _ in range(world_size)]
+        handles = [dist.all_gather(all_values, values, async_op=True),
+                   dist.all_gather(all_indices, indices, async_op=True)]
+        return handles, all_values, all_indices, prev
+
+    def finish(self, k, state, grads):
+        handles, all_values, all_indices, prev = state
+        for handle in handles:
+            handle.wait()
+        coalesced = torch.zeros_like(self.errors[k])
+        for values, indices in zip(all_values, all_indices):
+            coalesced.index_add_(0, indices, values)
+        coalesced /= dist.get_world_size()
+        # back to the last errors on all the ranks if the step is to be skipped
+        if prev is None:
+            prev = torch.zeros_like(coalesced)
+        self.errors[k] = torch.where(is_finite(coalesced).all(), self.errors[k], prev)
+        for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
+            buf.copy_(synced)
+
+
+class PowerSGDCompressor(NoCompressor):
+    """ PowerSGD (Vogels et al. 2019) rank-r approximation M ~ P Q^T of the matrix gradients by
+        a power iteration warm-started from the last Q, with the error feedback. the vectors,
+        e.g. the biases, are all-reduced as they are
+    """
+
+    def __init__(self, rank=4, *args, **kwargs):
+        super().__init__()
+        self.rank = rank
+        self.errors = dict()
+        self.qs = dict()
+
+    def __matrix(self, grad):
+        return grad.view(grad.size(0), -1)
+
+    def launch(self, k, grads):
+        matrices = [i for i, g in enumerate(grads) if g.dim() > 1 and min(self.__matrix(g).size()) > self.rank]
+        vectors = [i for i in range(len(grads)) if i not in matrices]
+        ms, ps = list(), list()
+        for i in matrices:
+            m = self.__matrix(grads[i]).clone()
+            if (k, i) in self.errors:
+                m += self.errors[(k, i)]
+            else:
+                # the same initial Q on all ranks
+                g = torch.Generator()
+                g.manual_seed(k * 1000 + i)
+                self.qs[(k, i)] = torch.randn(m.size(1), self.rank, generator=g).to(m)
+            ms.append(m)
+            ps.append(m.mm(self.qs[(k, i)]))
+        state = { "matrices": matrices, "vectors": vectors, "ms": ms, "ps": ps }
+        if ps:
+            state["p_flat"] = _flatten_dense_tensors(ps)
+            state["p_handle"] = dist.all_reduce(state["p_flat"], async_op=True)
+            self.bytes += state["p_flat"].numel() * state["p_flat"].element_size()
+        if vectors:
+            state["v_flat"] = _flatten_dense_tensors([grads[i] for i in vectors])
+            state["v_handle"] = dist.all_reduce(state["v_flat"], async_op=True)
+            self.bytes += state["v_flat"].numel() * state["v_flat"].element_size()
+        return state
+
+    def finish(self, k, state, grads):
+        world_size = dist.get_world_size()
+        if state["vectors"]:
+            state["v_handle"].wait()
+            state["v_flat"] /= world_size
+            vectors = [grads[i] for i in state["vectors"]]
+            for buf, synced in zip(vectors, _unflatten_dense_tensors(state["v_flat"], vectors)):
+                buf.copy_(synced)
+        if state["ps"]:
+            state["p_handle"].wait()
+            ps = [self.__orthogonalize(p) for p in _unflatten_dense_tensors(state["p_flat"], state["ps"])]
+            qs = [m.t().mm(p) for m, p in zip(state["ms"], ps)]
+            q_flat = _flatten_dense_tensors(qs)
+            dist.all_reduce(q_flat)
+            self.bytes += q_flat.numel() * q_flat.element_size()
+            q_flat /= world_size
+            # the errors and the warm-start Qs are kept as they were if the bucket is not finite on any rank
+            finite = is_finite(q_flat).all()
+            if state["vectors"]:
+                finite = finite & is_finite(state["v_flat"]).all()
+            for i, m, p, q in zip(state["matrices"], state["ms"], ps, _unflatten_dense_tensors(q_flat, qs)):
+                approx = p.mm(q.t())
+                error = self.errors.get((k, i), torch.zeros_like(m))
+                self.errors[(k, i)] = torch.where(finite, m - approx, error)
+                self.qs[(k, i)] = torch.where(finite, q, self.qs[(k, i)])
+                grads[i].copy_(approx.view_as(grads[i]))
+
+    def __orthogonalize(self, p, eps=1e-8):
+        # Gram-Schmidt over the columns
+        p = p.clone()
+        for i in range(p.size(1)):
+            col = p[:, i:i+1]
+            if i > 0:
+                col -= p[:, :i].mm(p[:, :i].t().mm(col))
+            col /= col.norm() + eps
+        return p
+
+
+COMPRESSIONS = {
+    None: NoCompressor,
+    "fp16": FP16Compressor,
+    "powersgd": PowerSGDCompressor,
+    "topk": TopKCompressor,
+}
+
+
 class DistributedDataParallel(Module):
 
-    def __init__(self, module):
+    def __init__(self, module, bucket_cap_mb=10, sync_in_backward=True, compression=None, **kwargs):
         super(DistributedDataParallel, self).__init__()
         self.module = module
+        assert compression in COMPRESSIONS
+        # compression options as rank for powersgd or ratio for topk
+        self.compressor = COMPRESSIONS[compression](**kwargs)
         self.first_call = True
+        self.sync_in_backward = sync_in_backward
+        self.require_sync = True
+
+        # the buckets of the same tensor type, a single bucket if bucket_cap_mb is None
+        params = [param for param in self.module.parameters() if param.requires_grad]
+        cap = float("inf") if bucket_cap_mb is None else bucket_cap_mb * 1024 * 1024
+        self.buckets, bucket, size = list(), list(), 0
+        for param in reversed(params):
+            nbytes = param.numel() * param.element_size()
+            if bucket and (param.type() != bucket[0].type() or size + nbytes > cap):
+                self.buckets.append(bucket)
+                bucket, size = list(), 0
+            bucket.append(param)
+            size += nbytes
+        if bucket:
+            self.buckets.append(bucket)
+        self.bucket_index = {id(param): k for k, bucket in enumerate(self.buckets) for param in bucket}
+        self.__reset()
+
+        # hooks on the grad accumulators, which run after the grads are accumulated into .grad
+        self.grad_accs = list()
+        for param in params:
+            grad_acc = param.expand_as(param).grad_fn.next_functions[0][0]
+            grad_acc.register_hook(self.__make_hook(param))
+            self.grad_accs.append(grad_acc)
+
+    def __reset(self):
+        self.num_ready = [0] * len(self.buckets)
+        self.next_bucket = 0
+        self.callback_queued = False
+        self.handles = list()
 
-        def allreduce_params():
-            if (self.needs_reduction):
-                self.needs_reduction = False
-                buckets = {}
-                for param in self.module.parameters():
-                    if param.requires_grad and param.grad is not None:
-                        tp = type(param.data)
-                        if tp not in buckets:
-                            buckets[tp] = []
-                        buckets[tp].append(param)
-
-                for tp in buckets:
-                    bucket = buckets[tp]
-                    grads = [param.grad.data for param in bucket]
-                    coalesced = _flatten_dense_tensors(grads)
-                    dist.all_reduce(coalesced)
-                    coalesced /= dist.get_world_size()
-                    for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
-                        buf.copy_(synced)
-
-        for param in list(self.module.parameters()):
-            def allreduce_hook(*unused):
-                Variable._execution_engine.queue_callback(allreduce_params)
-
-            if param.requires_grad:
-                param.register_hook(allreduce_hook)
+    def __make_hook(self, param):
+        def allreduce_hook(*unused):
+            if not self.require_sync:
+                return
+            if not self.callback_queued:
+                Variable._execution_engine.queue_callback(self.__finish_backward)
+                self.callback_queued = True
+            k = self.bucket_index[id(param)]
+            self.num_ready[k] += 1
+            # launch in the order of the buckets to keep the collectives in the same order on all ranks
+            while (self.next_bucket < len(self.buckets) and
+                   self.num_ready[self.next_bucket] == len(self.buckets[self.next_bucket])):
+                self.__launch(self.next_bucket)
+        return allreduce_hook
+
+    def __launch(self, k):
+        bucket = self.buckets[k]
+        for param in bucket:
+            # unused in this backward on this rank
+            if param.grad is None:
+                param.grad = torch.zeros_like(param.data)
+        state = self.compressor.launch(k, [param.grad.data for param in bucket])
+        self.handles.append((k, state))
+        self.next_bucket = k + 1
+
+    def __finish_backward(self):
+        while self.next_bucket < len(self.buckets):
+            self.__launch(self.next_bucket)
+        self.callback_queued = False
+        if self.sync_in_backward:
+            self.synchronize()
+
+    def synchronize(self):
+        """ wait for the all-reduces in flight and copy the averaged gradients back """
+        for k, state in self.handles:
+            self.compressor.finish(k, state, [param.grad.data for param in self.buckets[k]])
+        self.__reset()
+
+    @contextmanager
+    def no_sync(self):
+        """ skip the all-reduce, e.g. in the backwards but the last of a gradient accumulation """
+        require_sync, self.require_sync = self.require_sync, False
+        try:
+            yield
+        finally:
+            self.require_sync = require_sync
 
     def weight_broadcast(self):
         for param in self.module.parameters():
@@ -63,10 +301,75 @@ class DistributedDataParallel(Module):
 
     def forward(self, *inputs, **kwargs):
         if self.first_call:
-            print("first broadcast start")
             self.weight_broadcast()
             self.first_call = False
-            print("first broadcast done")
-        self.needs_reduction = True
         return self.module(*inputs, **kwargs)
 
+
+def _benchmark_worker(rank, args):
+    import os
+    from asr.models.deepspeech_ctc.network import DeepSpeech
+
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group(backend=args.backend, rank=rank, world_size=args.world_size)
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(rank)
+
+    xs = torch.randn(args.batch_size, 6, 129, args.frames)
+    cap = args.bucket_cap_mb
+    settings = [("single bucket after backward", None, None), (f"{cap}MB buckets overlapped", cap, None)]
+    settings += [(f"{cap}MB buckets with {c}", cap, c) for c in args.compression]
+    results, exact = list(), None
+    for desc, bucket_cap_mb, compression in settings:
+        torch.manual_seed(0)
+        model = DistributedDataParallel(DeepSpeech(), bucket_cap_mb=bucket_cap_mb, sync_in_backward=False,
+                                        compression=compression, rank=args.powersgd_rank, ratio=args.topk_ratio)
+        optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=0.9)
+        elapsed = list()
+        for i in range(args.warmup + args.steps):
+            dist.barrier()
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            loss = model(xs).pow(2).mean()
+            loss.backward()
+            model.synchronize()
+            # the error of the averaged gradients against the exact ones of the first step
+            if i == 0:
+                grads = torch.cat([p.grad.view(-1) for p in model.parameters()])
+                if exact is None:
+                    exact = grads
+                grad_err = ((grads - exact).norm() / exact.norm()).item()
+            optimizer.step()
+            elapsed.append(time.perf_counter() - start)
+        loss = loss.detach()
+        dist.all_reduce(loss)
+        num_steps = args.warmup + args.steps
+        results.append((desc, sum(elapsed[args.warmup:]) / args.steps,
+                        model.compressor.bytes / num_steps / 1024 / 1024, grad_err, loss.item() / args.world_size))
+    if rank == 0:
+        for desc, t, mb, grad_err, loss in results:
+            print(f"{desc}: {t * 1000.:.1f} ms/step, {mb:.2f} MB/step sent, "
+                  f"relative gradient error {grad_err:.4f}, loss {loss:.4f} after {num_steps} steps")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    import torch.multiprocessing as mp
+
+    parser = argparse.ArgumentParser(description="multi-process benchmark of the bucketed all-reduce with DeepSpeech")
+    parser.add_argument('--world-size', default=2, type=int, help="number of processes")
+    parser.add_argument('--backend', default="gloo", type=str, help="distributed backend")
+    parser.add_argument('--port', default=29511, type=int, help="master port on localhost")
+    parser.add_argument('--threads', default=1, type=int, help="number of threads per process")
+    parser.add_argument('--batch-size', default=2, type=int, help="number of utterances per process")
+    parser.add_argument('--frames', default=100, type=int, help="number of frames per utterance")
+    parser.add_argument('--bucket-cap-mb', default=10, type=float, help="bucket size in MB")
+    parser.add_argument('--compression', default=["fp16", "powersgd", "topk"], type=str, nargs='*', help=f"gradient compressions to compare in {set(c for c in COMPRESSIONS if c)}")
+    parser.add_argument('--powersgd-rank', default=4, type=int, help="rank of the PowerSGD approximation")
+    parser.add_argument('--topk-ratio', default=0.01, type=float, help="ratio of the gradients sent by top-k")
+    parser.add_argument('--lr', default=1e-3, type=float, help="learning rate of the SGD steps")
+    parser.add_argument('--warmup', default=2, type=int, help="number of steps not timed")
+    parser.add_argument('--steps', default=5, type=int, help="number of steps timed")
+    args = parser.parse_args(sys.argv[1:])
+    mp.spawn(_benchmark_worker, args=(args,), nprocs=args.world_size)
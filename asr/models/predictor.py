@@ -6,31 +6,73 @@ import numpy as np
 import torch
 import torch.nn as nn
 
+from asr.utils.dataset import NonSplitTrainDataset, SplitTrainDataset, AudioSubset
+from asr.utils.dataloader import NonSplitTrainDataLoader, SplitTrainDataLoader
 from asr.utils.logger import logger
-from asr.utils.misc import onehot2int, remove_duplicates
+from asr.utils.misc import ctc_greedy_decode
+from asr.utils.inference import optimize_for_inference
+from asr.utils.quantize import quantize_model, save_quantized_model, load_quantized_model, load_states
 from asr.utils import params as p
 
-from asr.kaldi.latgen import LatGenCTCDecoder
+from asr.decoders import get_decoder, decoder_options
 
 
 class NonSplitPredictor:
+    """ quantize takes "dynamic" or "static" to run the model in int8 on cpu, where "static" is
+        calibrated on calibration_size utterances of calibration_manifest. a checkpoint saved
+        by save_quantized is loaded as quantized in its mode
+    """
+
+    calibration_dataset = NonSplitTrainDataset
+    calibration_loader = NonSplitTrainDataLoader
 
     def __init__(self, model, use_cuda=False, continue_from=None, verbose=False,
-                 *args, **kwargs):
+                 decoder_type="latgen", no_optimize=False, quantize=None, calibration_manifest=None,
+                 calibration_size=100, save_quantized=None, *args, **kwargs):
         assert continue_from is not None
         self.use_cuda = use_cuda
         self.verbose = verbose
 
+        # prepare decoder, kaldi latgen by default
+        self.decoder = get_decoder(decoder_type, **decoder_options(kwargs))
+
         # load from args
         self.model = model
         if self.use_cuda:
             logger.info("using cuda")
             self.model.cuda()
 
+        self.quantize = None
         self.load(continue_from)
-
-        # prepare kaldi latgen decoder
-        self.decoder = LatGenCTCDecoder()
+        if self.quantize is not None:
+            return
+        if not no_optimize or quantize is not None:
+            # batch norms folded into the convs and the linears, on the weights loaded
+            self.model = optimize_for_inference(self.model)
+        if quantize is not None:
+            assert not self.use_cuda, "the quantized model runs on cpu only"
+            calibration = None
+            if quantize == "static":
+                assert calibration_manifest is not None, "static quantization needs a calibration manifest"
+                calibration = self.calibration_batches(calibration_manifest, calibration_size)
+            logger.info(f"quantizing the model to int8 ({quantize})")
+            self.model = quantize_model(self.model, quantize, calibration)
+            self.quantize = quantize
+            if save_quantized is not None:
+                save_quantized_model(self.model, quantize, save_quantized)
+                logger.info(f"saved the quantized model to {save_quantized}")
+
+    def calibration_batches(self, manifest_file, num_utts):
+        """ the input batches of the utterances randomly picked from the manifest, without the
+            augmentation of the training
+        """
+        dataset = self.calibration_dataset(labeler=self.decoder.labeler, manifest_file=manifest_file,
+                                           tempo=False, pitch=False, noise_range=(-20, -20),
+                                           offset=False, padding=False)
+        dataset = AudioSubset(dataset, data_size=num_utts, max_len=20.)
+        # a batch of an utterance, not to calibrate on the padding
+        data_loader = self.calibration_loader(dataset, batch_size=1, shuffle=False)
+        return (data[0] for data in data_loader)
 
     def decode(self, data_loader):
         self.model.eval()
@@ -49,21 +91,30 @@ class NonSplitPredictor:
                     loglikes = loglikes.cpu()
                 words, alignment, w_sizes, a_sizes = self.decoder(loglikes, frame_lens)
                 # print results
+                symbols = self.greedy_symbols(loglikes, frame_lens)
                 loglikes = [l[:s] for l, s in zip(loglikes, frame_lens)]
                 words = [w[:s] for w, s in zip(words, w_sizes)]
-                for results in zip(filenames, loglikes, words):
+                for results in zip(filenames, loglikes, words, symbols):
                     self.print_result(*results)
-
-    def print_result(self, filename, loglikes, words):
+        # the workers of the ctc_beam decoder
+        if hasattr(self.decoder, "close"):
+            self.decoder.close()
+
+    def greedy_symbols(self, loglikes, frame_lens):
+        """ best path label symbols of the batch, only in the verbose mode """
+        if not self.verbose:
+            return [None] * len(frame_lens)
+        labels, label_lens = ctc_greedy_decode(loglikes, frame_lens, blank=0)
+        return [self.decoder.labeler.i2p[l.numpy()] for l in labels.split(label_lens.tolist())]
+
+    def print_result(self, filename, loglikes, words, symbols=None):
         logger.info(f"decoding wav file: {str(Path(filename).resolve())}")
         if self.verbose:
-            labels = onehot2int(loglikes).squeeze()
+            labels = loglikes.argmax(dim=-1)
             logger.info(f"labels: {' '.join([str(x) for x in labels.tolist()])}")
-            symbols = [self.decoder.labeler.idx2phone(x) for x in remove_duplicates(labels, blank=0)]
             logger.info(f"symbols: {' '.join(symbols)}")
-        words = words.squeeze()
-        text = ' '.join([self.decoder.labeler.idx2word(i) for i in words]) \
-               if words.dim() else '<null output from decoder>'
+        text = ' '.join(self.decoder.labeler.idx2words(words)) \
+               if words.numel() else '<null output from decoder>'
         logger.info(f"decoded text: {text}")
 
     def load(self, file_path):
@@ -74,12 +125,21 @@ class NonSplitPredictor:
             sys.exit(1)
         logger.info(f"loading the model from {file_path}")
         to_device = f"cuda:{torch.cuda.current_device()}" if self.use_cuda else "cpu"
-        states = torch.load(file_path, map_location=to_device)
-        self.model.load_state_dict(states["model"])
+        states = load_states(file_path, map_location=to_device)
+        if states.get("quantize", None) is not None:
+            assert not self.use_cuda, "the quantized model runs on cpu only"
+            self.model = load_quantized_model(self.model, states)
+            self.quantize = states["quantize"]
+            logger.info(f"loaded the model quantized to int8 ({self.quantize})")
+        else:
+            self.model.load_state_dict(states["model"])
 
 
 class SplitPredictor(NonSplitPredictor):
 
+    calibration_dataset = SplitTrainDataset
+    calibration_loader = SplitTrainDataLoader
+
     def decode(self, data_loader):
         self.model.eval()
         with torch.no_grad():
@@ -101,10 +161,14 @@ class SplitPredictor(NonSplitPredictor):
                     loglikes = loglikes.cpu()
                 words, alignment, w_sizes, a_sizes = self.decoder(loglikes, frame_lens)
                 # print results
+                symbols = self.greedy_symbols(loglikes, frame_lens)
                 loglikes = [l[:s] for l, s in zip(loglikes, frame_lens)]
                 words = [w[:s] for w, s in zip(words, w_sizes)]
-                for results in zip(filenames, loglikes, words):
+                for results in zip(filenames, loglikes, words, symbols):
                     self.print_result(*results)
+        # the workers of the ctc_beam decoder
+        if hasattr(self.decoder, "close"):
+            self.decoder.close()
 
 
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ from asr.utils.misc import Swish, InferenceBatchSoftmax
 
 class BasicBlock(nn.Module):
     expansion = 1
+    # the batch norms following the convs in the forward, to fold for the inference
+    INFERENCE_FOLDS = [("conv1", "bn1"), ("conv2", "bn2")]
 
     def __init__(self, inplanes, planes, stride=1, downsample=None):
         super(BasicBlock, self).__init__()
@@ -38,6 +40,7 @@ class BasicBlock(nn.Module):
 
 class Bottleneck(nn.Module):
     expansion = 2
+    INFERENCE_FOLDS = [("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")]
 
     def __init__(self, inplanes, planes, stride=1, downsample=None):
         super(Bottleneck, self).__init__()
@@ -10,8 +10,9 @@ from asr.utils.dataset import NonSplitPredictDataset
 from asr.utils.dataloader import NonSplitPredictDataLoader
 from asr.utils.logger import logger, set_logfile, version_log
 from asr.utils import params as p
+from asr.utils.quantize import QUANTIZE_MODES
 
-from asr.kaldi.latgen import LatGenCTCDecoder
+from asr.decoders import DECODER_TYPES
 
 from ..predictor import NonSplitPredictor
 from .network import resnet101
@@ -23,7 +24,13 @@ def predict(argv):
     parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
     parser.add_argument('--batch-size', default=8, type=int, help="number of simultaneous decoding")
     parser.add_argument('--log-dir', default='./logs_resnet_ctc', type=str, help="filename for logging the outputs")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
     parser.add_argument('--continue-from', type=str, help="model file path to make continued from")
+    parser.add_argument('--no-optimize', default=False, action='store_true', help="run the model as trained, without folding the batch norms for inference")
+    parser.add_argument('--quantize', default=None, type=str, choices=QUANTIZE_MODES, help="run the model in int8 on cpu, quantized dynamically or statically")
+    parser.add_argument('--calibration-manifest', default=None, type=str, help="manifest of the utterances to calibrate the static quantization on")
+    parser.add_argument('--calibration-size', default=100, type=int, help="number of utterances of the calibration manifest to use")
+    parser.add_argument('--save-quantized', default=None, type=str, help="file path to save the quantized model, to load by --continue-from")
     parser.add_argument('wav_files', type=str, nargs='+', help="list of wav_files for prediction")
     args = parser.parse_args(argv)
 
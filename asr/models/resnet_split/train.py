@@ -11,7 +11,7 @@ from asr.utils.dataset import SplitTrainDataset, AudioSubset
 from asr.utils.dataloader import SplitTrainDataLoader
 from asr.utils.logger import logger, set_logfile, version_log
 from asr.utils import params as p
-from asr.kaldi.latgen import LatGenCTCDecoder
+from asr.decoders import DECODER_TYPES
 
 from ..trainer import FRAME_REDUCE_FACTOR, OPTIMIZER_TYPES, set_seed, SplitTrainer
 from .network import resnet50, resnet101
@@ -31,8 +31,12 @@ def batch_train(argv):
     parser.add_argument('--tensorboard', default=False, action='store_true', help="use tensorboard logging")
     parser.add_argument('--seed', default=None, type=int, help="seed for controlling randomness in this example")
     parser.add_argument('--log-dir', default='./logs_resnet_split', type=str, help="filename for logging the outputs")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
     parser.add_argument('--model-prefix', default='resnet_split', type=str, help="model file prefix to store")
     parser.add_argument('--checkpoint', default=True, action='store_true', help="save checkpoint")
+    parser.add_argument('--keep-last', default=None, type=int, help="number of the latest epoch checkpoints to retain, all of them if not given")
+    parser.add_argument('--keep-best', default=3, type=int, help="number of the best epoch checkpoints by LER to retain with --keep-last")
+    parser.add_argument('--keep-ckpts', default=10, type=int, help="number of the latest mid-epoch checkpoints to retain")
     parser.add_argument('--continue-from', default=None, type=str, help="model file path to make continued from")
     parser.add_argument('--opt-type', default="sgdr", type=str, help=f"optimizer type in {OPTIMIZER_TYPES}")
 
@@ -109,8 +113,12 @@ def train(argv):
     parser.add_argument('--tensorboard', default=False, action='store_true', help="use tensorboard logging")
     parser.add_argument('--seed', default=None, type=int, help="seed for controlling randomness in this example")
     parser.add_argument('--log-dir', default='./logs_resnet_split', type=str, help="filename for logging the outputs")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
     parser.add_argument('--model-prefix', default='resnet_split', type=str, help="model file prefix to store")
     parser.add_argument('--checkpoint', default=True, action='store_true', help="save checkpoint")
+    parser.add_argument('--keep-last', default=None, type=int, help="number of the latest epoch checkpoints to retain, all of them if not given")
+    parser.add_argument('--keep-best', default=3, type=int, help="number of the best epoch checkpoints by LER to retain with --keep-last")
+    parser.add_argument('--keep-ckpts', default=10, type=int, help="number of the latest mid-epoch checkpoints to retain")
     parser.add_argument('--continue-from', default=None, type=str, help="model file path to make continued from")
     parser.add_argument('--opt-type', default="sgdr", type=str, help=f"optimizer type in {OPTIMIZER_TYPES}")
 
@@ -159,6 +167,7 @@ def test(argv):
     # optional
     parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
     parser.add_argument('--log-dir', default='./logs_resnet_split', type=str, help="filename for logging the outputs")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
     parser.add_argument('--continue-from', default=None, type=str, help="model file path to make continued from")
 
     args = parser.parse_args(argv)
@@ -10,7 +10,7 @@ from asr.utils.dataset import SplitPredictDataset
 from asr.utils.dataloader import SplitPredictDataLoader
 from asr.utils.logger import logger, set_logfile, version_log
 from asr.utils import params as p
-from asr.kaldi.latgen import LatGenCTCDecoder
+from asr.decoders import DECODER_TYPES
 
 from ..predictor import SplitPredictor
 from .network import resnet50, resnet101
@@ -22,6 +22,7 @@ def predict(argv):
     parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
     parser.add_argument('--batch-size', default=8, type=int, help="number of simultaneous decoding")
     parser.add_argument('--log-dir', default='./logs_resnet_ctc', type=str, help="filename for logging the outputs")
+    parser.add_argument('--decoder-type', default="latgen", type=str, help=f"decoder type in {set(DECODER_TYPES)}")
     parser.add_argument('--continue-from', type=str, help="model file path to make continued from")
     parser.add_argument('wav_files', type=str, nargs='+', help="list of wav_files for prediction")
 
@@ -1,6 +1,9 @@
 #!python
 import os
 import sys
+import random
+import inspect
+from contextlib import ExitStack
 from pathlib import Path
 from tqdm import tqdm
 import multiprocessing as mp
@@ -16,14 +19,19 @@ from apex.fp16_utils import *
 import torchvision.utils as tvu
 from warpctc_pytorch import CTCLoss
 import torchnet as tnt
-import Levenshtein as Lev
 
 from asr.utils.logger import logger
-from asr.utils.misc import onehot2int, remove_duplicates, get_model_file_path
+from asr.utils.misc import ctc_greedy_decode, clip_grad_norm_finite_, is_finite, get_model_file_path
+from asr.utils.edit_distance import edit_distance
 from asr.utils.lr_scheduler import CosineAnnealingWithRestartsLR
+from asr.utils.checkpoint import CheckpointWriter
+from asr.utils.profiler import StepTimer
 from asr.utils import params as p
 
-from asr.kaldi.latgen import LatGenCTCDecoder
+from asr.decoders import DECODER_TYPES, get_decoder, decoder_options
+from asr.decoders.posterior_cache import PosteriorWriter
+
+from .distributed import DistributedDataParallel
 
 
 OPTIMIZER_TYPES = set([
@@ -33,36 +41,105 @@ OPTIMIZER_TYPES = set([
 ])
 
 
-def init_distributed(use_cuda, backend="nccl", init="slurm"):
+def get_dist_env(init=None):
+    """ the rank, the world size and the local rank from the env vars of the launcher in init,
+        or of the first one found among the local launcher, SLURM and OpenMPI if None
+    """
+    envs = {
+        "local": ("RANK", "WORLD_SIZE", "LOCAL_RANK"),
+        "slurm": ("SLURM_PROCID", "SLURM_NTASKS", "SLURM_LOCALID"),
+        "ompi" : ("OMPI_COMM_WORLD_RANK", "OMPI_COMM_WORLD_SIZE", "OMPI_COMM_WORLD_LOCAL_RANK"),
+    }
+    if init is None:
+        init = next((k for k, v in envs.items() if v[0] in os.environ), None)
+        if init is None:
+            return None
+    elif init not in envs:
+        raise ValueError(f"unknown init {init}, choose one of {set(envs)}")
+    return tuple(int(os.environ[k]) for k in envs[init])
+
+
+def init_distributed(use_cuda, backend=None, init=None):
+    """ join the process group of the launcher in init, detected from the env vars if None,
+        or stay as a single process when there is no launcher or only one process.
+        the rendezvous is the DIST_INIT_METHOD url if set, e.g. the file of the local launcher,
+        or tcp://MASTER_ADDR:MASTER_PORT
+    """
+    if backend is None:
+        backend = "nccl" if use_cuda else "gloo"
     try:
         mp.set_start_method('spawn') # spawn, forkserver, and fork
     except RuntimeError:
         pass
 
-    try:
-        if init == "slurm":
-            rank = int(os.environ['SLURM_PROCID'])
-            world_size = int(os.environ['SLURM_NTASKS'])
-            local_rank = int(os.environ['SLURM_LOCALID'])
-            #maser_node = os.environ['SLURM_TOPOLOGY_ADDR']
-            #maser_port = '23456'
-        elif init == "ompi":
-            rank = int(os.environ['OMPI_COMM_WORLD_RANK'])
-            world_size = int(os.environ['OMPI_COMM_WORLD_SIZE'])
-            local_rank = int(os.environ['OMPI_COMM_WORLD_LOCAL_RANK'])
-
-        if use_cuda:
-            torch.cuda.set_device(local_rank)
-            print(f"set cuda device to cuda:{local_rank}")
-
-        master_node = os.environ["MASTER_ADDR"]
-        master_port = os.environ["MASTER_PORT"]
-        init_method = f"tcp://{master_node}:{master_port}"
-        #init_method = "env://"
-        dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
-        print(f"initialized as {rank}/{world_size} via {init_method}")
-    except:
+    env = get_dist_env(init)
+    if env is None or env[1] == 1:
         print(f"initialized as single process")
+        return
+    rank, world_size, local_rank = env
+
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        print(f"set cuda device to cuda:{local_rank}")
+
+    init_method = os.environ.get("DIST_INIT_METHOD")
+    if init_method is None:
+        try:
+            init_method = f"tcp://{os.environ['MASTER_ADDR']}:{os.environ['MASTER_PORT']}"
+        except KeyError as e:
+            raise RuntimeError(f"rank {rank}/{world_size} has no rendezvous: set DIST_INIT_METHOD, "
+                               f"or MASTER_ADDR and MASTER_PORT") from e
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+    print(f"initialized as {rank}/{world_size} via {init_method}")
+
+
+def get_core_sets(nproc):
+    """ split the cpu cores available to this process into nproc disjoint sets,
+        or share them round-robin if there are fewer cores than the processes
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if len(cores) < nproc:
+        return [[cores[i % len(cores)]] for i in range(nproc)]
+    return [c.tolist() for c in np.array_split(cores, nproc)]
+
+
+def _launch_worker(local_rank, fn, argv, nproc, core_sets, init_method):
+    cores = core_sets[local_rank]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    os.environ.update({
+        "RANK": str(local_rank),
+        "WORLD_SIZE": str(nproc),
+        "LOCAL_RANK": str(local_rank),
+        "DIST_INIT_METHOD": init_method,
+    })
+    fn(argv)
+
+
+def is_launched():
+    """ if this process is a worker of the local launcher """
+    return "LOCAL_RANK" in os.environ and "DIST_INIT_METHOD" in os.environ
+
+
+def launch(fn, argv, nproc):
+    """ run fn(argv) on nproc local worker processes, each pinned to a disjoint set of the cpu
+        cores with as many intra-op threads, that join a gloo (or nccl with --use-cuda) process
+        group in init_distributed. the rendezvous is a file store in a temp directory, or a tcp
+        store on MASTER_PORT of localhost if set. when a worker fails, the others are terminated
+    """
+    import tempfile
+    import torch.multiprocessing as torch_mp
+
+    core_sets = get_core_sets(nproc)
+    for i, cores in enumerate(core_sets):
+        print(f"worker {i} on the cpu cores {cores}")
+    with tempfile.TemporaryDirectory(prefix="asr_dist_") as tmp_dir:
+        if "MASTER_PORT" in os.environ:
+            init_method = f"tcp://127.0.0.1:{os.environ['MASTER_PORT']}"
+        else:
+            init_method = f"file://{tmp_dir}/rendezvous"
+        torch_mp.spawn(_launch_worker, args=(fn, argv, nproc, core_sets, init_method), nprocs=nproc)
 
 
 def is_distributed():
@@ -79,13 +156,75 @@ def get_rank():
         return None
 
 
+def all_reduce_sum(values, device=None):
+    """ sum the counters over the ranks, returns them as a list """
+    if not is_distributed():
+        return values
+    t = torch.DoubleTensor(values).to(device)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def all_gather_lines(lines, device=None):
+    """ gather the lists of text lines from all the ranks, in the order of the ranks """
+    if not is_distributed():
+        return lines
+    data = torch.ByteTensor(list("\n".join(lines).encode("utf-8")))
+    size = torch.LongTensor([data.numel()]).to(device)
+    sizes = [torch.zeros_like(size) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, size)
+    # all_gather takes the tensors of the same size
+    buf = torch.zeros(max(max(s.item() for s in sizes), 1), dtype=torch.uint8)
+    buf[:data.numel()] = data
+    buf = buf.to(device)
+    bufs = [torch.zeros_like(buf) for _ in range(dist.get_world_size())]
+    dist.all_gather(bufs, buf)
+    gathered = list()
+    for b, s in zip(bufs, sizes):
+        text = bytes(b[:s.item()].cpu().tolist()).decode("utf-8")
+        if text:
+            gathered.extend(text.split("\n"))
+    return gathered
+
+
 def set_seed(seed=None):
     if seed is not None:
         logger.info(f"set random seed to {seed}")
+        random.seed(seed)
         torch.manual_seed(seed)
         np.random.seed(seed)
-        if args.use_cuda:
-            torch.cuda.manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed_all(seed)
+
+
+def get_rng_state(use_cuda=False):
+    """ the states of all the random generators used in the training, held in tensors and numbers
+        so that the checkpoints are loaded by torch.load with the weights only
+    """
+    version, internal, gauss = random.getstate()
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    return {
+        "python": { "version": version, "state": torch.LongTensor(internal), "gauss": gauss },
+        "numpy": { "name": name, "keys": torch.from_numpy(keys.astype(np.int64)), "pos": int(pos),
+                   "has_gauss": int(has_gauss), "cached": float(cached) },
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if use_cuda else None,
+    }
+
+
+def set_rng_state(states):
+    s = states["python"]
+    # the checkpoints of the earlier versions have the states as they are
+    if isinstance(s, dict):
+        s = (s["version"], tuple(s["state"].tolist()), s["gauss"])
+    random.setstate(s)
+    s = states["numpy"]
+    if isinstance(s, dict):
+        s = (s["name"], s["keys"].numpy().astype(np.uint32), s["pos"], s["has_gauss"], s["cached"])
+    np.random.set_state(s)
+    torch.set_rng_state(states["torch"])
+    if states["cuda"] is not None:
+        torch.cuda.set_rng_state_all(states["cuda"])
 
 
 class Trainer:
@@ -93,7 +232,8 @@ class Trainer:
     def __init__(self, model, init_lr=1e-4, max_norm=400, use_cuda=False,
                  fp16=False, log_dir='logs', model_prefix='model',
                  checkpoint=False, continue_from=None, opt_type="sgdr",
-                 *args, **kwargs):
+                 decoder_type="latgen", keep_last=None, keep_best=3, keep_ckpts=10, profile_sync=False, log_interval=20,
+                 accum_steps=1, grad_compression=None, padded_rnn=False, *args, **kwargs):
         if fp16:
             if not use_cuda:
                 raise RuntimeError
@@ -106,15 +246,31 @@ class Trainer:
         self.log_dir = log_dir
         self.model_prefix = model_prefix
         self.checkpoint = checkpoint
+        self.log_interval = log_interval
+        self.accum_steps = accum_steps
         self.epoch = 0
 
+        # checkpoints written in background, all the epoch ones or the last ones and the best ones
+        # by LER are retained, with the last mid-epoch ones
+        self.ckpt_writer = CheckpointWriter(keep_last=keep_last, keep_best=keep_best, keep_ckpts=keep_ckpts)
+        self.last_epoch_ckpt = None
+        # the progress of the epoch to resume from a mid-epoch checkpoint
+        self.resume_state = None
+        # timings of the training steps, reported at every checkpoint interval
+        self.timer = StepTimer(sync=profile_sync)
+
         # prepare visdom
         if logger.visdom is not None:
             logger.visdom.add_plot(title=f'train', xlabel='epoch', ylabel='loss')
             logger.visdom.add_plot(title=f'validate', xlabel='epoch', ylabel='LER')
+            logger.visdom.add_plot(title=f'step time', xlabel='epoch', ylabel='p50 ms')
+            logger.visdom.add_plot(title=f'throughput', xlabel='epoch', ylabel='samples/sec')
 
         # setup model
         self.model = model
+        # the models taking the frame lengths skip the padded frames, unless padded_rnn
+        self.pass_frame_lens = (not padded_rnn and not fp16 and
+                                "frame_lens" in inspect.signature(model.forward).parameters)
         if self.use_cuda:
             logger.debug("using cuda")
             self.model.cuda()
@@ -141,7 +297,7 @@ class Trainer:
             self.lr_scheduler = None
 
         # setup decoder for test
-        self.decoder = LatGenCTCDecoder()
+        self.decoder = get_decoder(decoder_type, **decoder_options(kwargs))
 
         # load from pre-trained model if needed
         if continue_from is not None:
@@ -153,7 +309,7 @@ class Trainer:
             self.optimizer = FP16_Optimizer(self.optimizer, static_loss_scale=128.)
 
         if is_distributed():
-            if self.use_cuda:
+            if self.use_cuda and grad_compression is None:
                 local_rank = torch.cuda.current_device()
                 if fp16:
                     self.model = apex.parallel.DistributedDataParallel(self.model)
@@ -162,47 +318,126 @@ class Trainer:
                                                                      device_ids=[local_rank],
                                                                      output_device=local_rank)
             else:
-                self.model = nn.parallel.DistributedDataParallel(self.model)
+                # bucketed all-reduce overlapped with backward, waited for in optimize()
+                self.model = DistributedDataParallel(self.model, sync_in_backward=False,
+                                                     compression=grad_compression)
 
 
     def __get_model_name(self, desc):
         return str(get_model_file_path(self.log_dir, self.model_prefix, desc))
 
-    def __remove_ckpt_files(self, epoch):
-        for ckpt in Path(self.log_dir).rglob(f"*_epoch_{epoch:03d}_ckpt_*"):
-            ckpt.unlink()
-
     def unit_train(self, data):
         raise NotImplementedError
 
-    def train_epoch(self, data_loader):
+    def optimize(self, loss):
+        """ backward the loss of a micro-batch, and clip and step the optimizer at the last one
+            of the accumulation window. the loss is averaged over the window, so that the gradient
+            and the lr keep their scales while the effective batch grows accum_steps times
+        """
+        finite = is_finite(loss.detach())
+        if self.accum_first:
+            self.optimizer.zero_grad()
+            self.accum_finite = finite
+        else:
+            self.accum_finite = self.accum_finite & finite
+        if self.accum_size > 1:
+            loss = loss / self.accum_size
+        # all-reduce the gradients only at the last micro-batch
+        with (self.model.no_sync() if not self.accum_last and hasattr(self.model, "no_sync") else ExitStack()):
+            if self.fp16:
+                self.optimizer.backward(loss)
+            else:
+                loss.backward()
+        self.timer.mark("backward")
+        if not self.accum_last:
+            return
+        if hasattr(self.model, "synchronize"):
+            self.model.synchronize()
+        if self.fp16:
+            # the optimizer skips the steps of the overflowed gradients by itself
+            self.optimizer.clip_master_grads(self.max_norm)
+        else:
+            # zero the gradients of a non-finite loss on the device, and check it on the host only
+            # once per step, to skip the step moving the params by the momentum and the weight decay
+            _, finite = clip_grad_norm_finite_(self.model.parameters(), self.max_norm, finite=self.accum_finite)
+            if not bool(finite):
+                self.timer.mark("clip")
+                logger.debug("skipped the optimizer step of non-finite gradients")
+                return
+        self.timer.mark("clip")
+        self.optimizer.step()
+        self.timer.mark("step")
+
+    def train_epoch(self, data_loader, accum_steps=None):
+        "train an epoch, accumulating the gradients over accum_steps batches if given"
         self.model.train()
-        num_ckpt = int(np.ceil(len(data_loader) / 10))
-        meter_loss = tnt.meter.MovingAverageValueMeter(len(data_loader) // 100 + 1)
+        accum_steps = self.accum_steps if accum_steps is None else accum_steps
+        sampler = data_loader.sampler
+        if getattr(sampler, "seed", 0) is None:
+            sampler.seed = self.__shuffle_seed()
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(self.epoch)
+        resume, self.resume_state = self.resume_state, None
+        if resume is not None and not hasattr(sampler, "load_state_dict"):
+            logger.warning(f"the sampler can't start in the middle of the epoch, restarting epoch {self.epoch:03d}")
+            resume = None
+
+        # fast-forward the sampler to the position of the checkpoint, without loading the skipped batches
+        start = 0
+        if resume is not None:
+            sampler.load_state_dict(resume["sampler"])
+            start = resume["batch"]
+            logger.info(f"resuming epoch {self.epoch:03d} from batch {start}")
+        num_batches = start + len(data_loader)
+        num_ckpt = int(np.ceil(num_batches / 10))
+        meter_loss = tnt.meter.MovingAverageValueMeter(num_batches // 100 + 1)
         #meter_accuracy = tnt.meter.ClassErrorMeter(accuracy=True)
         #meter_confusion = tnt.meter.ConfusionMeter(p.NUM_CTC_LABELS, normalized=True)
-        if self.lr_scheduler is not None:
+        if resume is not None:
+            # the lr_scheduler loaded has stepped for this epoch already
+            meter_loss.__dict__.update(resume["meter_loss"])
+        elif self.lr_scheduler is not None:
             self.lr_scheduler.step()
             logger.debug(f"current lr = {self.lr_scheduler.get_lr()}")
-        if is_distributed() and data_loader.sampler is not None:
-            data_loader.sampler.set_epoch(self.epoch)
+
+        # the loader iterator draws the seeds of its workers at the start of the epoch
+        if resume is not None:
+            set_rng_state(resume["epoch_rng"])
+        epoch_rng = get_rng_state(self.use_cuda)
+        batches = iter(data_loader)
+        if resume is not None:
+            set_rng_state(resume["rng"])
 
         # count the number of supervised batches seen in this epoch
-        t = tqdm(enumerate(data_loader), total=len(data_loader), desc="training")
+        t = tqdm(enumerate(batches, start), total=num_batches, initial=start, desc="training")
+        self.timer.begin()
+        losses = list()
         for i, (data) in t:
-            loss_value = self.unit_train(data)
-            meter_loss.add(loss_value)
-            t.set_description(f"training (loss: {meter_loss.value()[0]:.3f})")
-            t.refresh()
+            self.timer.mark("data")
+            # the accumulation windows restart at the epoch start or the resumed position
+            self.accum_first = (i - start) % accum_steps == 0
+            self.accum_last = (i - start + 1) % accum_steps == 0 or i == num_batches - 1
+            # the last window of the epoch can be shorter, and is averaged over its own batches
+            self.accum_size = min(accum_steps, num_batches - (i - (i - start) % accum_steps))
+            # the losses stay on the device until every log_interval steps or the checkpoint
+            losses.append(self.unit_train(data))
+            is_ckpt = 0 < i < num_batches and i % num_ckpt == 0
+            if is_ckpt or len(losses) >= self.log_interval:
+                self.__add_losses(meter_loss, losses)
+                t.set_description(f"training (loss: {meter_loss.value()[0]:.3f})")
             #self.meter_accuracy.add(ys_int, ys)
             #self.meter_confusion.add(ys_int, ys)
 
-            if 0 < i < len(data_loader) and i % num_ckpt == 0:
+            if is_ckpt:
+                timings = self.timer.report()
+                logger.info(f"timings at epoch_{self.epoch:03d}_ckpt_{i:07d}: {self.timer.describe(timings)}")
                 if not is_distributed() or (is_distributed() and dist.get_rank() == 0):
                     title = "train"
-                    x = self.epoch + i / len(data_loader)
+                    x = self.epoch + i / num_batches
                     if logger.visdom is not None:
                         logger.visdom.add_point(title=title, x=x, y=meter_loss.value()[0])
+                        logger.visdom.add_point(title="step time", x=x, y=timings["total_p50"])
+                        logger.visdom.add_point(title="throughput", x=x, y=timings["samples_per_sec"])
                     if logger.tensorboard is not None:
                         logger.tensorboard.add_graph(self.model, xs)
                         xs_img = tvu.make_grid(xs[0, 0], normalize=True, scale_each=True)
@@ -210,29 +445,60 @@ class Trainer:
                         ys_hat_img = tvu.make_grid(ys_hat[0].transpose(0, 1), normalize=True, scale_each=True)
                         logger.tensorboard.add_image('ys_hat', x, ys_hat_img)
                         logger.tensorboard.add_scalars(title, x, { 'loss': meter_loss.value()[0], })
+                        logger.tensorboard.add_scalars("timings", x, timings)
                 if self.checkpoint:
                     logger.info(f"training loss at epoch_{self.epoch:03d}_ckpt_{i:07d}: "
                                 f"{meter_loss.value()[0]:5.3f}")
                     if not is_distributed() or (is_distributed() and dist.get_rank() == 0):
-                        self.save(self.__get_model_name(f"epoch_{self.epoch:03d}_ckpt_{i:07d}"))
+                        train_state = {
+                            "batch": i + 1,
+                            "sampler": self.__sampler_state(sampler, (i + 1) * data_loader.batch_size),
+                            "meter_loss": dict(vars(meter_loss)),
+                            "epoch_rng": epoch_rng,
+                            "rng": get_rng_state(self.use_cuda),
+                        }
+                        self.save(self.__get_model_name(f"epoch_{self.epoch:03d}_ckpt_{i:07d}"),
+                                  mid_epoch=True, train_state=train_state)
             #input("press key to continue")
+            self.timer.mark("log")
+            self.timer.step(num_samples=len(data[4]), num_frames=int(data[2].sum()))
+        self.__add_losses(meter_loss, losses)
 
         self.epoch += 1
         logger.info(f"epoch {self.epoch:03d}: "
                     f"training loss {meter_loss.value()[0]:5.3f} ")
                     #f"training accuracy {meter_accuracy.value()[0]:6.3f}")
         if not is_distributed() or (is_distributed() and dist.get_rank() == 0):
-            self.save(self.__get_model_name(f"epoch_{self.epoch:03d}"))
-            self.__remove_ckpt_files(self.epoch-1)
+            self.last_epoch_ckpt = self.__get_model_name(f"epoch_{self.epoch:03d}")
+            self.save(self.last_epoch_ckpt)
+
+    def __add_losses(self, meter_loss, losses):
+        "materialize the losses in a single transfer and add them to the meter"
+        if not losses:
+            return
+        values = torch.stack(losses).float().cpu()
+        num_skipped = int((~is_finite(values)).sum())
+        if num_skipped > 0:
+            logger.warning(f"skipped {num_skipped} steps of non-finite loss, setting their loss values to 0")
+        for v in torch.where(is_finite(values), values, torch.zeros_like(values)).tolist():
+            meter_loss.add(v)
+        del losses[:]
+
+    def __sampler_state(self, sampler, position):
+        if not hasattr(sampler, "state_dict"):
+            return None
+        state = sampler.state_dict()
+        state["start"] = position
+        return state
 
     def unit_validate(self, data):
         raise NotImplementedError
 
-    def validate(self, data_loader):
+    def validate(self, data_loader, hyp_file=None):
         "validate with label error rate by the edit distance between hyps and refs"
         self.model.eval()
         with torch.no_grad():
-            N, D = 0, 0
+            N, D, lines = 0, 0, list()
             t = tqdm(enumerate(data_loader), total=len(data_loader), desc="validating")
             for i, (data) in t:
                 hyps, refs = self.unit_validate(data)
@@ -242,11 +508,21 @@ class Trainer:
                 ler = N * 100. / D
                 t.set_description(f"validating (LER: {ler:.2f} %)")
                 t.refresh()
+                if hyp_file is not None:
+                    i2p = self.decoder.labeler.idx2phone
+                    lines.extend(f"{f} {' '.join(i2p(int(x)) for x in h)}" for f, h in zip(data[4], hyps))
+            # the shards of the ranks
+            N, D = all_reduce_sum([N, D], device=self.__dist_device())
+            ler = N * 100. / D
             logger.info(f"validating at epoch {self.epoch:03d}: LER {ler:.2f} %")
+            if self.last_epoch_ckpt is not None:
+                self.ckpt_writer.set_metric(self.last_epoch_ckpt, ler)
+            if hyp_file is not None:
+                self.__dump_hyps(hyp_file, lines)
 
             if not is_distributed() or (is_distributed() and dist.get_rank() == 0):
                 title = f"validate"
-                x = self.epoch - 1 + i / len(data_loader)
+                x = self.epoch
                 if logger.visdom is not None:
                     logger.visdom.add_point(title=title, x=x, y=ler)
                 if logger.tensorboard is not None:
@@ -255,11 +531,11 @@ class Trainer:
     def unit_test(self, data):
         raise NotImplementedError
 
-    def test(self, data_loader):
+    def test(self, data_loader, hyp_file=None):
         "test with word error rate by the edit distance between hyps and refs"
         self.model.eval()
         with torch.no_grad():
-            N, D = 0, 0
+            N, D, lines = 0, 0, list()
             t = tqdm(enumerate(data_loader), total=len(data_loader), desc="testing")
             for i, (data) in t:
                 hyps, refs = self.unit_test(data)
@@ -269,19 +545,69 @@ class Trainer:
                 wer = N * 100. / D
                 t.set_description(f"testing (WER: {wer:.2f} %)")
                 t.refresh()
+                if hyp_file is not None:
+                    i2w = self.decoder.labeler.idx2words
+                    lines.extend(f"{f} {' '.join(i2w(h))}" for f, h in zip(data[4], hyps))
+            # the shards of the ranks
+            N, D = all_reduce_sum([N, D], device=self.__dist_device())
+            wer = N * 100. / D
             logger.info(f"testing at epoch {self.epoch:03d}: WER {wer:.2f} %")
+            if hyp_file is not None:
+                self.__dump_hyps(hyp_file, lines)
+
+    def __shuffle_seed(self):
+        "a seed of the shuffling drawn from the torch rng seeded by set_seed, that of rank 0 over the ranks"
+        seed = torch.LongTensor(1).random_(0, 2 ** 31 - 1)
+        if is_distributed():
+            seed = seed.to(self.__dist_device())
+            dist.broadcast(seed, 0)
+        return int(seed.item())
+
+    def __dist_device(self):
+        # nccl reduces the cuda tensors only
+        return torch.device("cuda") if self.use_cuda else torch.device("cpu")
+
+    def __dump_hyps(self, hyp_file, lines):
+        lines = all_gather_lines(lines, device=self.__dist_device())
+        if not is_distributed() or (is_distributed() and dist.get_rank() == 0):
+            Path(hyp_file).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            with open(hyp_file, "w") as f:
+                f.writelines(f"{l}\n" for l in sorted(lines))
+            logger.info(f"wrote the hypotheses of {len(lines)} utterances to {hyp_file}")
+
+    @property
+    def eval_model(self):
+        """ the model without the DistributedDataParallel wrapper, whose forward syncs the buffers
+            over the ranks, since the evaluation shards can have different numbers of batches
+        """
+        return self.model.module if is_distributed() else self.model
+
+    def unit_posterior(self, data):
+        raise NotImplementedError
+
+    def dump_posteriors(self, data_loader, cache_path, top_k=None):
+        "store the log-posteriors of the model to a cache for decode-only tuning"
+        self.model.eval()
+        if is_distributed():
+            # every rank dumps its own shard, which PosteriorCache reads together
+            cache_path = Path(cache_path).joinpath(f"rank_{get_rank():02d}")
+        num_labels = self.decoder.labeler.get_num_labels()
+        with torch.no_grad(), PosteriorWriter(cache_path, num_labels, top_k=top_k) as writer:
+            for data in tqdm(data_loader, total=len(data_loader), desc="dumping"):
+                loglikes, frame_lens, filenames, texts = self.unit_posterior(data)
+                for l, s, f, t in zip(loglikes, frame_lens, filenames, texts):
+                    writer.add(f, l[:s], t)
+            logger.info(f"dumped posteriors of {len(writer.utts)} utterances to {cache_path}")
 
     def edit_distance(self, refs, hyps):
+        "total edit distance of the batch, computed at once over the padded sequences"
         assert len(refs) == len(hyps)
-        n = 0
-        for ref, hyp in zip(refs, hyps):
-            r = [chr(c) for c in ref]
-            h = [chr(c) for c in hyp]
-            n += Lev.distance(''.join(r), ''.join(h))
-        return n
-
-    def save(self, file_path, **kwargs):
-        Path(file_path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        if not refs:
+            return 0
+        return int(edit_distance(refs, hyps).sum())
+
+    def save(self, file_path, mid_epoch=False, **kwargs):
+        "snapshot the states to the cpu memory and write them in background"
         logger.info(f"saving the model to {file_path}")
         states = kwargs
         states["epoch"] = self.epoch
@@ -294,7 +620,7 @@ class Trainer:
             states["model"] = self.model.state_dict()
         states["optimizer"] = self.optimizer.state_dict()
         states["lr_scheduler"] = self.lr_scheduler.state_dict()
-        torch.save(states, file_path)
+        self.ckpt_writer.save(states, file_path, mid_epoch=mid_epoch)
 
     def load(self, file_path):
         if isinstance(file_path, str):
@@ -303,45 +629,46 @@ class Trainer:
             logger.error(f"no such file {file_path} exists")
             sys.exit(1)
         logger.info(f"loading the model from {file_path}")
+        self.ckpt_writer.wait()
         to_device = f"cuda:{torch.cuda.current_device()}" if self.use_cuda else "cpu"
         states = torch.load(file_path, map_location=to_device)
         self.epoch = states["epoch"]
         self.model.load_state_dict(states["model"])
         self.optimizer.load_state_dict(states["optimizer"])
         self.lr_scheduler.load_state_dict(states["lr_scheduler"])
+        # mid-epoch checkpoints carry the progress of the epoch
+        self.resume_state = states.get("train_state", None)
+        if self.resume_state is not None and self.resume_state["sampler"] is None:
+            self.resume_state = None
 
 
 class NonSplitTrainer(Trainer):
     """training model for overall utterance spectrogram as a single image"""
 
+    def forward(self, model, xs, frame_lens):
+        if self.pass_frame_lens:
+            return model(xs, frame_lens=frame_lens)
+        return model(xs)
+
     def unit_train(self, data):
         xs, ys, frame_lens, label_lens, filenames, _ = data
         try:
             if self.use_cuda:
                 xs = xs.cuda(non_blocking=True)
-            ys_hat = self.model(xs)
+            self.timer.mark("h2d")
+            ys_hat = self.forward(self.model, xs, frame_lens)
             if self.fp16:
                 ys_hat = ys_hat.float()
             ys_hat = ys_hat.transpose(0, 1).contiguous()  # TxNxH
+            self.timer.mark("forward")
             #frame_lens = torch.ceil(frame_lens.float() / FRAME_REDUCE_FACTOR).int()
             #torch.set_printoptions(threshold=5000000)
             #print(ys_hat.shape, frame_lens, ys.shape, label_lens)
             #print(onehot2int(ys_hat).squeeze(), ys)
             loss = self.loss(ys_hat, ys, frame_lens, label_lens)
-            loss_value = loss.item()
-            inf = float("inf")
-            if loss_value == inf or loss_value == -inf:
-                logger.warning("received an inf loss, setting loss value to 0")
-                loss_value = 0
-            self.optimizer.zero_grad()
-            if self.fp16:
-                self.optimizer.backward(loss)
-                self.optimizer.clip_master_grads(self.max_norm)
-            else:
-                loss.backward()
-                nn.utils.clip_grad_norm_(self.model.parameters(), self.max_norm)
-            self.optimizer.step()
-            torch.cuda.synchronize()
+            self.timer.mark("loss")
+            self.optimize(loss)
+            loss_value = loss.detach()
             del loss
             return loss_value
         except Exception as e:
@@ -354,30 +681,34 @@ class NonSplitTrainer(Trainer):
         xs, ys, frame_lens, label_lens, filenames, _ = data
         if self.use_cuda:
             xs = xs.cuda(non_blocking=True)
-        ys_hat = self.model(xs)
+        ys_hat = self.forward(self.eval_model, xs, frame_lens)
         if self.fp16:
             ys_hat = ys_hat.float()
         # convert likes to ctc labels
         #frame_lens = torch.ceil(frame_lens.float() / FRAME_REDUCE_FACTOR).int()
-        hyps = [onehot2int(yh[:s]).squeeze() for yh, s in zip(ys_hat, frame_lens)]
-        hyps = [remove_duplicates(h, blank=0) for h in hyps]
+        labels, hyp_lens = ctc_greedy_decode(ys_hat, frame_lens, blank=0)
+        hyps = labels.cpu().split(hyp_lens.tolist())
         # slice the targets
         pos = torch.cat((torch.zeros((1, ), dtype=torch.long), torch.cumsum(label_lens, dim=0)))
         refs = [ys[s:l] for s, l in zip(pos[:-1], pos[1:])]
         return hyps, refs
 
-    def unit_test(self, data):
+    def unit_posterior(self, data):
         xs, ys, frame_lens, label_lens, filenames, texts = data
         if self.use_cuda:
             xs = xs.cuda(non_blocking=True)
-        ys_hat = self.model(xs)
+        ys_hat = self.forward(self.eval_model, xs, frame_lens)
         if self.fp16:
             ys_hat = ys_hat.float()
         #frame_lens = torch.ceil(frame_lens.float() / FRAME_REDUCE_FACTOR).int()
-        # latgen decoding
         loglikes = torch.log(ys_hat)
         if self.use_cuda:
             loglikes = loglikes.cpu()
+        return loglikes, frame_lens, filenames, texts
+
+    def unit_test(self, data):
+        loglikes, frame_lens, filenames, texts = self.unit_posterior(data)
+        # latgen decoding
         words, alignment, w_sizes, a_sizes = self.decoder(loglikes, frame_lens)
         hyps = [w[:s] for w, s in zip(words, w_sizes)]
         # convert target texts to word indices
@@ -396,6 +727,7 @@ class SplitTrainer(Trainer):
         try:
             if self.use_cuda:
                 xs = xs.cuda(non_blocking=True)
+            self.timer.mark("h2d")
             ys_hat = self.model(xs)
             if self.fp16:
                 ys_hat = ys_hat.float()
@@ -405,20 +737,11 @@ class SplitTrainer(Trainer):
             max_len = torch.max(frame_lens)
             ys_hats = [nn.ConstantPad1d((0, max_len-yh.size(2)), 0)(yh) for yh in ys_hats]
             ys_hat = torch.cat(ys_hats).transpose(1, 2).transpose(0, 1)
+            self.timer.mark("forward")
             loss = self.loss(ys_hat, ys, frame_lens, label_lens)
-            loss_value = loss.item()
-            inf = float("inf")
-            if loss_value == inf or loss_value == -inf:
-                logger.warning("received an inf loss, setting loss value to 0")
-                loss_value = 0
-            self.optimizer.zero_grad()
-            if self.fp16:
-                self.optimizer.backward(loss)
-                self.optimizer.clip_master_grads(self.max_norm)
-            else:
-                loss.backward()
-                nn.utils.clip_grad_norm_(self.model.parameters(), self.max_norm)
-            self.optimizer.step()
+            self.timer.mark("loss")
+            self.optimize(loss)
+            loss_value = loss.detach()
             del loss
         except Exception as e:
             print(filenames, frame_lens, label_lens)
@@ -429,24 +752,23 @@ class SplitTrainer(Trainer):
         xs, ys, frame_lens, label_lens, filenames, _ = data
         if self.use_cuda:
             xs = xs.cuda(non_blocking=True)
-        ys_hat = self.model(xs)
+        ys_hat = self.eval_model(xs)
         if self.fp16:
             ys_hat = ys_hat.float()
-        pos = torch.cat((torch.zeros((1, ), dtype=torch.long), torch.cumsum(frame_lens, dim=0)))
-        ys_hat = [ys_hat.narrow(0, p, l).clone() for p, l in zip(pos[:-1], frame_lens)]
+        ys_hat = nn.utils.rnn.pad_sequence(ys_hat.split(frame_lens.tolist()), batch_first=True)
         # convert likes to ctc labels
-        hyps = [onehot2int(yh[:s]).squeeze() for yh, s in zip(ys_hat, frame_lens)]
-        hyps = [remove_duplicates(h, blank=0) for h in hyps]
+        labels, hyp_lens = ctc_greedy_decode(ys_hat, frame_lens, blank=0)
+        hyps = labels.cpu().split(hyp_lens.tolist())
         # slice the targets
         pos = torch.cat((torch.zeros((1, ), dtype=torch.long), torch.cumsum(label_lens, dim=0)))
         refs = [ys[s:l] for s, l in zip(pos[:-1], pos[1:])]
         return hyps, refs
 
-    def unit_test(self, data):
+    def unit_posterior(self, data):
         xs, ys, frame_lens, label_lens, filenames, texts = data
         if self.use_cuda:
             xs = xs.cuda(non_blocking=True)
-        ys_hat = self.model(xs)
+        ys_hat = self.eval_model(xs)
         if self.fp16:
             ys_hat = ys_hat.float()
         ys_hat = ys_hat.unsqueeze(dim=0).transpose(1, 2)
@@ -455,10 +777,14 @@ class SplitTrainer(Trainer):
         max_len = torch.max(frame_lens)
         ys_hats = [nn.ConstantPad1d((0, max_len-yh.size(2)), 0)(yh) for yh in ys_hats]
         ys_hat = torch.cat(ys_hats).transpose(1, 2)
-        # latgen decoding
         loglikes = torch.log(ys_hat)
         if self.use_cuda:
             loglikes = loglikes.cpu()
+        return loglikes, frame_lens, filenames, texts
+
+    def unit_test(self, data):
+        loglikes, frame_lens, filenames, texts = self.unit_posterior(data)
+        # latgen decoding
         words, alignment, w_sizes, a_sizes = self.decoder(loglikes, frame_lens)
         hyps = [w[:s] for w, s in zip(words, w_sizes)]
         # convert target texts to word indices
@@ -0,0 +1,137 @@
+#!python
+import os
+import threading
+from pathlib import Path
+
+import torch
+
+from .logger import logger
+
+
+def to_cpu(obj):
+    """ snapshot the tensors in the nested dicts, lists and tuples to the cpu memory,
+        copying the cpu tensors too since the training keeps updating them in place
+    """
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    if isinstance(obj, dict):
+        copied = type(obj)((k, to_cpu(v)) for k, v in obj.items())
+        # the versions of the modules in the state_dicts
+        if hasattr(obj, "_metadata"):
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """ writes the checkpoints on a background thread from their snapshots in the cpu memory,
+        so that the training only blocks when the previous write is still in flight
+
+        the files are written to a temporary file and renamed atomically. the mid-epoch checkpoints
+        and the epoch ones are retained separately: among the epoch checkpoints written, the last
+        keep_last ones and the keep_best ones of the lowest metric are retained, and all of them
+        are if keep_last is None. the last keep_ckpts mid-epoch checkpoints are retained, and all
+        of them are if keep_ckpts is None
+    """
+
+    def __init__(self, keep_last=None, keep_best=0, keep_ckpts=None):
+        assert keep_last is None or keep_last > 0
+        assert keep_ckpts is None or keep_ckpts >= 0
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_ckpts = keep_ckpts
+        self.saved = list()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+
+    def save(self, states, file_path, mid_epoch=False):
+        file_path = str(file_path)
+        self.wait()
+        states = to_cpu(states)
+        with self._lock:
+            self.saved = [c for c in self.saved if c["path"] != file_path]
+            self.saved.append({ "path": file_path, "metric": None, "written": False, "mid_epoch": mid_epoch })
+        # not a daemon, so that the interpreter finishes the write before exiting
+        self._thread = threading.Thread(target=self.__write, args=(states, file_path),
+                                        name="checkpoint-writer")
+        self._thread.start()
+
+    def wait(self):
+        """ block until the write in flight is done, and raise its error if any """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def set_metric(self, file_path, metric):
+        """ score a checkpoint written, e.g. by the LER of its validation, for keep_best """
+        file_path = str(file_path)
+        with self._lock:
+            found = False
+            for c in self.saved:
+                if c["path"] == file_path:
+                    c["metric"], found = metric, True
+        if found:
+            self.__retain()
+
+    def __write(self, states, file_path):
+        tmp_path = f"{file_path}.tmp"
+        try:
+            Path(file_path).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            torch.save(states, tmp_path)
+            os.replace(tmp_path, file_path)
+        except Exception as e:
+            logger.error(f"failed to write the checkpoint {file_path}: {e}")
+            self._error = e
+            return
+        with self._lock:
+            for c in self.saved:
+                if c["path"] == file_path:
+                    c["written"] = True
+        self.__retain()
+
+    def __retain(self):
+        with self._lock:
+            written = [c for c in self.saved if c["written"]]
+            epochs = [c for c in written if not c["mid_epoch"]]
+            ckpts = [c for c in written if c["mid_epoch"]]
+            keep = set()
+            if self.keep_last is None:
+                keep.update(c["path"] for c in epochs)
+            else:
+                keep.update(c["path"] for c in epochs[-self.keep_last:])
+                scored = sorted((c for c in epochs if c["metric"] is not None), key=lambda c: c["metric"])
+                keep.update(c["path"] for c in scored[:self.keep_best])
+            if self.keep_ckpts is None:
+                keep.update(c["path"] for c in ckpts)
+            elif self.keep_ckpts > 0:
+                keep.update(c["path"] for c in ckpts[-self.keep_ckpts:])
+            removes = [c for c in written if c["path"] not in keep]
+            self.saved = [c for c in self.saved if c["path"] in keep or not c["written"]]
+        for c in removes:
+            try:
+                Path(c["path"]).unlink()
+                logger.debug(f"removed the checkpoint {c['path']}")
+            except FileNotFoundError:
+                pass
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writer = CheckpointWriter(keep_last=2, keep_best=1, keep_ckpts=1)
+        for epoch, ler in enumerate([30., 20., 25., 28.]):
+            for ckpt in range(2):
+                file_path = Path(tmp_dir, f"model_epoch_{epoch:03d}_ckpt_{ckpt:07d}.pth.tar")
+                writer.save({ "epoch": epoch, "model": torch.randn(4, 4) }, file_path, mid_epoch=True)
+            file_path = Path(tmp_dir, f"model_epoch_{epoch:03d}.pth.tar")
+            writer.save({ "epoch": epoch, "model": torch.randn(4, 4) }, file_path)
+            writer.wait()
+            writer.set_metric(file_path, ler)
+        print(sorted(p.name for p in Path(tmp_dir).iterdir()))
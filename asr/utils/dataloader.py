@@ -1,12 +1,15 @@
 import os
 import sys
+import math
 import random
 from pathlib import Path
 
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.distributed as dist
 from torch.utils.data import DataLoader
+from torch.utils.data.sampler import Sampler
 import torchaudio
 
 from .logger import logger
@@ -72,6 +75,83 @@ class NonSplitTrainDataLoader(DataLoader):
         super().__init__(collate_fn=NonSplitTrainCollateFn(), *args, **kwargs)
 
 
+class ResumableSampler(Sampler):
+    """ shuffles a dataset by a permutation seeded with the seed and the epoch, sharded over the ranks
+        like DistributedSampler if distributed. the permutation is reproduced from its state,
+        so that a training resumes from a position in the epoch without loading the skipped samples
+
+        if the seed is None, the trainer sets one drawn from its random generator, or the sampler
+        draws one from the torch random generator at its first shuffling
+    """
+
+    def __init__(self, dataset, shuffle=True, seed=None, num_replicas=None, rank=None):
+        initialized = dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if initialized else 1
+        if rank is None:
+            rank = dist.get_rank() if initialized else 0
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(len(dataset) / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+        self.epoch = 0
+        self.start = 0
+
+    def __iter__(self):
+        if self.shuffle:
+            if self.seed is None:
+                self.seed = int(torch.LongTensor(1).random_(0, 2 ** 31 - 1).item())
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        # pad to be evenly divisible over the ranks
+        indices += indices[:(self.total_size - len(indices))]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def state_dict(self):
+        return { "seed": self.seed, "epoch": self.epoch, "start": self.start }
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.start = state["start"]
+
+
+class DistributedEvalSampler(Sampler):
+    """ shards a dataset over the ranks for the evaluation, without the padding and the shuffling
+        of DistributedSampler so that every utterance is counted exactly once over the ranks.
+        the shards are interleaved to balance the utterance lengths of a sorted manifest
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.indices = list(range(rank, len(dataset), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
 class SplitPredictCollateFn(object):
 
     def __call__(self, batch):
@@ -112,17 +112,18 @@ class Augment(object):
 # transformer: spectrogram
 class Spectrogram(object):
 
-    def __init__(self, sample_rate, window_shift, window_size, nfft, window=tukey):
+    def __init__(self, sample_rate, window_shift, window_size, nfft, window=tukey, center=True):
         self.nfft = nfft
         self.window_size = int(sample_rate * window_size)
         self.window_shift = int(sample_rate * window_shift)
         self.window = torch.FloatTensor(window(self.window_size))
+        self.center = center
 
     def __call__(self, wav):
         with torch.no_grad():
             # STFT
             data = torch.stft(wav, n_fft=self.nfft, hop_length=self.window_shift,
-                              win_length=self.window_size, window=self.window)
+                              win_length=self.window_size, window=self.window, center=self.center)
             data /= self.window.pow(2).sum().sqrt_()
             #mag = data.pow(2).sum(-1).log1p_()
             #ang = torch.atan2(data[:, :, 1], data[:, :, 0])
@@ -166,6 +167,58 @@ class FrameSplitter(object):
             return frames
 
 
+class StreamingSpectrogram(object):
+    """ the frames of Spectrogram and FrameSplitter(split=False) computed incrementally over the
+        chunks of a waveform, the same with those of the whole waveform. the reflection padding
+        of the STFT is done here, so the frames are emitted once their samples have arrived
+    """
+    def __init__(self, sample_rate=p.SAMPLE_RATE, window_shift=p.WINDOW_SHIFT, window_size=p.WINDOW_SIZE,
+                 nfft=p.NFFT, window=tukey, stride=3):
+        self.spectrogram = Spectrogram(sample_rate=sample_rate, window_shift=window_shift,
+                                       window_size=window_size, nfft=nfft, window=window, center=False)
+        self.splitter = FrameSplitter(unit_frames=1, padding=0, stride=stride, split=False)
+        self.nfft = nfft
+        self.hop = self.spectrogram.window_shift
+        self.pad = nfft // 2
+        self.stride = stride
+        self.reset()
+
+    def reset(self):
+        self.samples = torch.FloatTensor()  # the samples padded, not consumed yet
+        self.tail = torch.FloatTensor()  # the last samples, to reflect at the end
+        self.frames = None  # the frames not folded yet
+        self.started = False
+
+    def __call__(self, wav, final=False):
+        """ returns the 1 x (2 * stride) x F x T frames completed by the chunk of samples,
+            and all the rest if final
+        """
+        wav = torch.as_tensor(np.asarray(wav), dtype=torch.float)
+        self.tail = torch.cat((self.tail, wav))[-(self.pad + 1):]
+        self.samples = torch.cat((self.samples, wav))
+        if not self.started:
+            if self.samples.size(0) <= self.pad and not final:
+                return None
+            self.samples = torch.cat((self.samples[1:(self.pad + 1)].flip(0), self.samples))
+            self.started = True
+        if final:
+            self.samples = torch.cat((self.samples, self.tail[:-1].flip(0)))
+
+        num_frames = (self.samples.size(0) - self.nfft) // self.hop + 1
+        if num_frames > 0:
+            used = (num_frames - 1) * self.hop + self.nfft
+            frames = self.spectrogram(self.samples[:used])
+            self.samples = self.samples[(num_frames * self.hop):]
+            self.frames = frames if self.frames is None else torch.cat((self.frames, frames), dim=2)
+        if self.frames is None or self.frames.size(2) < self.stride:
+            return None
+        # fold the multiples of the stride, the rest are dropped at the end like FrameSplitter
+        num_folded = self.frames.size(2) // self.stride * self.stride
+        folded = self.splitter(self.frames[:, :, :num_folded])
+        self.frames = self.frames[:, :, num_folded:]
+        return folded
+
+
 # transformer: convert int to one-hot vector
 class Int2OneHot(object):
 
@@ -0,0 +1,116 @@
+#!python
+import numpy as np
+import torch
+
+
+INF = 1 << 30
+
+
+def _shift(x, fill=0):
+    """ shift along the diagonal index, so that the entry i takes the entry i-1 """
+    return torch.cat([torch.full_like(x[:, :1], fill), x[:, :-1]], dim=1)
+
+
+def pad_sequences(seqs, pad=-1):
+    """ pad a list of integer sequences (tensors, arrays or lists) to a NxL LongTensor,
+        returns the padded tensor and the lengths
+    """
+    seqs = [torch.as_tensor(np.asarray(s) if not torch.is_tensor(s) else s, dtype=torch.long).view(-1)
+            for s in seqs]
+    lens = torch.LongTensor([len(s) for s in seqs])
+    padded = torch.full((len(seqs), max(lens.tolist() + [0])), pad, dtype=torch.long)
+    for i, s in enumerate(seqs):
+        padded[i, :len(s)] = s
+    return padded, lens
+
+
+def edit_distance(refs, hyps, ref_lens=None, hyp_lens=None, counts=False):
+    """ Levenshtein distances between the references and the hypotheses of a whole batch
+
+        refs and hyps are NxR and NxH padded integer tensors with their lengths, or lists of
+        sequences to be padded. the DP runs over the anti-diagonals i + j = k, so that all the
+        cells of a diagonal in all the pairs are computed at once with the tensor ops
+
+        returns the N distances, and the Nx3 counts of (substitution, insertion, deletion)
+        of an optimal alignment if counts is True
+    """
+    if ref_lens is None:
+        refs, ref_lens = pad_sequences(refs)
+    if hyp_lens is None:
+        hyps, hyp_lens = pad_sequences(hyps)
+    refs, hyps = torch.as_tensor(refs).long(), torch.as_tensor(hyps).long()
+    device = refs.device
+    ref_lens = torch.as_tensor(ref_lens).long().to(device)
+    hyp_lens = torch.as_tensor(hyp_lens).long().to(device)
+    hyps = hyps.to(device)
+
+    N, R, H = refs.size(0), refs.size(1), hyps.size(1)
+    dist = torch.zeros(N, dtype=torch.long, device=device)
+    ops = torch.zeros(N, 3, dtype=torch.long, device=device)
+    if N == 0:
+        return (dist, ops) if counts else dist
+
+    i = torch.arange(R + 1, device=device)
+    # diagonals k-1 and k-2 indexed by i, with the op counts of their best paths
+    prev1 = torch.full((N, R + 1), INF, dtype=torch.long, device=device)
+    prev2 = prev1.clone()
+    prev1_ops = torch.zeros(N, R + 1, 3, dtype=torch.long, device=device)
+    prev2_ops = prev1_ops.clone()
+    # D[0][0] = 0 on the diagonal 0
+    prev1[:, 0] = 0
+    ends = ref_lens + hyp_lens
+
+    for k in range(1, R + H + 1):
+        j = k - i
+        valid = (j >= 0) & (j <= H)
+        # substitution cost of the cell (i, j) compares refs[i-1] and hyps[j-1]
+        ri = (i - 1).clamp(0, max(R - 1, 0))
+        hj = (j - 1).clamp(0, max(H - 1, 0))
+        if R > 0 and H > 0:
+            sub = (refs[:, ri] != hyps[:, hj]).long()
+        else:
+            sub = torch.ones(N, R + 1, dtype=torch.long, device=device)
+
+        diag = _shift(prev2, INF) + sub
+        dele = _shift(prev1, INF) + 1
+        ins = prev1 + 1
+        cands = torch.stack([diag, ins, dele], dim=2)
+        cur, choice = cands.min(dim=2)
+        # the first row and column
+        cur = torch.where(i.unsqueeze(0) == 0, torch.full_like(cur, k), cur)
+        cur = torch.where((j == 0).unsqueeze(0), i.unsqueeze(0).expand_as(cur), cur)
+        cur = torch.where(valid.unsqueeze(0), cur, torch.full_like(cur, INF))
+
+        if counts:
+            src = torch.stack([_shift(prev2_ops), prev1_ops, _shift(prev1_ops)], dim=2)
+            cur_ops = src.gather(2, choice.view(N, R + 1, 1, 1).expand(N, R + 1, 1, 3)).squeeze(2)
+            # add the op chosen, matches don't count
+            inc = torch.zeros_like(cur_ops)
+            inc[:, :, 0] = (choice == 0).long() * sub
+            inc[:, :, 1] = (choice == 1).long()
+            inc[:, :, 2] = (choice == 2).long()
+            cur_ops = cur_ops + inc
+            # the first row are all insertions and the first column all deletions
+            first_row = torch.stack([torch.zeros_like(j), j.clamp(min=0), torch.zeros_like(j)], dim=1)
+            first_col = torch.stack([torch.zeros_like(i), torch.zeros_like(i), i], dim=1)
+            cur_ops = torch.where((i == 0).view(1, -1, 1), first_row.unsqueeze(0).expand_as(cur_ops), cur_ops)
+            cur_ops = torch.where((j == 0).view(1, -1, 1), first_col.unsqueeze(0).expand_as(cur_ops), cur_ops)
+
+        # the pairs ending on this diagonal
+        end = ends == k
+        if end.any():
+            dist[end] = cur[end, ref_lens[end]]
+            if counts:
+                ops[end] = cur_ops[end, ref_lens[end]]
+        prev2, prev1 = prev1, cur
+        if counts:
+            prev2_ops, prev1_ops = prev1_ops, cur_ops
+
+    return (dist, ops) if counts else dist
+
+
+if __name__ == "__main__":
+    refs = [[1, 2, 3, 4], [5, 6], [], [7, 7, 7]]
+    hyps = [[1, 3, 4, 4, 5], [5, 6], [1, 2], []]
+    dist, ops = edit_distance(refs, hyps, counts=True)
+    print(dist, ops)
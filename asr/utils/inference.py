@@ -0,0 +1,210 @@
+#!python
+import copy
+import types
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .misc import Swish, Identity
+
+
+_CONVS = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+_BATCH_NORMS = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+_DROPOUTS = (nn.Dropout, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout)
+
+
+class FusedSwish(nn.Module):
+    """ Swish of a single kernel by F.silu where the torch has it, for the inference """
+
+    def __init__(self, inplace=False):
+        super().__init__()
+        self.inplace = inplace
+
+    def forward(self, x):
+        if hasattr(F, "silu"):
+            return F.silu(x, inplace=self.inplace)
+        return x.mul_(torch.sigmoid(x)) if self.inplace else x * torch.sigmoid(x)
+
+
+def _bn_scale_shift(bn):
+    """ the batch norm in eval as y = scale * x + shift per channel """
+    assert bn.track_running_stats and bn.running_var is not None, "no running stats to fold"
+    scale = (bn.running_var + bn.eps).rsqrt()
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale, shift
+
+
+def fold_bn_into_preceding(layer, bn):
+    """ fold the batch norm on the outputs of a conv or a linear into its weight and bias """
+    scale, shift = _bn_scale_shift(bn)
+    with torch.no_grad():
+        layer.weight.mul_(scale.view(-1, *([1] * (layer.weight.dim() - 1))))
+        if layer.bias is None:
+            layer.bias = nn.Parameter(shift.clone())
+        else:
+            layer.bias.mul_(scale).add_(shift)
+
+
+def fold_bn_into_following(weight, bias, bn):
+    """ fold the batch norm on the inputs of a linear map into its weight and bias, in place,
+        e.g. of a nn.Linear or of the input projections of a LSTM
+
+        returns the bias, which is made if None
+    """
+    scale, shift = _bn_scale_shift(bn)
+    with torch.no_grad():
+        folded = weight.mv(shift)
+        weight.mul_(scale.unsqueeze(0))
+        if bias is None:
+            return nn.Parameter(folded)
+        bias.add_(folded)
+        return bias
+
+
+def _fold_sequential(seq):
+    children = list(seq.named_children())
+    folded = set()
+    for (name0, m0), (name1, m1) in zip(children, children[1:]):
+        if name0 in folded:
+            continue
+        if isinstance(m0, _CONVS + (nn.Linear, )) and isinstance(m1, _BATCH_NORMS):
+            fold_bn_into_preceding(m0, m1)
+            setattr(seq, name1, Identity())
+            folded.add(name1)
+        elif isinstance(m0, nn.BatchNorm1d) and isinstance(m1, nn.Linear):
+            m1.bias = fold_bn_into_following(m1.weight, m1.bias, m0)
+            setattr(seq, name0, Identity())
+
+
+def _fold_batch_rnn(module):
+    """ fold the batch norm of a BatchRNN into the input projections of the first layer of its rnn """
+    bn = module.batch_norm.module
+    rnn = module.rnn
+    if isinstance(rnn, nn.RNNBase):
+        if not rnn.bias:
+            return
+        suffixes = ["_l0", "_l0_reverse"] if rnn.bidirectional else ["_l0"]
+        params = [(getattr(rnn, "weight_ih" + s), getattr(rnn, "bias_ih" + s)) for s in suffixes]
+    elif hasattr(rnn, "hidden0"):
+        # the layer-norm LSTM, whose layer norm on the input gates follows the projection
+        cells = [rnn.hidden0[0]] + ([rnn.hidden1[0]] if rnn.bidirectional else [])
+        if any(c.bias_ih is None for c in cells):
+            return
+        params = [(c.weight_ih, c.bias_ih) for c in cells]
+    else:
+        return
+    for weight, bias in params:
+        fold_bn_into_following(weight, bias, bn)
+    module.batch_norm = None
+    if hasattr(rnn, "flatten_parameters"):
+        rnn.flatten_parameters()
+
+
+def optimize_for_inference(model):
+    """ a copy of the model for the inference only, with the batch norms folded into the adjacent
+        convs and linears, Swish fused and the dropouts removed. the folding is found in the
+        nn.Sequentials, the BatchRNNs, and the pairs of the names listed in INFERENCE_FOLDS of
+        the modules whose forward runs them in a row. the copy can't be turned back to training
+    """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+        for conv, bn in getattr(module, "INFERENCE_FOLDS", ()):
+            m0, m1 = getattr(module, conv), getattr(module, bn)
+            if isinstance(m1, _BATCH_NORMS):
+                fold_bn_into_preceding(m0, m1)
+                setattr(module, bn, Identity())
+        if getattr(module, "batch_norm", None) is not None and hasattr(module, "rnn"):
+            _fold_batch_rnn(module)
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, _DROPOUTS):
+                setattr(module, name, Identity())
+            elif type(child) is Swish:
+                setattr(module, name, FusedSwish(inplace=child.inplace))
+
+    for param in model.parameters():
+        param.requires_grad_(False)
+    model.train = types.MethodType(_eval_only, model)
+    return model.eval()
+
+
+def _eval_only(self, mode=True):
+    if mode:
+        raise RuntimeError("the model optimized for inference can't be trained")
+    return nn.Module.train(self, False)
+
+
+def _load_network(model):
+    """ the network module of a model, loaded by itself since the packages of resnet_ctc and
+        densenet_ctc import their train scripts, which don't import in this tree
+    """
+    import importlib.util
+    from pathlib import Path
+    path = Path(__file__).parents[1].joinpath("models", model, "network.py")
+    spec = importlib.util.spec_from_file_location(f"asr.models.{model}.network", str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _build_model(name):
+    from . import params as p
+    if name == "deepspeech_ctc":
+        from asr.models.deepspeech_ctc.network import DeepSpeech
+        return DeepSpeech(num_classes=p.NUM_CTC_LABELS), 6
+    elif name == "deepspeech_ctc_uni":
+        from asr.models.deepspeech_ctc.network import DeepSpeech
+        return DeepSpeech(num_classes=p.NUM_CTC_LABELS, bidirectional=False), 6
+    elif name == "resnet_ctc":
+        return _load_network("resnet_ctc").resnet50(num_classes=p.NUM_CTC_LABELS), 2
+    elif name == "densenet_ctc":
+        return _load_network("densenet_ctc").densenet_custom(num_classes=p.NUM_CTC_LABELS), 2
+    raise ValueError(f"unknown model {name}")
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="cpu latency of the inference by optimize_for_inference")
+    parser.add_argument('--models', default=["deepspeech_ctc"], type=str, nargs='*',
+                        help="models in {'deepspeech_ctc', 'deepspeech_ctc_uni', 'resnet_ctc', 'densenet_ctc'}")
+    parser.add_argument('--batch-size', default=1, type=int, help="number of utterances in a batch")
+    parser.add_argument('--frames', default=300, type=int, help="number of frames per utterance")
+    parser.add_argument('--repeats', default=10, type=int, help="number of runs timed after a warm-up run")
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"batch {args.batch_size} x {args.frames} frames on cpu, {torch.get_num_threads()} threads")
+    for name in args.models:
+        torch.manual_seed(0)
+        model, channels = _build_model(name)
+        # the running stats of some batches, not to fold the identities of the initial ones
+        model.train()
+        with torch.no_grad():
+            for _ in range(3):
+                model(torch.randn(4, channels, 129, args.frames))
+        model.eval()
+        optimized = optimize_for_inference(model)
+
+        xs = torch.randn(args.batch_size, channels, 129, args.frames)
+        # the runs of the two alternated, not to be skewed by the load drifting over time
+        elapsed = [list(), list()]
+        with torch.no_grad():
+            ys = [model(xs), optimized(xs)]
+            for _ in range(args.repeats):
+                for i, m in enumerate([model, optimized]):
+                    start = time.perf_counter()
+                    m(xs)
+                    elapsed[i].append(time.perf_counter() - start)
+        t0, t1 = min(elapsed[0]), min(elapsed[1])
+        print(f"{name:>20s}: {t0 * 1000.:8.1f} ms -> {t1 * 1000.:8.1f} ms ({t1 / t0 * 100.:5.1f}%), "
+              f"max abs diff of the posteriors {(ys[1] - ys[0]).abs().max().item():.2e}")
@@ -53,31 +53,41 @@ def remove_duplicates(labels, blank=-1):
             yield x
 
 
-def edit_distance(r, h):
-    '''
-    This function is to calculate the edit distance of reference sentence and the hypothesis sentence.
-    Main algorithm used is dynamic programming.
-    Attributes:
-        r -> the list of words produced by splitting reference sentence.
-        h -> the list of words produced by splitting hypothesis sentence.
-    '''
-    d = np.zeros((len(r)+1)*(len(h)+1), dtype=np.uint8).reshape((len(r)+1, len(h)+1))
-    for i in range(len(r)+1):
-        for j in range(len(h)+1):
-            if i == 0:
-                d[0][j] = j
-            elif j == 0:
-                d[i][0] = i
-    for i in range(1, len(r)+1):
-        for j in range(1, len(h)+1):
-            if r[i-1] == h[j-1]:
-                d[i][j] = d[i-1][j-1]
-            else:
-                substitute = d[i-1][j-1] + 1
-                insert = d[i][j-1] + 1
-                delete = d[i-1][j] + 1
-                d[i][j] = min(substitute, insert, delete)
-    return d
+def ctc_greedy_decode(ys_hat, frame_lens, blank=0):
+    """ best path decoding of a NxTxH batch of CTC outputs, taking the argmax of each frame
+        and removing the repeats and the blanks over the valid frames at once
+
+        returns the label sequences packed into a 1-D tensor and their lengths
+    """
+    labels = ys_hat.argmax(dim=2)
+    num_batch, num_frames = labels.size()
+    frame_lens = frame_lens.to(labels.device).long()
+    mask = torch.arange(num_frames, device=labels.device).unsqueeze(0) < frame_lens.unsqueeze(1)
+    prev = torch.cat([labels.new_full((num_batch, 1), -1), labels[:, :-1]], dim=1)
+    keep = mask & (labels != blank) & (labels != prev)
+    return labels[keep], keep.sum(dim=1)
+
+
+def is_finite(x):
+    """ elementwise finiteness on the device, for the torch without isfinite """
+    return (x == x) & (x.abs() != float("inf"))
+
+
+def clip_grad_norm_finite_(parameters, max_norm, finite=None):
+    """ clip the gradients by their total norm on the device, without the host round trip of
+        nn.utils.clip_grad_norm_, and zero them if the norm or the flag finite is not finite
+
+        returns the total norm and the finite flag as tensors
+    """
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    total_norm = torch.stack([g.norm() for g in grads]).norm()
+    ok = is_finite(total_norm)
+    if finite is not None:
+        ok = ok & finite.to(ok.device)
+    coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.)
+    for g in grads:
+        g.copy_(torch.where(ok.expand_as(g), g * coef, torch.zeros_like(g)))
+    return total_norm, ok
 
 
 class View(nn.Module):
@@ -90,6 +100,15 @@ class View(nn.Module):
         return x.view(*self.dim)
 
 
+class Identity(nn.Module):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+    def forward(self, x):
+        return x
+
+
 class Flatten(nn.Module):
 
     def __init__(self):
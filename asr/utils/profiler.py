@@ -0,0 +1,107 @@
+#!python
+import time
+
+import numpy as np
+import torch
+
+
+STEP_PHASES = [
+    "data",
+    "h2d",
+    "forward",
+    "loss",
+    "backward",
+    "clip",
+    "step",
+    "log",
+]
+
+
+class StepTimer:
+    """ per-step wall-clock timings of the phases of the training steps, kept in ring buffers
+        of the last window steps and reported as percentiles over the steps since the last report
+
+        a phase is timed from the previous mark to its mark, so that the data phase covers
+        the wait for the loader between the steps. the cuda kernels run asynchronously and
+        are accounted to the phase that blocks on them, unless sync is set to synchronize
+        at every mark for the exact timings at the cost of the throughput
+    """
+
+    def __init__(self, phases=STEP_PHASES, window=1000, sync=False):
+        self.phases = list(phases)
+        self.index = {ph: i for i, ph in enumerate(self.phases)}
+        self.window = window
+        self.sync = sync and torch.cuda.is_available()
+        self.times = np.zeros((len(self.phases), window))
+        self.current = np.zeros(len(self.phases))
+        self.count = 0
+        self.begin()
+
+    def begin(self):
+        """ start the timing, e.g. before pulling the first batch of an epoch """
+        self.last = time.perf_counter()
+        self.current[:] = 0.
+        self.interval_start = self.last
+        self.interval_count = 0
+        self.samples = 0
+        self.frames = 0
+
+    def mark(self, phase):
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.current[self.index[phase]] += now - self.last
+        self.last = now
+
+    def step(self, num_samples=0, num_frames=0):
+        """ close the timings of a step """
+        self.times[:, self.count % self.window] = self.current
+        self.current[:] = 0.
+        self.count += 1
+        self.interval_count += 1
+        self.samples += num_samples
+        self.frames += num_frames
+
+    def report(self, percentiles=(50, 90, 99)):
+        """ the percentiles in ms of the phases and of the whole steps since the last report,
+            with the samples/sec and the frames/sec, and starts a new interval
+        """
+        n = min(self.interval_count, self.window)
+        if n == 0:
+            return dict()
+        idx = np.arange(self.count - n, self.count) % self.window
+        times = self.times[:, idx] * 1000.
+        stats = dict()
+        for ph, t in zip(self.phases + ["total"], np.vstack([times, times.sum(axis=0)])):
+            for q, v in zip(percentiles, np.percentile(t, percentiles)):
+                stats[f"{ph}_p{q}"] = float(v)
+        elapsed = time.perf_counter() - self.interval_start
+        stats["samples_per_sec"] = self.samples / elapsed
+        stats["frames_per_sec"] = self.frames / elapsed
+        # the share of the phases in the interval, to tell the loader, compute or sync bound
+        share = times.sum(axis=1) / max(times.sum(), 1e-9)
+        for ph, s in zip(self.phases, share):
+            stats[f"{ph}_share"] = float(s)
+
+        self.interval_start = time.perf_counter()
+        self.interval_count = 0
+        self.samples = 0
+        self.frames = 0
+        return stats
+
+    def describe(self, stats):
+        desc = ", ".join(f"{ph} {stats[f'{ph}_p50']:.1f}/{stats[f'{ph}_p90']:.1f}ms ({stats[f'{ph}_share'] * 100.:.0f}%)"
+                         for ph in self.phases)
+        return (f"step p50/p90 {stats['total_p50']:.1f}/{stats['total_p90']:.1f}ms: {desc}; "
+                f"{stats['samples_per_sec']:.1f} samples/sec, {stats['frames_per_sec']:.0f} frames/sec")
+
+
+if __name__ == "__main__":
+    timer = StepTimer(window=8)
+    for i in range(20):
+        time.sleep(0.002)
+        timer.mark("data")
+        time.sleep(0.001)
+        timer.mark("forward")
+        timer.step(num_samples=4, num_frames=400)
+    print(timer.describe(timer.report()))
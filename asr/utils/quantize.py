@@ -0,0 +1,102 @@
+#!python
+import copy
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+
+QUANTIZE_MODES = [
+    "dynamic",
+    "static",
+]
+
+
+def _quantization():
+    try:
+        import torch.ao.quantization as q
+    except ImportError:
+        import torch.quantization as q
+    return q
+
+
+def _select_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ["fbgemm", "x86", "qnnpack"]:
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("no quantized engine is supported by the torch")
+
+
+class StaticQuantized(nn.Module):
+    """ a module run in int8 between the quantization of its input and the dequantization of its output """
+
+    def __init__(self, module):
+        super().__init__()
+        q = _quantization()
+        self.quant = q.QuantStub()
+        self.module = module
+        self.dequant = q.DeQuantStub()
+
+    def forward(self, x):
+        # the quantized convs output in channels last, back to the layout of the float ones
+        return self.dequant(self.module(self.quant(x))).contiguous()
+
+
+def quantize_model(model, mode="dynamic", calibration=None):
+    """ an int8 copy of a model for the inference on cpu, preferably of one by optimize_for_inference
+        whose batch norms are folded. "dynamic" keeps the weights of the LSTMs, GRUs and Linears in
+        int8 and quantizes their activations on the fly. "static" also runs the Conv2ds in int8,
+        with the scales of their inputs observed over the calibration, an iterable of the input
+        batches, while the activations between the convs, e.g. Swish, stay in float
+
+        the calibration can be None to make the structure to load a quantized state_dict into
+    """
+    assert mode in QUANTIZE_MODES, f"quantize mode should be one of {QUANTIZE_MODES}"
+    q = _quantization()
+    engine = _select_engine()
+    model = copy.deepcopy(model).cpu().eval()
+    if mode == "static":
+        for module in list(model.modules()):
+            for name, child in module.named_children():
+                if type(child) is nn.Conv2d:
+                    wrapped = StaticQuantized(child)
+                    wrapped.qconfig = q.get_default_qconfig(engine)
+                    setattr(module, name, wrapped)
+        q.prepare(model, inplace=True)
+        if calibration is not None:
+            with torch.no_grad():
+                for xs in calibration:
+                    model(xs)
+        q.convert(model, inplace=True)
+    # the layer-norm LSTM runs its own time loop on the float weights, and is left as it is
+    return q.quantize_dynamic(model, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def save_quantized_model(model, mode, file_path):
+    """ save the state_dict of a quantized model with its mode, which load_quantized_model needs
+        to make the same structure from the float model
+    """
+    file_path = Path(file_path)
+    file_path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    torch.save({ "model": model.state_dict(), "quantize": mode }, str(file_path))
+
+
+def load_states(file_path, map_location=None):
+    """ torch.load allowing the packed weights of the quantized LSTMs, the script objects which
+        the loading of the weights only in the recent torch refuses otherwise
+    """
+    safe_globals = getattr(torch.serialization, "safe_globals", None)
+    if safe_globals is None:
+        return torch.load(file_path, map_location=map_location)
+    with safe_globals([torch.ScriptObject]):
+        return torch.load(file_path, map_location=map_location)
+
+
+def load_quantized_model(model, states):
+    """ the quantized model of the states saved by save_quantized_model, from the float model """
+    from .inference import optimize_for_inference
+    model = quantize_model(optimize_for_inference(model), states["quantize"])
+    model.load_state_dict(states["model"])
+    return model
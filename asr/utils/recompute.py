@@ -0,0 +1,166 @@
+#!python
+import inspect
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+import torch.utils.checkpoint as cp
+
+
+# the reentrant checkpoint of the old torch drops the gradients of the parameters
+# when none of the inputs requires grad, e.g. the features into the conv front-end
+_NON_REENTRANT = "use_reentrant" in inspect.signature(cp.checkpoint).parameters
+# the recomputation runs to the end, since the exception stopping it early doesn't pass
+# through the scripted functions, e.g. the loop of the layer-norm LSTM, which also run
+# unoptimized so that the recomputation saves the same tensors with the profiling run
+_CHECKPOINT_KWARGS = dict(use_reentrant=False)
+if "early_stop" in inspect.signature(cp.checkpoint).parameters:
+    _CHECKPOINT_KWARGS["early_stop"] = False
+
+# the meters measuring on cpu, to count the inputs kept by the recomputed segments
+_meters = list()
+
+
+@contextmanager
+def frozen_batch_norm_stats(module):
+    """ keep the running stats of the batch norms in the module, so that the recomputation
+        of a forward doesn't update them twice
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [[b.clone() for b in bn.buffers()] for bn in bns]
+    try:
+        yield
+    finally:
+        # also when the recomputation stops early with an exception
+        with torch.no_grad():
+            for bn, bufs in zip(bns, saved):
+                for b, s in zip(bn.buffers(), bufs):
+                    b.copy_(s)
+
+
+def recompute(module, *inputs):
+    """ run the module keeping only its inputs for the backward, where its forward is run
+        again to get the intermediates, trading the memory of the activations for the time
+        of another forward. it runs as usual out of the training or without grad
+    """
+    if not (module.training and torch.is_grad_enabled()):
+        return module(*inputs)
+    for meter in _meters:
+        for x in inputs:
+            meter.add(x)
+
+    state = { "recomputing": False }
+
+    def run(*xs):
+        with torch.jit.optimized_execution(False):
+            if not state["recomputing"]:
+                state["recomputing"] = True
+                return module(*xs)
+            with frozen_batch_norm_stats(module):
+                return module(*xs)
+
+    if _NON_REENTRANT:
+        return cp.checkpoint(run, *inputs, **_CHECKPOINT_KWARGS)
+    if not any(x.requires_grad for x in inputs if torch.is_tensor(x)):
+        inputs = tuple(x.detach().requires_grad_() if torch.is_tensor(x) and x.is_floating_point() else x
+                       for x in inputs)
+    return cp.checkpoint(run, *inputs)
+
+
+class ActivationMeter:
+    """ the memory of a training step: the peak allocation over the step on cuda, or the bytes
+        of the tensors saved for the backward by autograd and of the inputs of the recomputed
+        segments on cpu, counting a storage saved by several ops once
+    """
+
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == "cuda"
+
+    @contextmanager
+    def measure(self):
+        self.bytes = 0
+        if self.cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_max_memory_allocated()
+            start = torch.cuda.memory_allocated()
+            yield
+            torch.cuda.synchronize()
+            self.bytes = torch.cuda.max_memory_allocated() - start
+        else:
+            self.seen = set()
+            _meters.append(self)
+            try:
+                with torch.autograd.graph.saved_tensors_hooks(self.add, lambda t: t):
+                    yield
+            finally:
+                _meters.remove(self)
+
+    def add(self, t):
+        if torch.is_tensor(t):
+            key = t.untyped_storage().data_ptr()
+            if key not in self.seen:
+                self.seen.add(key)
+                self.bytes += t.untyped_storage().nbytes()
+        return t
+
+
+def _build_model(name, recompute_segments):
+    if name == "deepspeech_ctc":
+        from asr.models.deepspeech_ctc.network import DeepSpeech
+        return DeepSpeech(recompute=recompute_segments)
+    elif name == "densenet_ctc":
+        from asr.models.densenet_ctc.network import densenet_custom
+        from asr.utils import params as p
+        return densenet_custom(num_classes=p.NUM_CTC_LABELS, recompute=recompute_segments)
+    raise ValueError(f"unknown model {name}")
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="memory and time of a training step by the segments recomputed")
+    parser.add_argument('--model', default="deepspeech_ctc", type=str, help="model in {'deepspeech_ctc', 'densenet_ctc'}")
+    parser.add_argument('--use-cuda', default=False, action='store_true', help="use cuda")
+    parser.add_argument('--batch-size', default=4, type=int, help="number of utterances in a batch")
+    parser.add_argument('--frames', default=300, type=int, help="number of frames per utterance")
+    parser.add_argument('--steps', default=3, type=int, help="number of steps timed after a warm-up step")
+    parser.add_argument('--configs', default=None, type=str, nargs='*', help="comma separated segments per configuration, 'none' for no recomputation")
+    args = parser.parse_args(sys.argv[1:])
+
+    device = torch.device("cuda" if args.use_cuda else "cpu")
+    model = _build_model(args.model, ())
+    segments = sorted(model.RECOMPUTE_SEGMENTS)
+    if args.configs is None:
+        configs = [()] + [(s,) for s in segments] + [tuple(segments)]
+    else:
+        configs = [tuple(s for s in c.split(",") if s and s != "none") for c in args.configs]
+    if args.model == "deepspeech_ctc":
+        xs = torch.randn(args.batch_size, 6, 129, args.frames, device=device)
+    else:
+        xs = torch.randn(args.batch_size, 2, 129, args.frames, device=device)
+
+    meter = ActivationMeter(device)
+    results = list()
+    for config in configs:
+        torch.manual_seed(0)
+        model = _build_model(args.model, config).to(device)
+        model.train()
+        elapsed = list()
+        for i in range(args.steps + 1):
+            model.zero_grad()
+            start = time.perf_counter()
+            with meter.measure():
+                loss = model(xs).pow(2).mean()
+                loss.backward()
+            if args.use_cuda:
+                torch.cuda.synchronize()
+            elapsed.append(time.perf_counter() - start)
+        results.append((",".join(config) or "none", meter.bytes / 1024 / 1024, sum(elapsed[1:]) / args.steps))
+
+    base_mem, base_time = results[0][1], results[0][2]
+    print(f"{args.model}, batch {args.batch_size} x {args.frames} frames on {device}")
+    for desc, mem, t in results:
+        print(f"{desc:>24s}: memory {mem:8.1f} MB ({mem / base_mem * 100.:5.1f}%), "
+              f"step {t * 1000.:8.1f} ms ({t / base_time * 100.:5.1f}%)")
@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.fixture
+def graph_files(tmp_path):
+    """ label, word and lexicon files of a tiny CTC lexicon: "ab" is a b, "ba" is b a """
+    label_file = tmp_path.joinpath("labels.txt")
+    label_file.write_text("<blk> 0\nsil 1\na 2\nb 3\n")
+    wd_file = tmp_path.joinpath("words.txt")
+    wd_file.write_text("<eps> 0\nab 1\nba 2\n")
+    lexicon_file = tmp_path.joinpath("align_lexicon.int")
+    lexicon_file.write_text("1 1 2 3\n2 2 3 2\n")
+    return { "label_file": str(label_file), "wd_file": str(wd_file), "lexicon_file": str(lexicon_file) }
+
+
+@pytest.fixture
+def make_trainer(graph_files, tmp_path):
+    """ make a trainer of a model on cpu, with the ctc_beam decoder of the tiny lexicon """
+    from asr.utils.logger import init_logger
+    from asr.models.trainer import NonSplitTrainer
+
+    init_logger(log_dir=str(tmp_path.joinpath("logs")), log_file="test.log")
+
+    def make(model, trainer_class=NonSplitTrainer, **kwargs):
+        options = dict(init_lr=0.01, log_dir=str(tmp_path.joinpath("logs")), model_prefix="test",
+                       opt_type="sgd", decoder_type="ctc_beam")
+        options.update(graph_files)
+        options.update(kwargs)
+        return trainer_class(model, **options)
+
+    return make
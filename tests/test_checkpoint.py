@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import torch
+
+from asr.utils.checkpoint import CheckpointWriter
+
+
+def run_epochs(writer, tmp_path, lers, num_ckpts=3):
+    for epoch, ler in enumerate(lers):
+        for i in range(num_ckpts):
+            file_path = tmp_path.joinpath(f"model_epoch_{epoch:03d}_ckpt_{i:07d}.pth.tar")
+            writer.save({ "epoch": epoch, "model": torch.randn(2, 2) }, file_path, mid_epoch=True)
+        file_path = tmp_path.joinpath(f"model_epoch_{epoch:03d}.pth.tar")
+        writer.save({ "epoch": epoch, "model": torch.randn(2, 2) }, file_path)
+        writer.wait()
+        writer.set_metric(file_path, ler)
+    writer.wait()
+    return sorted(p.name for p in tmp_path.iterdir())
+
+
+def test_mid_epoch_checkpoints_dont_count_for_epochs(tmp_path):
+    # all the epoch checkpoints by default
+    files = run_epochs(CheckpointWriter(keep_ckpts=2), tmp_path, [30., 20., 25., 28.])
+    assert [f for f in files if "ckpt" not in f] == [f"model_epoch_{e:03d}.pth.tar" for e in range(4)]
+    assert [f for f in files if "ckpt" in f] == ["model_epoch_003_ckpt_0000001.pth.tar",
+                                                 "model_epoch_003_ckpt_0000002.pth.tar"]
+
+
+def test_keep_last_and_best_epochs(tmp_path):
+    files = run_epochs(CheckpointWriter(keep_last=2, keep_best=1, keep_ckpts=0), tmp_path, [30., 20., 25., 28.])
+    assert files == ["model_epoch_001.pth.tar", "model_epoch_002.pth.tar", "model_epoch_003.pth.tar"]
+
+
+def test_keep_all(tmp_path):
+    files = run_epochs(CheckpointWriter(), tmp_path, [30., 20.], num_ckpts=2)
+    assert len(files) == 6
+    assert not any(Path(f).suffix == ".tmp" for f in files)
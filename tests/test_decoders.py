@@ -0,0 +1,94 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+
+from asr.decoders import DECODER_OPTIONS, decoder_options, get_decoder
+from asr.decoders.wfst import WFSTGraph
+
+
+def loglikes_of(labels, num_labels=4):
+    """ 1xTxH log-posteriors peaked on the labels of the frames """
+    probs = np.full((len(labels), num_labels), 0.01)
+    probs[np.arange(len(labels)), labels] = 1. - 0.01 * (num_labels - 1)
+    return torch.from_numpy(np.log(probs)).float().unsqueeze(0)
+
+
+def test_decoder_options_drop_the_other_options():
+    options = { "use_cuda": False, "log_dir": "logs", "lm_file": None, "max_active": 4000, "blank_skip": 0.9 }
+    assert decoder_options(options) == { "lm_file": None, "max_active": 4000, "blank_skip": 0.9 }
+    assert decoder_options(options, "ctc_beam") == { "lm_file": None, "blank_skip": 0.9 }
+    assert decoder_options(options, "wfst") == { "max_active": 4000, "blank_skip": 0.9 }
+
+
+def test_get_decoder_rejects_the_options_of_other_decoders():
+    # rejected before the latgen extension is loaded
+    with pytest.raises(ValueError, match="lm_weight"):
+        get_decoder("latgen", lm_weight=0.5)
+    with pytest.raises(ValueError, match="max_active"):
+        get_decoder("ctc_beam", max_active=4000)
+    with pytest.raises(ValueError, match="decode_workers"):
+        get_decoder("wfst", decode_workers=2)
+    assert all("decoder_config" in v for v in DECODER_OPTIONS.values())
+
+
+def test_ctc_beam_decoder_config(graph_files, tmp_path):
+    config = tmp_path.joinpath("decoder.json")
+    config.write_text(json.dumps({ "beam": 10.0, "lm_weight": 0.5 }))
+    # unset options are left to the defaults of the decoder
+    decoder = get_decoder("ctc_beam", decoder_config=str(config), lm_file=None, **graph_files)
+    assert decoder.search.beam == 10.0
+    assert decoder.search.lm_weight == 0.5
+    assert decoder.search.beam_size == 64
+
+
+def test_ctc_beam_workers_closed(graph_files):
+    loglikes = torch.cat([loglikes_of([2, 0, 3, 0]), loglikes_of([3, 3, 0, 2])])
+    frame_lens = torch.IntTensor([4, 4])
+    with get_decoder("ctc_beam", decode_workers=2, **graph_files) as decoder:
+        words, alignments, w_sizes, a_sizes = decoder(loglikes, frame_lens)
+        assert decoder.pool is not None
+    assert decoder.pool is None
+    assert [w[:s].tolist() for w, s in zip(words, w_sizes)] == [[1], [2]]
+
+
+def test_grid_settings_of_the_decoder():
+    from argparse import Namespace
+    from asr.decoders.sweep import SWEEP_PARAMS, grid_settings
+    args = Namespace(beam=[10.0, 16.0], max_active=[2000, 8000], acoustic_scale=[1.0],
+                     lm_weight=[0.5, 0.8], blank_skip=[None])
+    latgen = grid_settings(args, SWEEP_PARAMS, "latgen")
+    assert len(latgen) == 4 and all("lm_weight" not in s for s in latgen)
+    ctc_beam = grid_settings(args, SWEEP_PARAMS, "ctc_beam")
+    assert len(ctc_beam) == 4 and all("max_active" not in s for s in ctc_beam)
+
+
+def read_graph(tmp_path, text, **kwargs):
+    fst_file = tmp_path / "graph.txt"
+    fst_file.write_text(text)
+    return WFSTGraph.read_text(str(fst_file), **kwargs)
+
+
+def test_read_text_of_an_acceptor(tmp_path):
+    graph = read_graph(tmp_path, "0 1 2\n0 1 3 0.5\n1 2 1 1.5\n2 0.25\n")
+    assert graph.ilabel.tolist() == graph.olabel.tolist() == [2, 3, 1]
+    assert graph.weight.tolist() == [0., 0.5, 1.5]
+    assert graph.final.tolist() == [np.inf, np.inf, 0.25]
+    # weighted all over, told by the option
+    graph = read_graph(tmp_path, "0 1 2 0.5\n1 0.\n", acceptor=True)
+    assert (graph.ilabel.tolist(), graph.olabel.tolist(), graph.weight.tolist()) == ([2], [2], [0.5])
+
+
+def test_read_text_of_a_transducer(tmp_path):
+    graph = read_graph(tmp_path, "0 1 2 4\n0 1 3 5 0.5\n1\n")
+    assert (graph.ilabel.tolist(), graph.olabel.tolist(), graph.weight.tolist()) == ([2, 3], [4, 5], [0., 0.5])
+
+
+def test_read_text_of_the_symbols(tmp_path):
+    isymbols = tmp_path / "isyms.txt"
+    isymbols.write_text("<eps> 0\na 1\nb 2\n")
+    graph = read_graph(tmp_path, "0 1 a b\n1 0 <eps> a 0.5\n1\n", isymbols=str(isymbols))
+    assert (graph.ilabel.tolist(), graph.olabel.tolist()) == ([1, 0], [2, 1])
+    graph = read_graph(tmp_path, "0 1 a\n1 0 b 0.5\n1\n", isymbols=str(isymbols))
+    assert graph.ilabel.tolist() == graph.olabel.tolist() == [1, 2]
@@ -0,0 +1,83 @@
+import pytest
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from asr.models.deepspeech_ctc.network import DeepSpeech, LSTM, Lookahead
+
+
+def small_deepspeech(rnn_type=nn.LSTM, bidirectional=True):
+    torch.manual_seed(0)
+    model = DeepSpeech(num_classes=5, rnn_type=rnn_type, rnn_hidden_size=16, rnn_num_layers=2,
+                       bidirectional=bidirectional, context=3)
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.running_mean.uniform_(-.1, .1)
+            m.running_var.uniform_(.5, 2.)
+    return model.eval()
+
+
+@pytest.mark.parametrize("bidirectional", [True, False])
+def test_packed_matches_each_utterance(bidirectional):
+    model = small_deepspeech(bidirectional=bidirectional)
+    # the conv front-end sees the padding of the batch, so the frames are compared after it
+    model.conv = nn.Sequential()
+    frame_lens = torch.IntTensor([7, 12, 4])
+    xs = torch.randn(3, 816, 1, 12)
+    for i, l in enumerate(frame_lens.tolist()):
+        xs[i, :, :, l:] = 0.
+    with torch.no_grad():
+        ys = model(xs, frame_lens)
+        for i, l in enumerate(frame_lens.tolist()):
+            assert torch.allclose(ys[i, :l], model(xs[i:(i + 1), :, :, :l])[0], atol=1e-6)
+            assert (ys[i, l:] == 0.).all()
+
+
+def cell_loop(cell, xs):
+    h = c = xs.new_zeros(xs.size(1), cell.hidden_size)
+    ys = list()
+    for x in xs:
+        h, c = cell(x, (h, c))
+        ys.append(h)
+    return torch.stack(ys)
+
+
+def lstm_loop(lstm, xs):
+    """ the layers of the LSTMCells stepped in python over a TxNxH utterance """
+    for l in range(lstm.num_layers):
+        ys = cell_loop(lstm.hidden0[l], xs)
+        if lstm.bidirectional:
+            ys = torch.cat((ys, cell_loop(lstm.hidden1[l], xs.flip(0)).flip(0)), dim=2)
+        xs = ys
+    return xs
+
+
+@pytest.mark.parametrize("grad", [False, True])
+def test_layer_norm_lstm_matches_the_cells(grad):
+    torch.manual_seed(0)
+    lstm = LSTM(6, 5, num_layers=2, bidirectional=True)
+    lens = [9, 6, 2]
+    xs = torch.randn(9, 3, 6)
+    with torch.set_grad_enabled(grad):
+        ys, _ = pad_packed_sequence(lstm(pack_padded_sequence(xs, lens))[0])
+        assert torch.allclose(lstm(xs[:, :1])[0], ys[:, :1], atol=1e-6)
+        for i, l in enumerate(lens):
+            assert torch.allclose(ys[:l, i], lstm_loop(lstm, xs[:l, i:(i + 1)])[:, 0], atol=1e-6)
+            assert (ys[l:, i] == 0.).all()
+
+
+def test_lookahead_matches_the_stacked_context():
+    torch.manual_seed(0)
+    lookahead = Lookahead(4, context=3)
+    xs = torch.randn(10, 2, 4)
+    # the weighted sum of the frames in the context, padded with zeros at the end
+    padded = torch.cat((xs, xs.new_zeros(3, 2, 4)), dim=0)
+    expected = torch.stack([(padded[t:(t + 4)].permute(1, 2, 0) * lookahead.weight).sum(2) for t in range(10)])
+    with torch.no_grad():
+        assert torch.allclose(lookahead(xs), expected, atol=1e-6)
+        # the chunks of a stream
+        ys, buffer = list(), None
+        for start in range(0, 10, 2):
+            y, buffer = lookahead.stream(xs[start:(start + 2)], buffer, final=(start + 2 >= 10))
+            ys.append(y)
+        assert torch.allclose(torch.cat(ys), expected, atol=1e-6)
@@ -0,0 +1,49 @@
+import importlib.util
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+
+def load_network():
+    # the package imports its stale train script, so the network is loaded by itself
+    path = Path(__file__).parents[1].joinpath("asr", "models", "densenet_ctc", "network.py")
+    spec = importlib.util.spec_from_file_location("densenet_ctc_network", str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def small_densenet(network, **kwargs):
+    return network.densenet_custom(num_classes=5, **kwargs)
+
+
+def test_front_follows_train_and_eval():
+    network = load_network()
+    model = small_densenet(network, recompute=("front", ))
+    model.eval()
+    assert not any(m.training for m in model.modules())
+    xs = torch.randn(1, 2, 129, 8)
+    with torch.no_grad():
+        ys = model(xs)
+    assert ys.shape == (1, 4, 5)
+    # the running stats are not updated in eval
+    bn = model.front[1]
+    mean = bn.running_mean.clone()
+    with torch.no_grad():
+        model(xs)
+    assert torch.equal(bn.running_mean, mean)
+    model.train()
+    assert all(m.training for m in model.front)
+
+
+def test_load_the_front_in_the_hidden():
+    network = load_network()
+    model = small_densenet(network)
+    states = model.state_dict()
+    # the keys of the earlier checkpoints
+    old = { (k.replace("front.", "hidden.", 1) if k.startswith("front.") else k): v for k, v in states.items() }
+    assert "hidden.0.weight" in old
+    loaded = small_densenet(network)
+    loaded.load_state_dict(old)
+    assert all(torch.equal(v, loaded.state_dict()[k]) for k, v in states.items())
@@ -0,0 +1,49 @@
+import pytest
+import torch
+import torch.distributed as dist
+
+from asr.models.distributed import TopKCompressor, PowerSGDCompressor
+from asr.utils.misc import is_finite
+
+
+@pytest.fixture
+def process_group(tmp_path):
+    dist.init_process_group(backend="gloo", init_method=f"file://{tmp_path / 'store'}", rank=0, world_size=1)
+    yield
+    dist.destroy_process_group()
+
+
+def compress(compressor, grads):
+    grads = [g.clone() for g in grads]
+    compressor.finish(0, compressor.launch(0, grads), grads)
+    return grads
+
+
+def all_finite(grads):
+    return all(bool(is_finite(g).all()) for g in grads)
+
+
+@pytest.mark.parametrize("compressor", [lambda: TopKCompressor(ratio=0.1), lambda: PowerSGDCompressor(rank=2)])
+def test_non_finite_gradients_leave_the_error_feedback(process_group, compressor):
+    compressor = compressor()
+    torch.manual_seed(0)
+    steps = [[torch.randn(8, 6), torch.randn(8)] for _ in range(3)]
+    compress(compressor, steps[0])
+    errors = {k: v.clone() for k, v in compressor.errors.items()}
+    qs = {k: v.clone() for k, v in getattr(compressor, "qs", dict()).items()}
+
+    bad = [g.clone() for g in steps[1]]
+    bad[0][0, :3] = float("nan")
+    bad[0][1, 0] = float("inf")
+    # passed through for the trainer to skip the step
+    assert not all_finite(compress(compressor, bad))
+    assert all(torch.equal(compressor.errors[k], v) for k, v in errors.items())
+    assert all(torch.equal(compressor.qs[k], v) for k, v in qs.items())
+    assert all_finite(compress(compressor, steps[2]))
+
+
+def test_non_finite_first_step(process_group):
+    compressor = TopKCompressor(ratio=0.1)
+    bad = [torch.full((8, 6), float("nan"))]
+    assert not all_finite(compress(compressor, bad))
+    assert all_finite(compress(compressor, [torch.randn(8, 6)]))
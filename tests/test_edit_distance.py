@@ -0,0 +1,49 @@
+import random
+
+import pytest
+import torch
+
+from asr.utils.edit_distance import edit_distance, pad_sequences
+
+
+def levenshtein(ref, hyp):
+    d = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, d[0] = d[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, d[j] = d[j], min(d[j] + 1, d[j - 1] + 1, prev + (r != h))
+    return d[-1]
+
+
+def test_distances_and_counts():
+    refs = [[1, 2, 3, 4], [5, 6], [], [7, 7, 7], [1, 2]]
+    hyps = [[1, 3, 4, 4, 5], [5, 6], [1, 2], [], [2, 1]]
+    dist, ops = edit_distance(refs, hyps, counts=True)
+    assert dist.tolist() == [3, 0, 2, 3, 2]
+    assert ops[1].tolist() == [0, 0, 0]
+    assert ops[2].tolist() == [0, 2, 0]
+    assert ops[3].tolist() == [0, 0, 3]
+    assert (ops.sum(dim=1) == dist).all()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_batch_matches_the_pairwise_dp(seed):
+    rng = random.Random(seed)
+    refs = [[rng.randrange(4) for _ in range(rng.randrange(12))] for _ in range(16)]
+    hyps = [[rng.randrange(4) for _ in range(rng.randrange(12))] for _ in range(16)]
+    dist, ops = edit_distance(refs, hyps, counts=True)
+    assert dist.tolist() == [levenshtein(r, h) for r, h in zip(refs, hyps)]
+    assert (ops.sum(dim=1) == dist).all()
+    # the substitutions and the deletions less the insertions make up the length difference
+    lens = torch.LongTensor([len(r) - len(h) for r, h in zip(refs, hyps)])
+    assert (ops[:, 2] - ops[:, 1] == lens).all()
+
+
+def test_padded_tensors_with_lengths():
+    refs, ref_lens = pad_sequences([[1, 2, 3], [4]], pad=9)
+    hyps, hyp_lens = pad_sequences([[1, 3], [4, 4, 4]], pad=8)
+    assert edit_distance(refs, hyps, ref_lens, hyp_lens).tolist() == [1, 2]
+
+
+def test_empty_batch():
+    assert edit_distance([], []).tolist() == []
@@ -0,0 +1,43 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from asr.models.deepspeech_ctc.network import DeepSpeech, LSTM
+from asr.utils.inference import optimize_for_inference, _load_network
+from asr.utils.misc import Swish
+
+
+def trained(model, channels=6):
+    # the running stats of some batches, not to fold the identities of the initial ones
+    torch.manual_seed(0)
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.randn(2, channels, 129, 8))
+    return model.eval()
+
+
+@pytest.mark.parametrize("rnn_type, bidirectional", [(nn.LSTM, True), (nn.LSTM, False), (LSTM, True)])
+def test_folded_deepspeech_matches(rnn_type, bidirectional):
+    model = trained(DeepSpeech(num_classes=5, rnn_type=rnn_type, rnn_hidden_size=16, rnn_num_layers=2,
+                               bidirectional=bidirectional, context=3))
+    optimized = optimize_for_inference(model)
+    assert not any(isinstance(m, (nn.modules.batchnorm._BatchNorm, Swish)) for m in optimized.modules())
+    xs = torch.randn(2, 6, 129, 10)
+    with torch.no_grad():
+        assert torch.allclose(optimized(xs), model(xs), atol=1e-6)
+    # the model itself is left as it is
+    assert any(isinstance(m, nn.BatchNorm2d) for m in model.modules())
+    with pytest.raises(RuntimeError):
+        optimized.train()
+
+
+@pytest.mark.parametrize("block", ["BasicBlock", "Bottleneck"])
+def test_folded_resnet_matches(block):
+    network = _load_network("resnet_ctc")
+    model = trained(network.ResNet(getattr(network, block), [1, 1, 1, 1], num_classes=5), channels=2)
+    optimized = optimize_for_inference(model)
+    assert not any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in optimized.modules())
+    xs = torch.randn(2, 2, 129, 10)
+    with torch.no_grad():
+        assert torch.allclose(optimized(xs), model(xs), atol=1e-6)
@@ -0,0 +1,30 @@
+import torch
+
+from asr.utils.misc import ctc_greedy_decode
+
+
+def posteriors(paths, num_labels=4):
+    return torch.eye(num_labels)[torch.LongTensor(paths)]
+
+
+def test_greedy_decode_collapses_the_repeats_and_the_blanks():
+    # a repeat apart by a blank is kept twice
+    ys_hat = posteriors([[0, 1, 1, 0, 1, 2, 2, 0],
+                         [3, 3, 3, 0, 0, 0, 0, 0],
+                         [0, 0, 0, 0, 0, 0, 0, 0]])
+    labels, lens = ctc_greedy_decode(ys_hat, torch.IntTensor([8, 3, 8]))
+    assert lens.tolist() == [3, 1, 0]
+    assert [l.tolist() for l in labels.split(lens.tolist())] == [[1, 1, 2], [3], []]
+
+
+def test_greedy_decode_ignores_the_padded_frames():
+    ys_hat = posteriors([[1, 2, 3, 3],
+                         [2, 0, 1, 2]])
+    labels, lens = ctc_greedy_decode(ys_hat, torch.LongTensor([2, 3]))
+    assert [l.tolist() for l in labels.split(lens.tolist())] == [[1, 2], [2, 1]]
+
+
+def test_greedy_decode_of_the_other_blank():
+    ys_hat = posteriors([[3, 1, 1, 3, 0, 3, 0]])
+    labels, lens = ctc_greedy_decode(ys_hat, torch.LongTensor([7]), blank=3)
+    assert labels.tolist() == [1, 0, 0]
@@ -0,0 +1,69 @@
+import pytest
+
+from asr.decoders.ngram import NGramLM, TrieNGramLM
+
+
+# a trigram LM without <unk>, so the words out of the vocab have the id -1
+ARPA = """
+\\data\\
+ngram 1=5
+ngram 2=5
+ngram 3=2
+
+\\1-grams:
+-1.0 <s> -0.5
+-0.7 a -0.3
+-0.8 b -0.2
+-0.9 c -0.1
+-1.1 </s>
+
+\\2-grams:
+-0.3 <s> a -0.2
+-0.4 a b -0.1
+-0.5 b c
+-0.6 c </s>
+-0.2 b </s> -0.4
+
+\\3-grams:
+-0.1 <s> a b
+-0.15 a b c
+
+\\end\\
+"""
+
+
+@pytest.fixture
+def arpa_file(tmp_path):
+    path = tmp_path.joinpath("lm.arpa")
+    path.write_text(ARPA)
+    return str(path)
+
+
+@pytest.mark.parametrize("sentence", [
+    ["a", "b", "c"],
+    ["a", "x", "b", "c"],
+    ["x", "a", "b"],
+    ["c", "x", "x", "a"],
+    ["c", "x", "a"],
+    ["b", "c", "b", "a", "x"],
+])
+def test_trie_same_with_dict_without_unk(arpa_file, sentence):
+    lm, trie = NGramLM(arpa_file), TrieNGramLM(arpa_file)
+    assert lm.unk_id == trie.unk_id == -1
+    s0, s1 = lm.start(), trie.start()
+    for w in sentence:
+        lp0, s0 = lm.score(s0, lm.index(w))
+        lp1, s1 = trie.score(s1, trie.index(w))
+        assert lp1 == pytest.approx(lp0, abs=1e-5)
+        assert s0 == s1
+    assert trie.final(s1) == pytest.approx(lm.final(s0), abs=1e-5)
+
+
+def test_trie_find_row_of_oov(arpa_file):
+    trie = TrieNGramLM(arpa_file)
+    a, b, c = trie.index("a"), trie.index("b"), trie.index("c")
+    assert trie._find_row((a, b)) >= 0
+    assert trie._find_row((-1, b)) == -1
+    # the key of (c, -1) is that of (b, </s>)
+    assert trie._find_row((c, -1)) == -1
+    assert trie._find_row((-1, )) == -1
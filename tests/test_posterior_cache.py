@@ -0,0 +1,25 @@
+import numpy as np
+
+from asr.decoders.posterior_cache import PosteriorWriter, PosteriorCache
+
+
+def log_softmax(x):
+    return x - np.log(np.exp(x).sum(axis=1, keepdims=True))
+
+
+def test_read_the_shards_of_the_ranks(tmp_path):
+    rng = np.random.RandomState(0)
+    utts = { f"utt{i}": log_softmax(rng.randn(5 + i, 4)) for i in range(3) }
+    # the sampler of the last rank repeats utt0 to even up the shards
+    for rank, names in enumerate([["utt0", "utt2"], ["utt1", "utt0"]]):
+        with PosteriorWriter(tmp_path.joinpath(f"rank_{rank:02d}"), 4) as writer:
+            for name in names:
+                writer.add(name, utts[name], text=name)
+
+    cache = PosteriorCache(tmp_path)
+    assert len(cache) == 3
+    for name, loglikes in utts.items():
+        values, text = cache[name]
+        assert text == name
+        np.testing.assert_allclose(values, loglikes, atol=1e-2)
+    assert [cache[i][1] for i in range(len(cache))] == ["utt0", "utt2", "utt1"]
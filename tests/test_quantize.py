@@ -0,0 +1,40 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from asr.models.deepspeech_ctc.network import DeepSpeech
+from asr.utils.inference import optimize_for_inference
+from asr.utils.quantize import QUANTIZE_MODES, quantize_model, save_quantized_model, load_states, load_quantized_model
+
+
+def float_model():
+    torch.manual_seed(0)
+    model = DeepSpeech(num_classes=5, rnn_hidden_size=16, rnn_num_layers=2)
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.randn(2, 6, 129, 8))
+    return model.eval()
+
+
+@pytest.mark.parametrize("mode", QUANTIZE_MODES)
+def test_quantized_round_trip(tmp_path, mode):
+    model = float_model()
+    calibration = [torch.randn(2, 6, 129, 8) for _ in range(2)]
+    quantized = quantize_model(optimize_for_inference(model), mode, calibration)
+    assert not any(type(m) in (nn.LSTM, nn.Linear) for m in quantized.modules())
+    if mode == "static":
+        assert not any(type(m) is nn.Conv2d for m in quantized.modules())
+
+    xs = torch.randn(1, 6, 129, 10)
+    with torch.no_grad():
+        ys = quantized(xs)
+        # close to the float model, each frame a distribution
+        assert (ys - model(xs)).abs().max() < 0.1
+        assert torch.allclose(ys.sum(2), torch.ones(1, 10), atol=1e-4)
+
+    file_path = tmp_path / "quantized.pth"
+    save_quantized_model(quantized, mode, file_path)
+    loaded = load_quantized_model(float_model(), load_states(str(file_path)))
+    with torch.no_grad():
+        assert torch.equal(loaded(xs), ys)
@@ -0,0 +1,69 @@
+import inspect
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from asr.utils.dataset import Spectrogram, FrameSplitter
+from asr.utils import params as p
+from asr.models.deepspeech_ctc.network import DeepSpeech, LSTM
+from asr.models.deepspeech_ctc.streaming import StreamingDeepSpeech
+
+
+@pytest.fixture(autouse=True)
+def real_stft(monkeypatch):
+    # the recent torch returns the complex stft only, where the 0.4 one returned its real view
+    stft = torch.stft
+    if "return_complex" in inspect.signature(stft).parameters:
+        def real(*args, **kwargs):
+            kwargs.setdefault("return_complex", True)
+            return torch.view_as_real(stft(*args, **kwargs))
+        monkeypatch.setattr(torch, "stft", real)
+
+
+def unidirectional(rnn_type):
+    torch.manual_seed(0)
+    model = DeepSpeech(bidirectional=False, rnn_type=rnn_type, rnn_hidden_size=32, rnn_num_layers=2)
+    # the running stats other than the initial ones, not to hide a batch norm misplaced
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.running_mean.uniform_(-.1, .1)
+            m.running_var.uniform_(.5, 2.)
+    return model.eval()
+
+
+def whole(model, wav):
+    spect = Spectrogram(p.SAMPLE_RATE, p.WINDOW_SHIFT, p.WINDOW_SIZE, p.NFFT)
+    xs = FrameSplitter(1, 0, 3, split=False)(spect(torch.from_numpy(wav)))
+    with torch.no_grad():
+        return model(xs)
+
+
+def streamed(streamer, wav, chunk):
+    streamer.reset()
+    ys = list()
+    for start in range(0, wav.shape[0], chunk):
+        y = streamer(wav[start:(start + chunk)], final=(start + chunk >= wav.shape[0]))
+        if y is not None:
+            ys.append(y)
+    return torch.cat(ys, dim=1)
+
+
+@pytest.mark.parametrize("rnn_type", [nn.LSTM, LSTM])
+@pytest.mark.parametrize("chunk", [37, 333, 1280, 100000])
+def test_chunks_match_the_whole_utterance(rnn_type, chunk):
+    model = unidirectional(rnn_type)
+    wav = np.random.RandomState(chunk).normal(0., .1, 8000 + 37).astype(np.float32)
+    expected = whole(model, wav)
+    ys = streamed(StreamingDeepSpeech(model), wav, chunk)
+    assert ys.shape == expected.shape
+    assert torch.allclose(ys, expected, atol=1e-5)
+
+
+def test_reset_starts_a_new_stream():
+    model = unidirectional(nn.LSTM)
+    streamer = StreamingDeepSpeech(model)
+    wavs = [np.random.RandomState(i).normal(0., .1, 4000).astype(np.float32) for i in range(2)]
+    streamed(streamer, wavs[0], 800)
+    assert torch.allclose(streamed(streamer, wavs[1], 800), whole(model, wavs[1]), atol=1e-5)
@@ -0,0 +1,121 @@
+import torch
+import torch.nn as nn
+
+
+class FixedPosteriors(nn.Module):
+    """ the posteriors given in NxTxH regardless of the input """
+
+    def __init__(self, posteriors):
+        super().__init__()
+        self.posteriors = posteriors
+        self.scale = nn.Parameter(torch.ones(1))
+
+    def forward(self, xs):
+        return self.posteriors * self.scale
+
+
+def onehot_posteriors(paths, num_labels=10):
+    posteriors = torch.full((len(paths), max(len(p) for p in paths), num_labels), 0.01)
+    for i, path in enumerate(paths):
+        posteriors[i, torch.arange(len(path)), torch.tensor(path)] = 0.9
+    return posteriors
+
+
+def test_validate_against_the_targets(make_trainer):
+    # the hyps have 3 and 2 labels, the targets 4 and 2
+    paths = [[3, 0, 4, 4, 0, 5], [7, 7, 0, 8, 0, 0]]
+    trainer = make_trainer(FixedPosteriors(onehot_posteriors(paths)))
+    xs = torch.zeros(2, 1, 4, 6)
+    ys = torch.IntTensor([3, 4, 5, 6, 7, 8])
+    frame_lens, label_lens = torch.IntTensor([6, 6]), torch.IntTensor([4, 2])
+    trainer.model.eval()
+    with torch.no_grad():
+        hyps, refs = trainer.unit_validate((xs, ys, frame_lens, label_lens, ["a", "b"], ["", ""]))
+    assert [h.tolist() for h in hyps] == [[3, 4, 5], [7, 8]]
+    assert [r.tolist() for r in refs] == [[3, 4, 5, 6], [7, 8]]
+    assert trainer.edit_distance(refs, hyps) == 1
+
+
+def test_split_validate_against_the_targets(make_trainer):
+    from asr.models.trainer import SplitTrainer
+    paths = [[3, 0, 4, 4, 0, 5], [7, 7, 0, 8]]
+    # the frames of the utterances in a row
+    posteriors = torch.cat([onehot_posteriors([p])[0] for p in paths])
+    trainer = make_trainer(FixedPosteriors(posteriors), trainer_class=SplitTrainer)
+    xs = torch.zeros(10, 2, 4, 4)
+    ys = torch.IntTensor([3, 4, 5, 6, 7, 8])
+    frame_lens, label_lens = torch.IntTensor([6, 4]), torch.IntTensor([4, 2])
+    trainer.model.eval()
+    with torch.no_grad():
+        hyps, refs = trainer.unit_validate((xs, ys, frame_lens, label_lens, ["a", "b"], ["", ""]))
+    assert [h.tolist() for h in hyps] == [[3, 4, 5], [7, 8]]
+    assert [r.tolist() for r in refs] == [[3, 4, 5, 6], [7, 8]]
+
+
+def test_rng_state_loaded_with_the_weights_only(tmp_path):
+    import random
+    import numpy as np
+    from asr.models.trainer import get_rng_state, set_rng_state
+
+    random.seed(1), np.random.seed(1), torch.manual_seed(1)
+    torch.save({ "rng": get_rng_state() }, str(tmp_path.joinpath("rng.pth")))
+    drawn = (random.random(), np.random.rand(), torch.rand(1).item())
+    states = torch.load(str(tmp_path.joinpath("rng.pth")), weights_only=True)
+    set_rng_state(states["rng"])
+    assert (random.random(), np.random.rand(), torch.rand(1).item()) == drawn
+
+
+class Loader:
+    """ a data loader of the batches given """
+
+    def __init__(self, sampler, batches=[]):
+        self.sampler = sampler
+        self.batches = batches
+        self.batch_size = 1
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def test_sampler_seed_from_the_trainer(make_trainer):
+    from asr.utils.dataloader import ResumableSampler
+
+    seeds = list()
+    for seed in [1, 1, 2]:
+        torch.manual_seed(seed)
+        trainer = make_trainer(FixedPosteriors(onehot_posteriors([[1]])))
+        loader = Loader(ResumableSampler(list(range(100))))
+        trainer.train_epoch(loader)
+        seeds.append(loader.sampler.seed)
+    assert seeds[0] == seeds[1] != seeds[2]
+
+
+def test_skip_the_step_of_non_finite_loss(make_trainer):
+    trainer = make_trainer(FixedPosteriors(onehot_posteriors([[1]])))
+    trainer.accum_first, trainer.accum_last, trainer.accum_size = True, True, 1
+    scale = trainer.model.scale
+    # the momentum of a finite step
+    trainer.optimize((scale * 2.).sum())
+    before = scale.detach().clone()
+    trainer.optimize((scale * float("nan")).sum())
+    assert torch.equal(scale.detach(), before)
+    trainer.optimize((scale * 2.).sum())
+    assert not torch.equal(scale.detach(), before)
+
+
+def test_accumulation_windows(make_trainer):
+    trainer = make_trainer(FixedPosteriors(onehot_posteriors([[1]])))
+    windows = list()
+
+    def unit_train(data):
+        windows.append((trainer.accum_first, trainer.accum_last, trainer.accum_size))
+        return torch.zeros(())
+
+    trainer.unit_train = unit_train
+    batch = (None, None, torch.IntTensor([1]), None, ["a"], [""])
+    trainer.train_epoch(Loader(list(range(5)), [batch] * 5), accum_steps=2)
+    # the last window has a single batch
+    assert windows == [(True, False, 2), (False, True, 2), (True, False, 2), (False, True, 2), (True, True, 1)]